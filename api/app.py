@@ -4,17 +4,18 @@ for i in range(1, 8):
     if not hasattr(torch, f"int{i}"): setattr(torch, f"int{i}", torch.int8)
     if not hasattr(torch, f"uint{i}"): setattr(torch, f"uint{i}", torch.uint8)
 
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import sys
 import os
 from prometheus_fastapi_instrumentator import Instrumentator
-from prometheus_fastapi_instrumentator import Instrumentator
-from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import asyncio
 import threading
-import subprocess
+from contextlib import asynccontextmanager
 import time
 import pandas as pd
 import io
@@ -25,50 +26,85 @@ import traceback
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "qwen_3b")))
 
-from inference import get_model
+from metrics import (
+    REQUEST_COUNT, REQUEST_ERRORS, INFERENCE_TIME, MODEL_LOADED, MODEL_READY, STARTUP_PHASE_SECONDS,
+    GPU_AVAILABLE, GPU_UTIL, GPU_MEM_TOTAL, GPU_MEM_USED, WS_FRAME_ITEMS,
+)
+from scheduler import BATCH_MAX_SIZE, BULK, QueueFull, DeadlineExceeded
+from model_pool import ModelPool, replica_devices, MODEL_REPLICAS_PER_DEVICE
+from model_worker import remote_workers, INFERENCE_WORKERS, MODEL_WORKER_ADDRESSES
+from service import InferenceService
+from fast_path import FastPath
+from gpu_telemetry import MB, get_telemetry
+from schema import DispositionResponse
+import ws_protocol
+from jobs import JobManager, JobNotFound
+from bulk import (
+    find_transcript_column, transcript_text, stream_kind, iter_rows_async, ordered_predictions,
+    csv_header, csv_line, jsonl_line,
+)
 
-app = FastAPI(title="Disposition Extraction API", version="1.0")
-Instrumentator().instrument(app).expose(app)
+# "gpu" loads the real model (on the CPU runtime if there is no CUDA device), "cpu" loads
+# it on the CPU runtime only; "stub" uses the CPU stand-in (for tests / load testing without a GPU)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "gpu").lower()
+# Max concurrent in-flight requests per WebSocket connection
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "4"))
+# Protocol v2 (ws_protocol.py): max items per frame and items in flight per connection
+WS_MAX_FRAME_ITEMS = int(os.getenv("WS_MAX_FRAME_ITEMS", "256"))
+WS_MAX_ITEMS_IN_FLIGHT = int(os.getenv("WS_MAX_ITEMS_IN_FLIGHT", "512"))
+# uvicorn worker processes when started with `python app.py`. Each one loads its own
+# replicas, so more than one needs shared model workers (MODEL_WORKER_ADDRESSES)
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+# Offer permessage-deflate compression on /ws (applies when started with `python app.py`)
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "1") == "1"
+# Default per-request deadline for /predict and /ws when the request sets none (0 = no deadline)
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "0"))
+# Seconds between GPU utilization / memory gauge updates
+GPU_METRICS_INTERVAL_S = float(os.getenv("GPU_METRICS_INTERVAL_S", "5"))
+# Warmup passes (a single row and a full batch on every replica) before reporting ready; 0 skips
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", "1"))
+WARMUP_TRANSCRIPT = os.getenv(
+    "WARMUP_TRANSCRIPT", "Agent: hello, am I speaking with the borrower? Borrower: yes, I will pay 5000 next monday",
+)
+
+@asynccontextmanager
+async def lifespan(app):
+    global jobs
+    # Load in the background so uvicorn binds the port right away; /health/ready tells
+    # the load balancer when to send traffic
+    threading.Thread(target=load_model, name="model-loader", daemon=True).start()
+    threading.Thread(target=collect_gpu_metrics, args=(GPU_METRICS_INTERVAL_S,), name="gpu-metrics", daemon=True).start()
+    # Background bulk jobs, checkpointed to SQLite; unfinished jobs resume on restart. With
+    # several API processes each job is claimed by one of them (see JobManager). Started
+    # here rather than at import, so importing the app starts no threads and opens no database.
+    jobs = JobManager(submit_when_ready)
+    jobs.resume()
+    yield
+    if scheduler is not None:
+        scheduler.stop(timeout=5)
 
-# Prometheus custom metrics
-REQUEST_COUNT = Counter("disposition_requests_total", "Total number of /predict requests")
-REQUEST_ERRORS = Counter("disposition_request_errors_total", "Total number of failed /predict requests")
-INFERENCE_TIME = Histogram("disposition_inference_seconds", "Inference latency in seconds")
-MODEL_LOADED = Gauge("disposition_model_loaded", "Whether the model is loaded (1 = loaded)")
-GPU_AVAILABLE = Gauge("disposition_gpu_available", "Whether CUDA GPU is available (1/0)")
-# Per-GPU metrics will be labeled by index
-GPU_UTIL = Gauge("disposition_gpu_util_percent", "GPU utilization percent", ["gpu"])
-GPU_MEM_TOTAL = Gauge("disposition_gpu_mem_total_mb", "GPU memory total (MB)", ["gpu"])
-GPU_MEM_USED = Gauge("disposition_gpu_mem_used_mb", "GPU memory used (MB)", ["gpu"])
+app = FastAPI(title="Disposition Extraction API", version="1.0", lifespan=lifespan)
+Instrumentator().instrument(app).expose(app)
 
 def collect_gpu_metrics(period_s: int = 5):
-    """Background thread: poll nvidia-smi and update Prometheus gauges."""
+    """Background thread: read in-process GPU telemetry (NVML / torch.cuda) into Prometheus gauges."""
     while True:
         try:
-            # Query utilization, memory total and used for all GPUs
-            cmd = [
-                "nvidia-smi",
-                "--query-gpu=index,utilization.gpu,memory.total,memory.used",
-                "--format=csv,noheader,nounits",
-            ]
-            out = subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
-            GPU_AVAILABLE.set(1)
-            for line in out.strip().splitlines():
-                parts = [p.strip() for p in line.split(',')]
-                if len(parts) >= 4:
-                    idx, util, mem_total, mem_used = parts[0], parts[1], parts[2], parts[3]
-                    GPU_UTIL.labels(gpu=idx).set(float(util))
-                    GPU_MEM_TOTAL.labels(gpu=idx).set(float(mem_total))
-                    GPU_MEM_USED.labels(gpu=idx).set(float(mem_used))
+            telemetry = get_telemetry()
+            indexes = telemetry.devices() if telemetry is not None else []
+            stats = [s for s in (telemetry.snapshot(i) for i in indexes) if s is not None]
+            GPU_AVAILABLE.set(1 if stats else 0)
+            for s in stats:
+                idx = str(s.index)
+                if s.util_percent is not None:
+                    GPU_UTIL.labels(gpu=idx).set(s.util_percent)
+                GPU_MEM_TOTAL.labels(gpu=idx).set(s.mem_total / MB)
+                GPU_MEM_USED.labels(gpu=idx).set(s.mem_used / MB)
         except Exception:
-            # Nvidia-smi not available or failed
+            # No GPU or the driver could not be read
             GPU_AVAILABLE.set(0)
         time.sleep(period_s)
 
-# Start GPU collection thread
-gpu_thread = threading.Thread(target=collect_gpu_metrics, args=(5,), daemon=True)
-gpu_thread.start()
-
 # Serve static UI files (place `index.html` and logo under `api/static`)
 static_dir = os.path.join(os.path.dirname(__file__), "static")
 if not os.path.exists(static_dir):
@@ -81,28 +117,126 @@ from datetime import date
 class TranscriptRequest(BaseModel):
     transcript: str
     current_date: str | None = None
+    # Set to false to skip the result cache (e.g. to force a fresh generation)
+    use_cache: bool = True
+    # Give up if inference has not started within this many ms (defaults to REQUEST_DEADLINE_MS)
+    deadline_ms: float | None = None
+    # Include a per-stage timing breakdown ("timings") in the response
+    debug: bool = False
+
+# Set by load_model() once the replicas are loaded and warmed up
+scheduler = None
+service = None
+# Background job runner, started by lifespan()
+jobs = None
+model_ready = threading.Event()
+# Set once load_model() has finished, whether or not the model came up
+startup_done = threading.Event()
+startup_state = {"phase": "starting", "error": None}
+
+def build_scheduler():
+    # One replica per device (x MODEL_REPLICAS_PER_DEVICE), each with its own batching
+    # scheduler; requests go to the least-loaded replica. CPU replicas (CPU_REPLICAS) take
+    # bulk and/or overflow traffic as set by CPU_ROUTING.
+    devices, cpu_devices = replica_devices(INFERENCE_BACKEND)
+    if MODEL_WORKER_ADDRESSES or INFERENCE_WORKERS == "process":
+        # Each replica lives in its own process, so a CUDA crash only restarts that worker
+        # Devices already say where each replica runs; "cpu" ones load the CPU runtime
+        kind = "stub" if INFERENCE_BACKEND == "stub" else "gpu"
+        replicas = remote_workers(kind, devices, MODEL_REPLICAS_PER_DEVICE)
+        return ModelPool(replicas, remote_workers(kind, cpu_devices, 1, first_port=len(replicas), cpu=True))
+    if INFERENCE_BACKEND == "stub":
+        from stub_model import StubDispositionModel
+        return ModelPool.from_devices(lambda device: StubDispositionModel(), devices, cpu_devices=cpu_devices)
+    from inference import DispositionModel
+    return ModelPool.from_devices(lambda device: DispositionModel(device=device), devices, cpu_devices=cpu_devices)
+
+def load_model():
+    """Background startup: load the replicas, warm them up, then open the front door."""
+    global scheduler, service
+    started = time.perf_counter()
+    try:
+        print("Loading model for API...")
+        startup_state["phase"] = "loading"
+        # Fail on a bad rules file before spending minutes on the model
+        fast_path = FastPath.from_env()
+        t0 = time.perf_counter()
+        # All endpoints go through the batching scheduler instead of calling model.predict directly
+        pool = build_scheduler().start()
+        STARTUP_PHASE_SECONDS.labels(phase="load_model").set(time.perf_counter() - t0)
+        for phase, seconds in pool.load_timings().items():
+            STARTUP_PHASE_SECONDS.labels(phase=phase).set(seconds)
+        MODEL_LOADED.set(1)
+
+        startup_state["phase"] = "warmup"
+        t0 = time.perf_counter()
+        if WARMUP_ROUNDS > 0:
+            pool.warmup(WARMUP_TRANSCRIPT, rounds=WARMUP_ROUNDS, batch_size=BATCH_MAX_SIZE)
+        STARTUP_PHASE_SECONDS.labels(phase="warmup").set(time.perf_counter() - t0)
+
+        scheduler = pool
+        # Result cache and other shortcuts sit in front of the scheduler
+        service = InferenceService(pool, fast_path=fast_path)
+        startup_state["phase"] = "ready"
+        STARTUP_PHASE_SECONDS.labels(phase="total").set(time.perf_counter() - started)
+        MODEL_READY.set(1)
+        model_ready.set()
+        print(f"Model ready after {time.perf_counter() - started:.1f}s")
+    except Exception as e:
+        startup_state["phase"] = "failed"
+        startup_state["error"] = str(e)
+        print(f"ERROR loading model: {e}")
+        traceback.print_exc()
+    finally:
+        startup_done.set()
+
+def ready_service():
+    """The inference front door, or a 503 while the model is still loading."""
+    if not model_ready.is_set():
+        raise HTTPException(
+            status_code=503, detail=f"Model is not ready ({startup_state['phase']})", headers={"Retry-After": "10"},
+        )
+    return service
 
-# Nested Model for Ptp Details
-class PtpDetails(BaseModel):
-    amount: float | str | None = None
-    date: str | None = None
+def submit_when_ready(transcript, current_date=None):
+    # Jobs can be queued (and resumed) during startup; they start once the model is ready,
+    # and fail (instead of waiting forever) if it could not be loaded
+    startup_done.wait()
+    if not model_ready.is_set():
+        raise RuntimeError(f"Model failed to load: {startup_state['error']}")
+    return service.submit(transcript, current_date, lane=BULK)
 
-# Response Model
-class DispositionResponse(BaseModel):
-    disposition: str | None = None
-    payment_disposition: str | None = None
-    reason_for_not_paying: str | None = None
-    ptp_details: PtpDetails | None = None
-    remarks: str | None = None
-    confidence_score: float | None = None
+def request_deadline(deadline_ms):
+    """time.monotonic() deadline for a request budget in ms, or None for no deadline."""
+    if deadline_ms is None:
+        deadline_ms = REQUEST_DEADLINE_MS
+    return time.monotonic() + deadline_ms / 1000.0 if deadline_ms and deadline_ms > 0 else None
+
+def shed_error(e):
+    """Fast 429 / 503 for a request rejected or dropped by admission control."""
+    if isinstance(e, QueueFull):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
 
-print("Loading model for API...")
-# Initialize model on startup
-model = get_model()
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "model": "unsloth/Qwen2.5-7B-Instruct-bnb-4bit"}
+    return {
+        "status": "ok", "model": "unsloth/Qwen2.5-7B-Instruct-bnb-4bit",
+        "ready": model_ready.is_set(), "phase": startup_state["phase"],
+    }
+
+@app.get("/health/live")
+def health_live():
+    """Liveness: the process is up and serving HTTP (the model may still be loading)."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def health_ready():
+    """Readiness: 200 once the model is loaded and warmed up, 503 until then (or if loading failed)."""
+    if model_ready.is_set():
+        return {"status": "ready"}
+    return JSONResponse(status_code=503, content={"status": startup_state["phase"], "error": startup_state["error"]})
 
 @app.get("/")
 def read_root():
@@ -117,48 +251,96 @@ def read_root():
     return {"status": "running", "message": "Disposition Extraction API is active. Use /predict for inference or /docs for documentation."}
 
 
+async def _stream_upload(file: UploadFile, output_format: str):
+    """Read a CSV/JSONL upload in chunks and stream result rows back in input order as they complete."""
+    service = ready_service()
+    kind = stream_kind(file.filename)
+    if kind is None:
+        raise HTTPException(status_code=400, detail="Streaming mode needs a .csv or .jsonl upload.")
+    if output_format not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="Streaming mode supports csv or jsonl output.")
+
+    rows = iter_rows_async(file.file, kind)
+    try:
+        first = await rows.__anext__()
+    except StopAsyncIteration:
+        raise HTTPException(status_code=400, detail="Uploaded file has no rows.")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to parse uploaded file: {e}")
+    transcript_col = find_transcript_column(first.keys())
+    if transcript_col is None:
+        raise HTTPException(status_code=400, detail="No transcript/text column found in uploaded file.")
+
+    async def transcripts():
+        yield transcript_text(first.get(transcript_col))
+        async for row in rows:
+            yield transcript_text(row.get(transcript_col))
+
+    async def body():
+        if output_format == "csv":
+            yield csv_header()
+        # Upload rows go in the bulk lane so live /predict and /ws traffic is served first
+        submit = lambda t: service.submit(t, lane=BULK)
+        async for out in ordered_predictions(transcripts(), submit):
+            yield csv_line(out) if output_format == "csv" else jsonl_line(out)
+
+    media_type = 'text/csv' if output_format == "csv" else 'application/x-ndjson'
+    output_filename = f"predictions_{int(time.time())}.{output_format}"
+    return StreamingResponse(body(), media_type=media_type, headers={"Content-Disposition": f"attachment; filename={output_filename}"})
+
+def _read_table(binary_file, filename):
+    """Parse a whole CSV/Excel/JSON upload into a DataFrame (runs on the threadpool)."""
+    name = filename.lower()
+    if name.endswith(".csv"):
+        return pd.read_csv(binary_file)
+    if name.endswith(('.xls', '.xlsx')):
+        return pd.read_excel(binary_file)
+    if name.endswith(('.jsonl', '.ndjson')):
+        return pd.read_json(binary_file, lines=True)
+    if name.endswith('.json'):
+        return pd.read_json(binary_file)
+    # Try CSV by default
+    return pd.read_csv(binary_file)
+
 @app.post("/upload")
-async def upload_and_process(file: UploadFile = File(...), output_format: str = Form("csv")):
-    """Accepts CSV/Excel/JSON file with a transcript column, runs model.predict on each row, and returns a downloadable file."""
+async def upload_and_process(request: Request, file: UploadFile = File(...), output_format: str = Form("csv"), stream: bool = Form(False)):
+    """Accepts CSV/Excel/JSON file with a transcript column, runs model.predict on each row, and returns a downloadable file.
+
+    With `stream=true`, CSV/JSONL uploads are processed row by row and results are streamed back as they complete.
+    """
+    if stream:
+        return await _stream_upload(file, output_format)
+    service = ready_service()
+
     filename = file.filename or f"upload_{int(time.time())}"
-    body = await file.read()
     try:
-        if filename.lower().endswith(".csv"):
-            df = pd.read_csv(io.BytesIO(body))
-        elif filename.lower().endswith(('.xls', '.xlsx')):
-            df = pd.read_excel(io.BytesIO(body))
-        elif filename.lower().endswith('.json'):
-            df = pd.read_json(io.BytesIO(body))
-        else:
-            # Try CSV by default
-            df = pd.read_csv(io.BytesIO(body))
+        # Parsing a large sheet is CPU work; keep it off the event loop
+        df = await run_in_threadpool(_read_table, file.file, filename)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to parse uploaded file: {e}")
 
     # Find transcript column
-    transcript_col = None
-    for c in df.columns:
-        if 'transcript' in str(c).lower() or 'text' in str(c).lower() or 'conversation' in str(c).lower():
-            transcript_col = c
-            break
+    transcript_col = find_transcript_column(df.columns)
     if transcript_col is None:
         raise HTTPException(status_code=400, detail="No transcript/text column found in uploaded file.")
 
+    async def transcripts():
+        for t in df[transcript_col].tolist():
+            yield transcript_text(t)
+
+    # Same bounded window as streamed uploads: at most BULK_MAX_IN_FLIGHT rows are queued
+    # at a time, and rows not yet run are cancelled if the client goes away
+    submit = lambda t: service.submit(t, lane=BULK)
+    rows = ordered_predictions(transcripts(), submit)
     results = []
-    for _, row in df.iterrows():
-        try:
-            transcript = str(row.get(transcript_col, '') or '')
-            pred = model.predict(transcript)
-            # Flatten prediction into a dict row
-            if isinstance(pred, dict):
-                out = pred.copy()
-            else:
-                out = {"raw": str(pred)}
-        except Exception as e:
-            out = {"error": str(e)}
-        # Keep original columns if needed
-        out["_original_transcript"] = transcript
-        results.append(out)
+    try:
+        async for out in rows:
+            results.append(out)
+            if await request.is_disconnected():
+                print(f"Client disconnected from /upload after {len(results)}/{len(df)} rows; cancelling the rest")
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        await rows.aclose()
 
     out_df = pd.DataFrame(results)
 
@@ -178,11 +360,47 @@ async def upload_and_process(file: UploadFile = File(...), output_format: str =
         buf.write(out_df.to_json(orient='records').encode())
         buf.seek(0)
         media_type = 'application/json'
+    elif output_format == 'jsonl':
+        buf.write(out_df.to_json(orient='records', lines=True).encode())
+        buf.seek(0)
+        media_type = 'application/x-ndjson'
     else:
         raise HTTPException(status_code=400, detail="Unsupported output format")
 
     return StreamingResponse(buf, media_type=media_type, headers={"Content-Disposition": f"attachment; filename={output_filename}"})
 
+@app.post("/jobs")
+async def create_job(file: UploadFile = File(...), output_format: str = Form("csv")):
+    """Store the upload and process it in the background; poll GET /jobs/{id} for progress."""
+    filename = file.filename or f"upload_{int(time.time())}"
+    try:
+        job_id = await run_in_threadpool(jobs.create, filename, file.file, output_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    try:
+        return jobs.status(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    try:
+        status = jobs.status(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if status["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {status['status']}")
+    output_format = status["output_format"]
+    media_type = 'text/csv' if output_format == "csv" else 'application/x-ndjson'
+    return StreamingResponse(
+        jobs.iter_result(job_id), media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=predictions_{job_id}.{output_format}"},
+    )
+
 @app.post("/predict", response_model=DispositionResponse)
 def predict_disposition(request: TranscriptRequest):
     REQUEST_COUNT.inc()
@@ -190,19 +408,27 @@ def predict_disposition(request: TranscriptRequest):
         REQUEST_ERRORS.inc()
         raise HTTPException(status_code=400, detail="Transcript is empty")
 
+    service = ready_service()
     pred_date = request.current_date or str(date.today())
+    deadline = request_deadline(request.deadline_ms)
     start_t = time.time()
     try:
         with INFERENCE_TIME.time():
-            result = model.predict(request.transcript, current_date=pred_date)
+            fut = service.submit(request.transcript, current_date=pred_date, use_cache=request.use_cache, deadline=deadline)
+            result = fut.result()
 
         if isinstance(result, dict) and "error" in result:
             REQUEST_ERRORS.inc()
             raise HTTPException(status_code=500, detail="Model failed to generate valid JSON")
 
+        if request.debug:
+            timings = {**(getattr(fut, "timings", None) or {}), "total": time.time() - start_t}
+            return JSONResponse({**DispositionResponse(**result).model_dump(), "timings": timings})
         return result
     except HTTPException:
         raise
+    except (QueueFull, DeadlineExceeded) as e:
+        raise shed_error(e)
     except Exception as e:
         REQUEST_ERRORS.inc()
         print(f"ERROR in /predict: {str(e)}")
@@ -214,36 +440,203 @@ def metrics():
     resp = generate_latest()
     return HTMLResponse(content=resp, status_code=200, media_type=CONTENT_TYPE_LATEST)
 
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    print("WebSocket connection established")
+async def _ws_stream(transcript, current_date, send_partial, use_cache=True, deadline=None):
+    """Submit a streaming request and forward raw JSON fields while the model generates them.
+
+    Returns the finished scheduler future (result plus `timings`).
+    """
+    loop = asyncio.get_running_loop()
+    partials = asyncio.Queue()
+    # on_partial runs on the scheduler thread; hop back onto the event loop to send
+    fut = service.submit(
+        transcript, current_date,
+        on_partial=lambda fields: loop.call_soon_threadsafe(partials.put_nowait, fields),
+        use_cache=use_cache, deadline=deadline,
+    )
+    try:
+        done = asyncio.wrap_future(fut)
+        # Completion is delivered through the same loop callbacks, so the sentinel lands after every partial
+        done.add_done_callback(lambda _: partials.put_nowait(None))
+        while True:
+            fields = await partials.get()
+            if fields is None:
+                break
+            await send_partial(fields)
+        done.result()
+        return fut
+    finally:
+        # On disconnect only `partials.get()` is cancelled; drop the queued request, or
+        # stop a running generation at its next field (see scheduler.StreamFuture)
+        fut.cancel()
+
+async def _ws_result(data, send_partial=None):
+    """Run one /ws request (a v1 message or a v2 item) and return its result or error payload.
+
+    With `send_partial` the request streams and each generated field is passed to it.
+    """
+    transcript = data.get("transcript") or ""
+    current_date = data.get("current_date") or str(date.today())
+    use_cache = bool(data.get("use_cache", True))
+    try:
+        deadline = request_deadline(data.get("deadline_ms"))
+    except TypeError:
+        return {"error": "deadline_ms must be a number"}
+
+    if not isinstance(transcript, str) or not transcript.strip():
+        return {"error": "Transcript is empty"}
+    if not model_ready.is_set():
+        return {"error": f"Model is not ready ({startup_state['phase']})"}
+
+    REQUEST_COUNT.inc()
+    start_t = time.time()
+    try:
+        with INFERENCE_TIME.time():
+            if send_partial is not None:
+                fut = await _ws_stream(transcript, current_date, send_partial, use_cache=use_cache, deadline=deadline)
+            else:
+                # Awaiting the scheduler future keeps the event loop free while the batch runs
+                fut = service.submit(transcript, current_date, use_cache=use_cache, deadline=deadline)
+                await asyncio.wrap_future(fut)
+        result = fut.result()
+
+        if isinstance(result, dict) and "error" in result:
+            REQUEST_ERRORS.inc()
+            return {"error": "Model failed to generate valid JSON", "details": result["error"]}
+        if data.get("debug"):
+            result = {**result, "timings": {**(getattr(fut, "timings", None) or {}), "total": time.time() - start_t}}
+        return result
+    except asyncio.CancelledError:
+        raise
+    except (QueueFull, DeadlineExceeded) as e:
+        err = shed_error(e)
+        return {"error": err.detail, "status": err.status_code, "retry_after": int(err.headers["Retry-After"])}
+    except Exception as e:
+        REQUEST_ERRORS.inc()
+        print(f"ERROR in WebSocket predict: {str(e)}")
+        return {"error": str(e)}
+
+async def _ws_predict(data, send):
+    """Run one v1 WebSocket request through the scheduler and send its result frame."""
+    request_id = data.get("request_id")
+
+    def tagged(payload):
+        # Echo the client's request_id so pipelined responses can be matched out of order
+        if request_id is not None:
+            payload = {"request_id": request_id, **payload}
+        return payload
+
+    stream = bool(data.get("stream"))
+    send_partial = (lambda fields: send(tagged({"type": "partial", "fields": fields}))) if stream else None
+    payload = await _ws_result(data, send_partial)
+    if stream and "error" not in payload:
+        payload = {"type": "final", **payload}
+    await send(tagged(payload))
+
+async def _ws_session_v1(websocket, send):
+    # Up to WS_MAX_IN_FLIGHT requests per socket run concurrently. At the limit we stop
+    # reading from the socket until one finishes, which pushes back on the client via TCP.
+    slots = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    pending = set()
+
+    async def handle(data):
+        try:
+            await _ws_predict(data, send)
+        finally:
+            slots.release()
+
     try:
         while True:
+            await slots.acquire()
             data = await websocket.receive_json()
-            transcript = data.get("transcript", "")
-            current_date = data.get("current_date") or str(date.today())
-            
-            if not transcript.strip():
-                await websocket.send_json({"error": "Transcript is empty"})
-                continue
+            task = asyncio.create_task(handle(data))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    finally:
+        # Cancelling the task also cancels its scheduler future, so queued rows are dropped
+        # and streaming generations stop early
+        for task in pending:
+            task.cancel()
+
+async def _ws_session_v2(websocket, send, encoding):
+    # Items from every frame share WS_MAX_ITEMS_IN_FLIGHT slots; a frame is only read
+    # once the previous one is fully submitted, so a full socket pushes back via TCP.
+    slots = asyncio.Semaphore(WS_MAX_ITEMS_IN_FLIGHT)
+    results = asyncio.Queue()
+    pending = set()
 
-            REQUEST_COUNT.inc()
+    async def handle(item):
+        try:
+            if "error" in item:
+                payload = {"error": item["error"]}
+            elif item.get("id") is None:
+                payload = {"error": "Item id is required"}
+            elif item.get("stream"):
+                payload = {"error": "Streaming is not supported in protocol v2"}
+            else:
+                payload = await _ws_result(item)
+            results.put_nowait({"id": item.get("id"), **payload})
+        finally:
+            slots.release()
+
+    async def sender():
+        # Results finished by the same batch are queued together; send whatever has
+        # accumulated as one frame instead of one frame per item
+        while True:
+            batch = [await results.get()]
+            while not results.empty() and len(batch) < WS_MAX_FRAME_ITEMS:
+                batch.append(results.get_nowait())
+            WS_FRAME_ITEMS.labels(direction="out").observe(len(batch))
+            await send({"results": batch})
+
+    sender_task = asyncio.create_task(sender())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
             try:
-                with INFERENCE_TIME.time():
-                    # model.predict is synchronous and handles its own threading lock
-                    result = model.predict(transcript, current_date=current_date)
-                
-                if isinstance(result, dict) and "error" in result:
-                    REQUEST_ERRORS.inc()
-                    await websocket.send_json({"error": "Model failed to generate valid JSON", "details": result["error"]})
-                else:
-                    await websocket.send_json(result)
+                items = ws_protocol.frame_items(ws_protocol.decode(message, encoding), WS_MAX_FRAME_ITEMS)
             except Exception as e:
-                REQUEST_ERRORS.inc()
-                print(f"ERROR in WebSocket predict: {str(e)}")
-                await websocket.send_json({"error": str(e)})
+                await send({"error": f"Invalid frame: {e}"})
+                continue
+            WS_FRAME_ITEMS.labels(direction="in").observe(len(items))
+            for item in items:
+                await slots.acquire()
+                task = asyncio.create_task(handle(item))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+    finally:
+        for task in pending:
+            task.cancel()
+        sender_task.cancel()
 
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    try:
+        version, encoding, subprotocol = ws_protocol.negotiate(
+            websocket.scope.get("subprotocols") or [], websocket.query_params,
+        )
+    except ws_protocol.ProtocolError as e:
+        print(f"WebSocket connection rejected: {e}")
+        await websocket.close(code=1003, reason=str(e)[:120])
+        return
+    await websocket.accept(subprotocol=subprotocol)
+    print(f"WebSocket connection established (protocol v{version}, {encoding})")
+    send_lock = asyncio.Lock()
+
+    async def send(payload):
+        text, data = ws_protocol.encode(payload, encoding)
+        async with send_lock:
+            if data is not None:
+                await websocket.send_bytes(data)
+            else:
+                await websocket.send_text(text)
+
+    try:
+        if version == 2:
+            await _ws_session_v2(websocket, send, encoding)
+        else:
+            await _ws_session_v1(websocket, send)
     except WebSocketDisconnect:
         print("WebSocket client disconnected")
     except Exception as e:
@@ -252,4 +645,12 @@ async def websocket_endpoint(websocket: WebSocket):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8005)
+    if API_WORKERS > 1 and not MODEL_WORKER_ADDRESSES and INFERENCE_BACKEND != "stub":
+        sys.exit("API_WORKERS > 1 needs MODEL_WORKER_ADDRESSES (model workers started once and shared); "
+                 "otherwise every API worker loads its own copy of the model")
+    # An import string, not the app object: uvicorn can only start several workers from one
+    uvicorn.run(
+        "app:app", app_dir=os.path.dirname(os.path.abspath(__file__)), workers=API_WORKERS,
+        host=os.getenv("API_HOST", "0.0.0.0"), port=int(os.getenv("API_PORT", "8005")),
+        ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE,
+    )
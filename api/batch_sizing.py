@@ -0,0 +1,114 @@
+import os
+
+from gpu_telemetry import MB, device_index, get_telemetry
+from metrics import BATCH_MEMORY_BUDGET, BATCH_MEMORY_LIMITED
+
+# =========================
+# CONFIG
+# =========================
+# Size batches from free GPU memory and prompt lengths (backends with `memory_profile()` only)
+ADAPTIVE_BATCHING = os.getenv("ADAPTIVE_BATCHING", "1") == "1"
+# Share of the currently available memory a batch may plan to use
+GPU_MEMORY_UTILIZATION = float(os.getenv("GPU_MEMORY_UTILIZATION", "0.9"))
+# Kept free on top of that for the CUDA workspace and allocator fragmentation
+GPU_MEMORY_RESERVE_MB = float(os.getenv("GPU_MEMORY_RESERVE_MB", "512"))
+# On CUDA OOM the planned budget is multiplied by this ...
+OOM_BACKOFF = float(os.getenv("OOM_BACKOFF", "0.5"))
+# ... and grows back by one OOM_RECOVERY_STEP after this many batches without one
+OOM_RECOVERY_BATCHES = int(os.getenv("OOM_RECOVERY_BATCHES", "50"))
+OOM_RECOVERY_STEP = float(os.getenv("OOM_RECOVERY_STEP", "0.1"))
+MIN_BUDGET_SCALE = 0.05
+
+
+def is_oom(exc):
+    """CUDA out-of-memory (recoverable, unlike an illegal memory access; see model_worker.is_fatal)."""
+    return type(exc).__name__ == "OutOfMemoryError" or "out of memory" in str(exc).lower()
+
+
+class BatchSizeController:
+    """Picks how many rows fit in the next batch from free GPU memory and prompt lengths.
+
+    The backend's `memory_profile()` describes what one batch costs:
+    `kv_bytes_per_token` (KV cache), `prefill_bytes_per_token` (transient activations
+    while the prompt is prefilled), `fixed_tokens` (tokens every row adds on top of its
+    transcript: the cached prefix and the generated answer) and `row_bytes` (per-row
+    logits and masks). Rows are left-padded to the longest transcript, so a batch of
+    `rows` costs `rows * (longest * (kv + prefill) + fixed_tokens * kv + row_bytes)`.
+
+    `budget()` reads the device once per batch; `fits()` checks a candidate batch
+    against it. A CUDA OOM scales the budget down by `backoff` (after which the
+    scheduler re-runs the batch in halves); every `recovery_batches` successful
+    batches it grows back by `recovery_step`, so a transient spike does not cap
+    throughput forever.
+    """
+    def __init__(self, telemetry, index, profile, name="0", share=1.0,
+                 utilization=GPU_MEMORY_UTILIZATION, reserve_mb=GPU_MEMORY_RESERVE_MB,
+                 backoff=OOM_BACKOFF, recovery_batches=OOM_RECOVERY_BATCHES, recovery_step=OOM_RECOVERY_STEP):
+        self.telemetry = telemetry
+        self.index = index
+        self.name = name
+        # Replicas sharing the device each plan with their share of the free memory
+        self.share = min(1.0, max(0.0, float(share)))
+        self.utilization = min(1.0, max(0.0, float(utilization)))
+        self.reserve = max(0.0, float(reserve_mb)) * MB
+        self.backoff = min(1.0, max(MIN_BUDGET_SCALE, float(backoff)))
+        self.recovery_batches = max(1, int(recovery_batches))
+        self.recovery_step = max(0.0, float(recovery_step))
+        self.token_bytes = profile["kv_bytes_per_token"] + profile["prefill_bytes_per_token"]
+        self.row_overhead = profile["fixed_tokens"] * profile["kv_bytes_per_token"] + profile["row_bytes"]
+        self.scale = 1.0
+        self._clean_batches = 0
+        self._budget_gauge = BATCH_MEMORY_BUDGET.labels(replica=name)
+        self._limited = BATCH_MEMORY_LIMITED.labels(replica=name)
+
+    @classmethod
+    def for_backend(cls, backend, name="0", share=1.0):
+        """A controller for `backend`, or None (disabled, no memory profile, not on CUDA, no telemetry)."""
+        if not ADAPTIVE_BATCHING or not hasattr(backend, "memory_profile"):
+            return None
+        profile = backend.memory_profile()
+        index = device_index(profile.get("device")) if profile else None
+        telemetry = get_telemetry()
+        if index is None or telemetry is None:
+            return None
+        print(f"Adaptive batching on replica {name}: {profile['kv_bytes_per_token'] / 1024:.0f} KiB KV "
+              f"+ {profile['prefill_bytes_per_token'] / 1024:.0f} KiB prefill per token")
+        return cls(telemetry, index, profile, name=name, share=share)
+
+    def budget(self):
+        """Bytes the next batch may use, or None when the device cannot be read."""
+        try:
+            stats = self.telemetry.snapshot(self.index)
+        except Exception as e:
+            print(f"GPU telemetry failed on replica {self.name}: {e}")
+            return None
+        if stats is None:
+            return None
+        budget = max(0.0, stats.available * self.utilization - self.reserve) * self.share * self.scale
+        self._budget_gauge.set(budget / MB)
+        return budget
+
+    def cost(self, rows, longest):
+        return rows * (longest * self.token_bytes + self.row_overhead)
+
+    def fits(self, rows, longest, budget):
+        return self.cost(rows, longest) <= budget
+
+    def limited(self):
+        """Count a batch that was cut short because the next row did not fit."""
+        self._limited.inc()
+
+    def on_success(self):
+        if self.scale >= 1.0:
+            return
+        self._clean_batches += 1
+        if self._clean_batches >= self.recovery_batches:
+            self._clean_batches = 0
+            self.scale = min(1.0, self.scale + self.recovery_step)
+
+    def on_oom(self, rows):
+        self._clean_batches = 0
+        self.scale = max(MIN_BUDGET_SCALE, self.scale * self.backoff)
+        # Hand the failed batch's cached blocks back before the retry plans against free memory
+        self.telemetry.release_cached(self.index)
+        print(f"CUDA OOM on replica {self.name} with {rows} rows; memory budget scaled to {self.scale:.2f}")
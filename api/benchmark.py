@@ -0,0 +1,469 @@
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk import find_transcript_column, iter_rows
+
+# Used when no --corpus is given: a small mix of the call types the model sees
+SAMPLE_TRANSCRIPTS = [
+    "Agent: Hello, your EMI is pending. Borrower: I will pay 5000 next Monday.",
+    "Agent: Vikas ji se baat ho rahi hai? Customer: Nahi, main unka beta bol raha hoon.",
+    "Agent: Hello? The number you are calling is switched off, please try again later.",
+    "Agent: Aapka payment kab tak hoga? Borrower: Haan main parso 5000 jama kar dunga.",
+    "Agent: Your loan is overdue. Borrower: I lost my job last month, I cannot pay right now.",
+    "Agent: Hello sir, EMI due hai. Borrower: Main hospital mein hoon, baad mein baat karta hoon.",
+    "Agent: Sir payment pending hai. Borrower: Maine kal hi pay kar diya, receipt bhej deta hoon.",
+    "Agent: Aap kisi ko ghar bhej do. Borrower: Haan, ghar aa jao, main cash de dunga.",
+]
+
+# Regression checks for --compare: (summary path, higher_is_better)
+COMPARE_METRICS = [
+    (("throughput_rps",), True),
+    (("latency_s", "p50"), False),
+    (("latency_s", "p95"), False),
+    (("latency_s", "p99"), False),
+    (("error_rate",), False),
+]
+
+
+def load_corpus(path=None, field=None):
+    """Transcripts from a .jsonl / .csv / .json file (or the built-in sample set)."""
+    if path is None:
+        return list(SAMPLE_TRANSCRIPTS)
+    name = path.lower()
+    if name.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+    else:
+        with open(path, "rb") as f:
+            rows = list(iter_rows(f, "csv" if name.endswith(".csv") else "jsonl"))
+    transcripts = []
+    for row in rows:
+        if isinstance(row, str):
+            transcripts.append(row)
+            continue
+        column = field or find_transcript_column(row.keys())
+        if column is None or column not in row:
+            raise SystemExit(f"No transcript column in {path}; pass --field")
+        if row[column]:
+            transcripts.append(str(row[column]))
+    if not transcripts:
+        raise SystemExit(f"No transcripts found in {path}")
+    return transcripts
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(q):
+        # Nearest-rank percentile
+        return values[max(0, math.ceil(q * len(values)) - 1)]
+
+    return {
+        "mean": sum(values) / len(values), "p50": rank(0.50), "p95": rank(0.95),
+        "p99": rank(0.99), "max": values[-1],
+    }
+
+
+class Sample:
+    """Outcome of one request (one upload counts `rows` transcripts)."""
+    __slots__ = ("latency", "ok", "status", "ttft", "timings", "rows")
+
+    def __init__(self, latency, ok, status, ttft=None, timings=None, rows=1):
+        self.latency = latency
+        self.ok = ok
+        self.status = status
+        self.ttft = ttft
+        self.timings = timings
+        self.rows = rows
+
+
+# =========================
+# Clients
+# =========================
+def _http(request, timeout):
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+class PredictClient:
+    def __init__(self, base_url, args):
+        self.url = base_url.rstrip("/") + "/predict"
+        self.args = args
+
+    def __call__(self, transcript):
+        payload = {"transcript": transcript, "use_cache": self.args.use_cache, "debug": self.args.server_timings}
+        if self.args.deadline_ms:
+            payload["deadline_ms"] = self.args.deadline_ms
+        request = urllib.request.Request(
+            self.url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"},
+        )
+        status, body = _http(request, self.args.timeout)
+        timings = None
+        if status == 200 and self.args.server_timings:
+            timings = json.loads(body).get("timings")
+        return status, status == 200, None, timings, 1
+
+
+class UploadClient:
+    """Posts each chunk of transcripts as one CSV file to /upload."""
+    def __init__(self, base_url, args):
+        self.url = base_url.rstrip("/") + "/upload"
+        self.args = args
+
+    def __call__(self, transcripts):
+        boundary = uuid.uuid4().hex
+        csv_buf = io.StringIO()
+        writer = csv.writer(csv_buf)
+        writer.writerow(["transcript"])
+        writer.writerows([t] for t in transcripts)
+        csv_body = csv_buf.getvalue()
+        parts = [
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"output_format\"\r\n\r\njsonl\r\n",
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"stream\"\r\n\r\n{str(self.args.upload_stream).lower()}\r\n",
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"bench.csv\"\r\n"
+            f"Content-Type: text/csv\r\n\r\n{csv_body}\r\n",
+            f"--{boundary}--\r\n",
+        ]
+        request = urllib.request.Request(
+            self.url, data="".join(parts).encode("utf-8"),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        status, body = _http(request, self.args.timeout)
+        ok = status == 200
+        if ok:
+            # Every output row must be a prediction, not an error row
+            rows = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+            ok = len(rows) == len(transcripts) and not any(r.get("error") for r in rows)
+        return status, ok, None, None, len(transcripts)
+
+
+class WebSocketClient:
+    """One WebSocket per worker thread, one request in flight per socket.
+
+    With --ws-items each request is one protocol v2 frame carrying that many transcripts.
+    """
+    def __init__(self, base_url, args):
+        try:
+            from websockets.sync.client import connect
+        except ImportError:
+            raise SystemExit("The /ws benchmark needs the `websockets` package (pip install websockets)")
+        self.connect = connect
+        self.codec = (json.dumps, json.loads)
+        if args.ws_items and args.ws_encoding == "msgpack":
+            try:
+                import msgpack
+            except ImportError:
+                raise SystemExit("--ws-encoding msgpack needs the `msgpack` package (pip install msgpack)")
+            self.codec = (msgpack.packb, msgpack.unpackb)
+        self.url = base_url.rstrip("/").replace("http://", "ws://").replace("https://", "wss://") + "/ws"
+        self.args = args
+        self.local = threading.local()
+        self.sockets = []
+        self.lock = threading.Lock()
+
+    def _socket(self):
+        ws = getattr(self.local, "ws", None)
+        if ws is None:
+            subprotocols = [f"disposition.v2.{self.args.ws_encoding}"] if self.args.ws_items else None
+            ws = self.local.ws = self.connect(self.url, open_timeout=self.args.timeout, subprotocols=subprotocols)
+            with self.lock:
+                self.sockets.append(ws)
+        return ws
+
+    def __call__(self, transcript):
+        if self.args.ws_items:
+            return self._frame(transcript)
+        payload = {
+            "transcript": transcript, "use_cache": self.args.use_cache,
+            "stream": self.args.ws_stream, "debug": self.args.server_timings,
+        }
+        if self.args.deadline_ms:
+            payload["deadline_ms"] = self.args.deadline_ms
+        started = time.perf_counter()
+        ttft = None
+        try:
+            ws = self._socket()
+            ws.send(json.dumps(payload))
+            while True:
+                msg = json.loads(ws.recv(timeout=self.args.timeout))
+                if msg.get("type") == "partial":
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    continue
+                break
+        except Exception:
+            self.local.ws = None
+            raise
+        if "error" in msg:
+            return msg.get("status", "error"), False, ttft, None, 1
+        return 200, True, ttft, msg.get("timings"), 1
+
+    def _frame(self, transcripts):
+        payload = {
+            "items": [{"id": i, "transcript": t} for i, t in enumerate(transcripts)],
+            "use_cache": self.args.use_cache, "debug": self.args.server_timings,
+        }
+        if self.args.deadline_ms:
+            payload["deadline_ms"] = self.args.deadline_ms
+        dumps, loads = self.codec
+        results = {}
+        try:
+            ws = self._socket()
+            ws.send(dumps(payload))
+            # Results arrive in completion order, possibly several per frame
+            while len(results) < len(transcripts):
+                msg = loads(ws.recv(timeout=self.args.timeout))
+                if "error" in msg:
+                    return "error", False, None, None, len(transcripts)
+                results.update((r["id"], r) for r in msg["results"])
+        except Exception:
+            self.local.ws = None
+            raise
+        errors = [r for r in results.values() if "error" in r]
+        if errors:
+            return errors[0].get("status", "error"), False, None, None, len(transcripts)
+        timings = [r["timings"] for r in results.values() if r.get("timings")]
+        return 200, True, None, (timings[0] if timings else None), len(transcripts)
+
+    def close(self):
+        for ws in self.sockets:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+
+CLIENTS = {"predict": PredictClient, "ws": WebSocketClient, "upload": UploadClient}
+
+
+# =========================
+# Runner
+# =========================
+def run_benchmark(client, items, concurrency, rate=None, seed=0):
+    """Replay `items` through `client`; returns (samples, wall seconds).
+
+    Without `rate` this is a closed loop: `concurrency` clients send back to back.
+    With `rate` (req/s) arrivals follow a Poisson process and latency is measured
+    from the scheduled arrival, so time spent waiting for a free client counts too.
+    """
+    samples = []
+    lock = threading.Lock()
+
+    def one(item, scheduled):
+        started = scheduled if scheduled is not None else time.perf_counter()
+        try:
+            status, ok, ttft, timings, rows = client(item)
+        except Exception as e:
+            status, ok, ttft, timings, rows = type(e).__name__, False, None, None, (len(item) if isinstance(item, list) else 1)
+        sample = Sample(time.perf_counter() - started, ok, status, ttft, timings, rows)
+        with lock:
+            samples.append(sample)
+
+    rng = random.Random(seed)
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if rate:
+            next_at = wall_start
+            for item in items:
+                next_at += rng.expovariate(rate)
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, item, next_at)
+        else:
+            for item in items:
+                pool.submit(one, item, None)
+    return samples, time.perf_counter() - wall_start
+
+
+def summarize(samples, wall_s):
+    ok = [s for s in samples if s.ok]
+    rows = sum(s.rows for s in samples)
+    summary = {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "error_rate": (len(samples) - len(ok)) / len(samples) if samples else 0.0,
+        "rows": rows,
+        "duration_s": wall_s,
+        "throughput_rps": len(ok) / wall_s if wall_s > 0 else 0.0,
+        "rows_per_s": sum(s.rows for s in ok) / wall_s if wall_s > 0 else 0.0,
+        "latency_s": percentiles([s.latency for s in ok]),
+        "status_codes": dict(Counter(str(s.status) for s in samples)),
+    }
+    ttft = [s.ttft for s in ok if s.ttft is not None]
+    if ttft:
+        summary["ttft_s"] = percentiles(ttft)
+    # Mean server-side stage breakdown (requests sent with debug=true)
+    stage_values = {}
+    for s in ok:
+        for stage, value in (s.timings or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stage_values.setdefault(stage, []).append(value)
+    if stage_values:
+        summary["server_timings_mean"] = {k: sum(v) / len(v) for k, v in sorted(stage_values.items())}
+    return summary
+
+
+def compare(current, baseline, tolerance):
+    """Print current vs baseline; returns the metrics that regressed by more than `tolerance`."""
+    regressions = []
+    for key in ("endpoint", "concurrency", "rate", "requests", "upload_rows", "corpus"):
+        if baseline.get("config", {}).get(key) != current["config"].get(key):
+            print(f"WARNING: baseline was run with {key}={baseline.get('config', {}).get(key)!r}, "
+                  f"this run with {current['config'].get(key)!r}")
+    print(f"\n{'metric':<20}{'baseline':>14}{'current':>14}{'change':>10}")
+    for path, higher_is_better in COMPARE_METRICS:
+        old, new = baseline["summary"], current["summary"]
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if old is None or new is None:
+            continue
+        name = ".".join(path)
+        change = (new - old) / old if old else (0.0 if new == old else math.inf)
+        print(f"{name:<20}{old:>14.4f}{new:>14.4f}{change:>+10.1%}")
+        if name == "error_rate":
+            worse = new - old > 0.01
+        else:
+            worse = -change > tolerance if higher_is_better else change > tolerance
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def wait_ready(base_url, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            status, _ = _http(urllib.request.Request(base_url.rstrip("/") + "/health/ready"), 5)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise SystemExit(f"Server at {base_url} did not become ready within {timeout_s}s")
+
+
+def spawn_server(args, backend="stub"):
+    """Start api/app.py with the stub backend (or the real model on the CPU runtime) on --port and wait until it is ready."""
+    env = dict(
+        os.environ,
+        INFERENCE_BACKEND=backend,
+        STUB_BATCH_LATENCY_MS=str(args.stub_batch_ms),
+        STUB_ITEM_LATENCY_MS=str(args.stub_item_ms),
+        API_HOST="127.0.0.1",
+        API_PORT=str(args.port),
+        JOBS_DIR=tempfile.mkdtemp(prefix="bench_jobs_"),
+    )
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    proc = subprocess.Popen([sys.executable, app_path], env=env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_ready(base_url, args.ready_timeout)
+    except BaseException:
+        proc.terminate()
+        raise
+    return proc, base_url
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a transcript corpus against the API and report throughput, latency percentiles and errors.",
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8005", help="Base URL of a running server")
+    parser.add_argument("--spawn-stub", action="store_true", help="Start the API with the CPU stub backend on --port")
+    parser.add_argument("--spawn-cpu", action="store_true", help="Start the API with the real model on the CPU runtime on --port")
+    parser.add_argument("--port", type=int, default=8015)
+    parser.add_argument("--stub-batch-ms", type=float, default=200, help="Stub fake latency per batch")
+    parser.add_argument("--stub-item-ms", type=float, default=20, help="Stub fake latency per row")
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--endpoint", choices=sorted(CLIENTS), default="predict")
+    parser.add_argument("--corpus", help=".jsonl / .csv / .json file of transcripts (default: built-in samples)")
+    parser.add_argument("--field", help="Transcript field/column in the corpus (default: auto-detect)")
+    parser.add_argument("--requests", type=int, default=200, help="Requests to send (the corpus is cycled)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--rate", type=float, help="Open-loop Poisson arrival rate in req/s (default: closed loop)")
+    parser.add_argument("--upload-rows", type=int, default=50, help="Transcripts per /upload request")
+    parser.add_argument("--upload-stream", action="store_true", help="Use the streaming /upload mode")
+    parser.add_argument("--ws-items", type=int, default=0, help="Transcripts per /ws protocol v2 frame (0 = v1, one per message)")
+    parser.add_argument("--ws-encoding", choices=["json", "msgpack"], default="json", help="Encoding of v2 frames")
+    parser.add_argument("--ws-stream", action="store_true", help="Use streaming /ws frames and report time to first field")
+    parser.add_argument("--use-cache", action="store_true", help="Allow result-cache hits (off: every request generates)")
+    parser.add_argument("--deadline-ms", type=float, help="deadline_ms sent with each /predict and /ws request")
+    parser.add_argument("--server-timings", action="store_true", help="Send debug=true and report mean server stage timings")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Write config + summary as JSON here")
+    parser.add_argument("--compare", help="Baseline results JSON; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression for --compare")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus, args.field)
+    rng = random.Random(args.seed)
+    transcripts = [corpus[i % len(corpus)] for i in range(args.requests)]
+    rng.shuffle(transcripts)
+    chunk = args.upload_rows if args.endpoint == "upload" else args.ws_items if args.endpoint == "ws" else 0
+    if chunk:
+        items = [transcripts[i:i + chunk] for i in range(0, len(transcripts), chunk)]
+    else:
+        items = transcripts
+
+    server = None
+    base_url = args.url
+    if args.spawn_stub or args.spawn_cpu:
+        server, base_url = spawn_server(args, "cpu" if args.spawn_cpu else "stub")
+    client = CLIENTS[args.endpoint](base_url, args)
+    try:
+        print(f"Benchmarking {args.endpoint} at {base_url}: {len(items)} requests, "
+              f"concurrency {args.concurrency}, {'rate %.1f/s' % args.rate if args.rate else 'closed loop'}")
+        samples, wall_s = run_benchmark(client, items, args.concurrency, args.rate, args.seed)
+    finally:
+        if hasattr(client, "close"):
+            client.close()
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    summary = summarize(samples, wall_s)
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    config["base_url"] = base_url
+    config["corpus_size"] = len(corpus)
+    results = {"created_at": time.time(), "config": config, "summary": summary}
+    print(json.dumps(summary, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"REGRESSION: {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
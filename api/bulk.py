@@ -0,0 +1,131 @@
+import asyncio
+import csv
+import io
+import json
+import math
+import os
+from collections import deque
+from itertools import islice
+
+from starlette.concurrency import run_in_threadpool
+
+# =========================
+# CONFIG
+# =========================
+# Rows read from the upload per threadpool hop
+BULK_READ_CHUNK_ROWS = int(os.getenv("BULK_READ_CHUNK_ROWS", "256"))
+# Max rows submitted to the scheduler and not yet written back, per upload
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", "64"))
+
+# Columns of every streamed output row, in order
+OUTPUT_COLUMNS = [
+    "disposition", "payment_disposition", "reason_for_not_paying", "ptp_details",
+    "remarks", "confidence_score", "error", "raw", "_original_transcript",
+]
+
+
+def find_transcript_column(columns):
+    """First column that looks like it holds the transcript, or None."""
+    for c in columns:
+        if 'transcript' in str(c).lower() or 'text' in str(c).lower() or 'conversation' in str(c).lower():
+            return c
+    return None
+
+
+def transcript_text(value):
+    """A transcript cell as text; None, NaN (an empty pandas cell) and blank cells give ""."""
+    if value is None or isinstance(value, float) and math.isnan(value):
+        return ""
+    text = str(value)
+    return text if text.strip() else ""
+
+
+def stream_kind(filename):
+    """'csv' / 'jsonl' when the upload can be read row by row, else None."""
+    name = (filename or "").lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return None
+
+
+def iter_rows(binary_file, kind):
+    """Yield dict rows from a CSV or JSON Lines file object without loading it all."""
+    text = io.TextIOWrapper(binary_file, encoding="utf-8-sig", newline="")
+    if kind == "csv":
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+async def iter_rows_async(binary_file, kind, chunk_rows=BULK_READ_CHUNK_ROWS):
+    """Async wrapper around `iter_rows` that reads in chunks on the threadpool."""
+    rows = iter_rows(binary_file, kind)
+    while True:
+        chunk = await run_in_threadpool(lambda: list(islice(rows, chunk_rows)))
+        if not chunk:
+            return
+        for row in chunk:
+            yield row
+
+
+def prediction_row(pred, transcript):
+    """Flatten one prediction (or exception) into an output row."""
+    if isinstance(pred, BaseException):
+        out = {"error": str(pred)}
+    elif isinstance(pred, dict):
+        out = pred.copy()
+    else:
+        out = {"raw": str(pred)}
+    # Keep original columns if needed
+    out["_original_transcript"] = transcript
+    return out
+
+
+async def ordered_predictions(transcripts, submit, max_in_flight=BULK_MAX_IN_FLIGHT):
+    """Submit transcripts as they arrive and yield output rows in input order.
+
+    At most `max_in_flight` rows are queued but not yet yielded, so a huge file neither
+    floods the scheduler queue nor buffers its results in memory.
+    """
+    window = deque()
+
+    async def pop():
+        transcript, fut = window.popleft()
+        try:
+            pred = await asyncio.wrap_future(fut)
+        except Exception as e:
+            pred = e
+        return prediction_row(pred, transcript)
+
+    try:
+        async for transcript in transcripts:
+            window.append((transcript, submit(transcript)))
+            if len(window) >= max_in_flight:
+                yield await pop()
+        while window:
+            yield await pop()
+    finally:
+        # Client went away mid-stream: drop rows that have not reached the GPU yet
+        for _, fut in window:
+            fut.cancel()
+
+
+def csv_header():
+    buf = io.StringIO()
+    csv.writer(buf).writerow(OUTPUT_COLUMNS)
+    return buf.getvalue()
+
+
+def csv_line(row):
+    buf = io.StringIO()
+    csv.DictWriter(buf, fieldnames=OUTPUT_COLUMNS, extrasaction="ignore").writerow(row)
+    return buf.getvalue()
+
+
+def jsonl_line(row):
+    return json.dumps(row, ensure_ascii=False) + "\n"
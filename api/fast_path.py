@@ -0,0 +1,147 @@
+import json
+import os
+
+from keywords import KEYWORD_RULES, KeywordMatcher
+from metrics import FAST_PATH_CHECKED, FAST_PATH_HITS
+from postprocess import clean_output
+from schema import CALL_LABELS, DispositionResponse
+
+# =========================
+# CONFIG
+# =========================
+# Answer system-message / no-contact transcripts from keyword rules instead of the model
+FAST_PATH = os.getenv("FAST_PATH", "1") == "1"
+# JSON file with a rule set in the DEFAULT_FAST_PATH_RULES format (empty = built-in rules)
+FAST_PATH_RULES = os.getenv("FAST_PATH_RULES", "")
+# Rules whose confidence is below this are not applied
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.9"))
+
+# Categories in "require" / "forbid" are keywords.KEYWORD_RULES categories or ones
+# added under "keywords". A rule fires when every required category is present, no
+# forbidden one is (global or per rule) and the transcript has at most max_words words.
+#
+# Each rule requires one of the fast path's own "system_*" categories (operator
+# announcement wording, never words a person says on a live call: "busy", "waiting",
+# "another call" are clean_output hints, not proof that nobody picked up) together with
+# the clean_output category that produces the same disposition, and forbids the
+# categories clean_output checks before it. The model path therefore gives the same
+# disposition for every transcript a rule answers.
+DEFAULT_FAST_PATH_RULES = {
+    "version": "3",
+    "keywords": {
+        "system_switched_off": [
+            "is switched off", "is currently switched off", "has been switched off",
+            "switched off hai", "switch off hai",
+        ],
+        "system_out_of_network": [
+            "is not reachable", "is currently not reachable", "is out of network",
+            "network kshetra se bahar", "kshetra se bahar hai",
+        ],
+        "system_busy": [
+            "you are calling is busy", "you have dialled is busy", "you have dialed is busy", "subscriber is busy",
+            "is busy on another call", "is currently busy", "abhi vyast hai", "vyast hai, kripya",
+        ],
+        "system_ringing": [
+            "you are calling is ringing", "phone is ringing", "[ringing]", "(ringing)",
+            "ghanti ja rahi hai", "ghanti baj rahi hai",
+        ],
+        # A labelled turn from the other side means someone picked up
+        "borrower_turn": ["borrower:", "borrower :", "customer:", "customer :"],
+        # Promises in Hindi that "pay" / "commitment" do not catch
+        "promise": ["dunga", "dungi", "denge", "kar deta", "kar dete", "de deta"],
+    },
+    # Longer transcripts are real conversations even if a system message is quoted
+    "max_words": 40,
+    # Any sign that the borrower engaged sends the call to the model
+    "forbid": ["borrower_turn", "paid", "pay", "commitment", "promise", "family", "medical", "visit"],
+    # Same precedence as the system message overrides in postprocess.clean_output
+    "rules": [
+        {"name": "switched_off", "disposition": "SWITCHED_OFF", "require": ["system_switched_off", "switched_off"],
+         "confidence": 0.97, "remarks": "number switched off or not reachable"},
+        {"name": "out_of_network", "disposition": "OUT_OF_NETWORK",
+         "require": ["system_out_of_network", "out_of_network"], "forbid": ["switched_off"],
+         "confidence": 0.96, "remarks": "number out of network coverage"},
+        {"name": "busy", "disposition": "BUSY", "require": ["system_busy", "busy"],
+         "forbid": ["switched_off", "out_of_network"], "max_words": 25,
+         "confidence": 0.92, "remarks": "number busy"},
+        {"name": "ringing", "disposition": "RINGING", "require": ["system_ringing", "ringing", "hello"],
+         "forbid": ["switched_off", "out_of_network", "busy", "pick"],
+         "confidence": 0.9, "remarks": "call rang, no one answered"},
+    ],
+}
+
+
+class FastPath:
+    """Rule-based pre-classifier for calls that never reached a person.
+
+    `classify(transcript, current_date)` returns `(rule name, DispositionResponse dict)`
+    for a system-message / no-contact transcript and None for everything else, which
+    then goes to the model as usual. The answer goes through `clean_output` like a model
+    answer; a rule whose disposition `clean_output` would override (possible with a
+    custom rule set) defers to the model.
+    """
+    def __init__(self, config, min_confidence=FAST_PATH_MIN_CONFIDENCE):
+        self.version = str(config["version"])
+        self.matcher = KeywordMatcher({**KEYWORD_RULES, **config.get("keywords", {})})
+        self.max_words = config.get("max_words")
+        self.forbid = tuple(config.get("forbid", ()))
+        self.rules = []
+        for rule in config["rules"]:
+            if rule["disposition"] not in CALL_LABELS:
+                raise ValueError(f"Fast path rule {rule['name']!r}: unknown disposition {rule['disposition']!r}")
+            categories = list(rule.get("require", ())) + list(rule.get("forbid", ())) + list(self.forbid)
+            unknown = [c for c in categories if c not in self.matcher.rules]
+            if unknown:
+                raise ValueError(f"Fast path rule {rule['name']!r}: unknown keyword categories {unknown}")
+            if not rule.get("require"):
+                raise ValueError(f"Fast path rule {rule['name']!r} has no required categories")
+            if rule.get("confidence", 1.0) >= min_confidence:
+                self.rules.append(rule)
+
+    @classmethod
+    def from_env(cls):
+        """The configured rule set, or None when FAST_PATH=0."""
+        if not FAST_PATH:
+            return None
+        config = DEFAULT_FAST_PATH_RULES
+        if FAST_PATH_RULES:
+            with open(FAST_PATH_RULES, encoding="utf-8") as f:
+                config = json.load(f)
+        fast_path = cls(config)
+        print(f"Fast path rules v{fast_path.version}: {', '.join(r['name'] for r in fast_path.rules) or 'none'} "
+              f"(min confidence {FAST_PATH_MIN_CONFIDENCE})")
+        return fast_path
+
+    def classify(self, transcript, current_date=None):
+        FAST_PATH_CHECKED.inc()
+        text = str(transcript).lower()
+        words = len(text.split())
+        kw = self.matcher.scan(text)
+        if any(kw.has(c) for c in self.forbid):
+            return None
+        for rule in self.rules:
+            max_words = rule.get("max_words", self.max_words)
+            if max_words is not None and words > max_words:
+                continue
+            if any(kw.has(c) for c in rule.get("forbid", ())):
+                continue
+            if all(kw.has(c) for c in rule["require"]):
+                result = self.result(rule, str(transcript), current_date)
+                if result["disposition"] != rule["disposition"]:
+                    return None
+                FAST_PATH_HITS.labels(rule=rule["name"], version=self.version).inc()
+                return rule["name"], result
+        return None
+
+    @staticmethod
+    def result(rule, transcript, current_date=None):
+        # The answer the schema decoder would emit for these calls, normalized the same way
+        raw = {
+            "disposition": rule["disposition"],
+            "payment_disposition": None,
+            "reason_for_not_paying": None,
+            "ptp_details": {"amount": None, "date": None},
+            "remarks": rule.get("remarks", ""),
+            "confidence_score": rule.get("confidence", 1.0),
+        }
+        return DispositionResponse(**clean_output(raw, transcript, current_date)).model_dump()
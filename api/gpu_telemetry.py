@@ -0,0 +1,182 @@
+import os
+import sys
+import threading
+
+# =========================
+# CONFIG
+# =========================
+# Where GPU utilization / memory readings come from: auto (NVML, else torch.cuda), nvml, torch, fake, off
+GPU_TELEMETRY = os.getenv("GPU_TELEMETRY", "auto").lower()
+# Device reported by GPU_TELEMETRY=fake (for tests and the stub backend)
+GPU_TELEMETRY_FAKE_TOTAL_MB = float(os.getenv("GPU_TELEMETRY_FAKE_TOTAL_MB", "15360"))
+GPU_TELEMETRY_FAKE_FREE_MB = float(os.getenv("GPU_TELEMETRY_FAKE_FREE_MB", "4096"))
+
+MB = 1024 * 1024
+
+
+class GpuStats:
+    """One reading for one CUDA device; memory in bytes, utilization in percent (None if unknown).
+
+    `reclaimable` is memory this process's torch allocator has cached but not in use:
+    it counts as used for the driver but a new batch can still get it.
+    """
+    __slots__ = ("index", "util_percent", "mem_total", "mem_used", "mem_free", "reclaimable")
+
+    def __init__(self, index, util_percent, mem_total, mem_used, mem_free, reclaimable=0):
+        self.index = index
+        self.util_percent = util_percent
+        self.mem_total = mem_total
+        self.mem_used = mem_used
+        self.mem_free = mem_free
+        self.reclaimable = reclaimable
+
+    @property
+    def available(self):
+        return self.mem_free + self.reclaimable
+
+
+def device_index(device):
+    """CUDA ordinal of a torch device string ("cuda" / "cuda:1"), or None for non-CUDA devices."""
+    device = str(device)
+    if not device.startswith("cuda"):
+        return None
+    _, _, index = device.partition(":")
+    return int(index) if index else 0
+
+
+def _torch_cuda():
+    # Only look at torch when the process already uses it, and never initialize CUDA
+    # from here: in the API process of INFERENCE_WORKERS=process that would allocate a
+    # context on every GPU just to read a gauge.
+    torch = sys.modules.get("torch")
+    cuda = getattr(torch, "cuda", None)
+    if cuda is None or not hasattr(cuda, "is_initialized") or not cuda.is_initialized():
+        return None
+    return cuda
+
+
+def _reclaimable(index):
+    cuda = _torch_cuda()
+    if cuda is None:
+        return 0
+    try:
+        return max(0, cuda.memory_reserved(index) - cuda.memory_allocated(index))
+    except Exception:
+        return 0
+
+
+class NvmlTelemetry:
+    """Readings from NVML (the library nvidia-smi uses), without spawning a process."""
+    def __init__(self):
+        import pynvml
+        pynvml.nvmlInit()
+        self.nvml = pynvml
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def devices(self):
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        if visible is not None:
+            return list(range(len([d for d in visible.split(",") if d.strip()])))
+        return list(range(self.nvml.nvmlDeviceGetCount()))
+
+    def _handle(self, index):
+        # NVML numbers every GPU in the machine; CUDA only the visible ones
+        with self._lock:
+            if index not in self._handles:
+                visible = [d.strip() for d in os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",") if d.strip()]
+                if not visible:
+                    handle = self.nvml.nvmlDeviceGetHandleByIndex(index)
+                elif visible[index].isdigit():
+                    handle = self.nvml.nvmlDeviceGetHandleByIndex(int(visible[index]))
+                else:
+                    handle = self.nvml.nvmlDeviceGetHandleByUUID(visible[index])
+                self._handles[index] = handle
+            return self._handles[index]
+
+    def snapshot(self, index):
+        handle = self._handle(index)
+        mem = self.nvml.nvmlDeviceGetMemoryInfo(handle)
+        try:
+            util = float(self.nvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+        except self.nvml.NVMLError:
+            util = None
+        return GpuStats(index, util, mem.total, mem.used, mem.free, _reclaimable(index))
+
+    def release_cached(self, index):
+        cuda = _torch_cuda()
+        if cuda is not None:
+            cuda.empty_cache()
+
+
+class TorchTelemetry:
+    """Readings from torch.cuda for devices this process already uses (no utilization without NVML)."""
+    def devices(self):
+        cuda = _torch_cuda()
+        return list(range(cuda.device_count())) if cuda is not None else []
+
+    def snapshot(self, index):
+        cuda = _torch_cuda()
+        if cuda is None:
+            return None
+        free, total = cuda.mem_get_info(index)
+        try:
+            util = float(cuda.utilization(index))
+        except Exception:
+            util = None
+        return GpuStats(index, util, total, total - free, free, _reclaimable(index))
+
+    def release_cached(self, index):
+        cuda = _torch_cuda()
+        if cuda is not None:
+            cuda.empty_cache()
+
+
+class FakeTelemetry:
+    """Fixed readings that tests can change (`free_mb`); `release_cached` is a no-op."""
+    def __init__(self, total_mb=GPU_TELEMETRY_FAKE_TOTAL_MB, free_mb=GPU_TELEMETRY_FAKE_FREE_MB, count=1):
+        self.total_mb = total_mb
+        self.free_mb = free_mb
+        self.count = count
+        self.released = 0
+
+    def devices(self):
+        return list(range(self.count))
+
+    def snapshot(self, index):
+        total, free = int(self.total_mb * MB), int(self.free_mb * MB)
+        return GpuStats(index, 0.0, total, total - free, free)
+
+    def release_cached(self, index):
+        self.released += 1
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def create_telemetry(kind=GPU_TELEMETRY):
+    """A telemetry provider for `kind`, or None when none is available (or kind is "off")."""
+    if kind == "off":
+        return None
+    if kind == "fake":
+        return FakeTelemetry()
+    if kind in ("auto", "nvml"):
+        try:
+            return NvmlTelemetry()
+        except Exception as e:
+            if kind == "nvml":
+                print(f"NVML telemetry unavailable: {e}")
+                return None
+    if kind in ("auto", "torch"):
+        return TorchTelemetry()
+    raise ValueError(f"Unknown GPU_TELEMETRY: {kind}")
+
+
+def get_telemetry():
+    """The process-wide provider selected by GPU_TELEMETRY (created on first use)."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = create_telemetry() or False
+        return _telemetry or None
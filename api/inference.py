@@ -4,44 +4,168 @@ for i in range(1, 8):
     if not hasattr(torch, f"int{i}"): setattr(torch, f"int{i}", torch.int8)
     if not hasattr(torch, f"uint{i}"): setattr(torch, f"uint{i}", torch.uint8)
 
-from unsloth import FastLanguageModel
-from transformers import TextStreamer, StoppingCriteria, StoppingCriteriaList
+try:
+    # Unsloth patches transformers, so it is imported first. It needs a GPU; CPU-only
+    # hosts go without it and load through the CPU runtime (see model_runtime.py).
+    import unsloth  # noqa: F401
+except Exception:
+    pass
+from transformers import TextStreamer, StoppingCriteria, StoppingCriteriaList, DynamicCache
+import copy
+import hashlib
 import json
-from datetime import date, datetime, timedelta
+from datetime import date
 from dateutil.relativedelta import relativedelta, MO, TU, WE, TH, FR, SA, SU
 import re
 import sys
 import os
 import threading
+import time
+
+from metrics import (
+    TRUNCATED_TRANSCRIPTS, PROMPT_TOKENS, GENERATED_TOKENS, DECODE_TOKENS_PER_SECOND, SCHEMA_FORCED_TOKENS,
+    SPEC_DRAFT_TOKENS, SPEC_ACCEPTED_TOKENS,
+)
+from partial_json import PartialJsonParser
+from postprocess import clean_output
+from profiling import StageTimer, maybe_profile
+from schema import FIELD_LABELS, REQUIRED_FIELDS, DispositionResponse
+from schema_decoding import SchemaDecoder, vocab_cache_key
+from model_runtime import runtime_for
+
+
+def load_brace_tables(tokenizer, vocab_size=None, cache_dir=None):
+    """Boolean tables over the vocabulary marking tokens that contain '{' / '}'.
+
+    Built from the vocab strings in one pass (no per-id decode) and cached on disk
+    keyed by a hash of the tokenizer, so restarts only pay a torch.load.
+    """
+    cache_dir = cache_dir or STOP_TABLE_CACHE_DIR
+    size = max(len(tokenizer), vocab_size or 0)
+    path = os.path.join(cache_dir, f"brace_table_{vocab_cache_key(tokenizer, size)}.pt")
+    if os.path.exists(path):
+        try:
+            tables = torch.load(path)
+            return tables["open"], tables["close"]
+        except Exception as e:
+            print(f"WARNING: ignoring unreadable brace table cache {path}: {e}")
+
+    open_table = torch.zeros(size, dtype=torch.bool)
+    close_table = torch.zeros(size, dtype=torch.bool)
+    open_ids, close_ids = [], []
+    for tok, tid in tokenizer.get_vocab().items():
+        # Byte-level BPE keeps printable ASCII as-is; sentencepiece byte fallback spells it <0x7B>
+        if '{' in tok or tok == "<0x7B>":
+            open_ids.append(tid)
+        if '}' in tok or tok == "<0x7D>":
+            close_ids.append(tid)
+    open_table[torch.tensor(open_ids, dtype=torch.long)] = True
+    close_table[torch.tensor(close_ids, dtype=torch.long)] = True
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save({"open": open_table, "close": close_table}, path)
+    except OSError as e:
+        print(f"WARNING: could not write brace table cache {path}: {e}")
+    return open_table, close_table
 
 class StopOnJson(StoppingCriteria):
-    """Stop generation when the outermost JSON '{}' is closed (brace depth returns to 0)."""
-    def __init__(self, tokenizer):
-        self.tokenizer = tokenizer
-        # Pre-compute which token IDs contain '{' or '}'
-        self.open_ids = set()
-        self.close_ids = set()
-        for tid in range(tokenizer.vocab_size):
-            tok = tokenizer.decode([tid])
-            if '{' in tok:
-                self.open_ids.add(tid)
-            if '}' in tok:
-                self.close_ids.add(tid)
-        self.reset()
-
-    def reset(self):
-        self.depth = 0
-        self.started = False
+    """Stop each row when its outermost JSON '{}' is closed (brace depth returns to 0).
+
+    The brace tables are shared and read-only; the per-row depth lives on this instance,
+    so build one with `for_generation()` per generate() call and it is safe to use the
+    same tables from concurrent requests.
+    """
+    def __init__(self, open_table, close_table):
+        self.open_table = open_table
+        self.close_table = close_table
+        self.depth = None
+        self.started = None
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, vocab_size=None, device=None):
+        open_table, close_table = load_brace_tables(tokenizer, vocab_size)
+        return cls(open_table.to(device), close_table.to(device))
+
+    def for_generation(self):
+        return StopOnJson(self.open_table, self.close_table)
 
     def __call__(self, input_ids, scores, **kwargs):
-        last_token = input_ids[0, -1].item()
-        if last_token in self.open_ids:
-            self.depth += 1
-            self.started = True
-        if last_token in self.close_ids:
-            self.depth -= 1
+        last_tokens = input_ids[:, -1]
+        if self.depth is None or self.depth.shape[0] != last_tokens.shape[0]:
+            self.depth = torch.zeros(last_tokens.shape[0], dtype=torch.int32, device=input_ids.device)
+            self.started = torch.zeros(last_tokens.shape[0], dtype=torch.bool, device=input_ids.device)
+        opened = self.open_table[last_tokens]
+        closed = self.close_table[last_tokens]
+        self.depth += opened.int() - closed.int()
+        self.started |= opened
         # Stop only when we've opened at least one brace and depth is back to 0
-        return self.started and self.depth <= 0
+        return self.started & (self.depth <= 0)
+
+class FirstTokenTimer(StoppingCriteria):
+    """Never stops generation; records when the first new token exists (end of prefill).
+
+    Synchronizes once, on the first call, so the timestamp is not just the moment the
+    prefill kernels were queued.
+    """
+    def __init__(self):
+        self.at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.at is None:
+            if input_ids.is_cuda:
+                torch.cuda.synchronize(input_ids.device)
+            self.at = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class PrefixKVCache:
+    """past_key_values of the static instruction block, computed once and shared by every request.
+
+    Keyed by a hash of the prefix text: if the prompt template changes, the next `get()`
+    recomputes the cache instead of silently reusing stale keys/values.
+    """
+    def __init__(self, model, tokenizer, device):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.version = None
+        self.input_ids = None
+        self.past_key_values = None
+
+    @staticmethod
+    def hash_prefix(prefix_text):
+        return hashlib.sha256(prefix_text.encode("utf-8")).hexdigest()[:16]
+
+    @torch.inference_mode()
+    def get(self, prefix_text):
+        version = self.hash_prefix(prefix_text)
+        if version != self.version:
+            ids = self.tokenizer(prefix_text, return_tensors="pt")["input_ids"].to(self.device)
+            out = self.model(input_ids=ids, use_cache=True)
+            pkv = out.past_key_values
+            if isinstance(pkv, tuple):
+                pkv = DynamicCache.from_legacy_cache(pkv)
+            self.input_ids, self.past_key_values, self.version = ids, pkv, version
+            print(f"Prefix KV cache built: {ids.shape[1]} tokens (template {version})")
+        return self.input_ids, self.past_key_values
+
+    def expand(self, batch_size):
+        # generate() appends to the cache in place, so every call gets its own copy
+        cache = copy.deepcopy(self.past_key_values)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+class JsonFieldStreamer(TextStreamer):
+    """TextStreamer that forwards each completed top-level JSON field instead of printing text."""
+    def __init__(self, tokenizer, on_partial):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.parser = PartialJsonParser()
+        self.on_partial = on_partial
+
+    def on_finalized_text(self, text, stream_end=False):
+        fields = self.parser.feed(text)
+        if fields:
+            self.on_partial(fields)
 
 # =========================
 # CONFIG
@@ -50,26 +174,92 @@ MODEL_PATH = os.getenv("QWEN_MODEL", "khushianand01/disposition_model")
 MAX_SEQ_LEN = 8192 # Expanded from 4096 to handle long transcripts
 DTYPE = None # Auto
 LOAD_IN_4BIT = True
+MAX_NEW_TOKENS = 512
+# Transcripts over budget are cut in token space: "head" keeps the start,
+# "head_tail" keeps both ends (the tail is where PTP commitments usually are)
+TRUNCATION_MODE = os.getenv("TRUNCATION_MODE", "head").lower()
+TRUNCATION_HEAD_FRACTION = float(os.getenv("TRUNCATION_HEAD_FRACTION", "0.3"))
+TRUNCATION_MARKER = " ... [TRUNCATED] "
+# Character cap applied before tokenizing (roughly 4 chars/token over the whole context)
+MAX_TRANSCRIPT_CHARS = int(os.getenv("MAX_TRANSCRIPT_CHARS", str(4 * MAX_SEQ_LEN)))
+# Where StopOnJson's per-tokenizer brace tables are cached between restarts
+STOP_TABLE_CACHE_DIR = os.getenv("STOP_TABLE_CACHE_DIR", os.path.expanduser("~/.cache/disposition_api"))
+# Reuse the instruction block's KV cache across requests (prefill only Context/Transcript)
+PREFIX_KV_CACHE = os.getenv("PREFIX_KV_CACHE", "1") == "1"
+# Decode only the values of the DispositionResponse JSON, restricted to the schema and label sets.
+# Off by default: it changes what the model is allowed to write, so enable it once validated.
+SCHEMA_DECODING = os.getenv("SCHEMA_DECODING", "0") == "1"
+# Token budget per generated string value (remarks, ptp date) in schema decoding
+SCHEMA_MAX_STRING_TOKENS = int(os.getenv("SCHEMA_MAX_STRING_TOKENS", "64"))
+# Speculative decoding: draft tokens per step copied from the transcript by n-gram lookup (0 = off).
+# Drafts are verified against the greedy pick, so the output does not change.
+PROMPT_LOOKUP_TOKENS = int(os.getenv("PROMPT_LOOKUP_TOKENS", "0"))
+PROMPT_LOOKUP_MAX_NGRAM = int(os.getenv("PROMPT_LOOKUP_MAX_NGRAM", "3"))
 
 class DispositionModel:
-    def __init__(self, model_path=MODEL_PATH):
+    def __init__(self, model_path=MODEL_PATH, device="cuda", runtime=None):
         self.lock = threading.Lock()
-        print(f"Loading model from {model_path}...")
-        if not torch.cuda.is_available():
-            raise RuntimeError("CUDA is not available. This server requires a GPU to run.")
-        self.device = "cuda"
+        # Loads the weights: Unsloth 4-bit on a GPU, or the CPU runtime for "cpu" devices
+        self.runtime = runtime or runtime_for(device)
+        self.device = self.runtime.device
+        print(f"Loading model from {model_path} ({self.runtime.name} runtime)...")
         print(f"Using device: {self.device}")
-        self.model, self.tokenizer = FastLanguageModel.from_pretrained(
-            model_name=model_path,
-            max_seq_length=MAX_SEQ_LEN,
-            dtype=DTYPE,
-            load_in_4bit=LOAD_IN_4BIT,
+        # Seconds spent in each loading step, exported as startup metrics by the API
+        self.load_timings = {}
+        t0 = time.perf_counter()
+        self.model, self.tokenizer = self.runtime.load(model_path, MAX_SEQ_LEN, dtype=DTYPE, load_in_4bit=LOAD_IN_4BIT)
+        self.model_id = self.runtime.model_path
+        # Batched generation needs left padding so every row ends at "### Response:"
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.marker_ids = self.tokenizer(TRUNCATION_MARKER, add_special_tokens=False)["input_ids"]
+        self.load_timings["model_weights"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.stop_on_json = StopOnJson.from_tokenizer(
+            self.tokenizer, vocab_size=self.model.config.vocab_size, device=self.device,
         )
-        FastLanguageModel.for_inference(self.model)
-        self.stop_criteria = StoppingCriteriaList([StopOnJson(self.tokenizer)])
+        self.load_timings["stop_tables"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.schema_decoder = None
+        if SCHEMA_DECODING:
+            self.schema_decoder = SchemaDecoder.from_tokenizer(
+                self.tokenizer, DispositionResponse, FIELD_LABELS, REQUIRED_FIELDS,
+                max_string_tokens=SCHEMA_MAX_STRING_TOKENS, vocab_size=self.model.config.vocab_size,
+                device=self.device, cache_dir=STOP_TABLE_CACHE_DIR,
+            )
+        self.load_timings["schema_tables"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.prefix_cache = None
+        if PREFIX_KV_CACHE:
+            try:
+                self.prefix_cache = PrefixKVCache(self.model, self.tokenizer, self.device)
+                self.prefix_cache.get(self.format_prefix())
+            except Exception as e:
+                print(f"WARNING: prefix KV cache disabled: {e}")
+                self.prefix_cache = None
+        self.load_timings["prefix_cache"] = time.perf_counter() - t0
         print("Model loaded successfully.")
 
+    @property
+    def prompt_version(self):
+        """Short hash of the static instruction block; changes whenever the template or decoding mode does."""
+        mode = "schema" if self.schema_decoder is not None else "free"
+        return PrefixKVCache.hash_prefix(f"{mode}\x00{self.format_prefix()}")
+
     def format_prompt(self, transcript, current_date=None):
+        return self.format_prefix() + self.format_input(transcript, current_date)
+
+    def format_input(self, transcript, current_date=None):
+        """Per-request part of the prompt (everything after the shared instruction prefix)."""
+        return f"""Context: Current Date is {current_date}
+Transcript: {transcript}
+
+### Response:
+"""
+
+    def format_prefix(self):
+        """Static instruction block: identical for every request, so its KV cache is shared."""
         instruction = (
             "You are an AI assistant that extracts structured call disposition data.\n"
             "Fields: disposition, payment_disposition, reason_for_not_paying, ptp_details, remarks, confidence_score.\n"
@@ -121,261 +311,265 @@ class DispositionModel:
 {instruction}
 
 ### Input:
-Context: Current Date is {current_date}
-Transcript: {transcript}
-
-### Response:
 """
 
     def clean_output(self, result: dict, transcript: str, current_date: str) -> dict:
-        if not isinstance(result, dict): return {"error": "Invalid format", "raw": str(result)}
-
-        call_labels = [
-            "ANSWERED", "ANSWERED_BY_FAMILY_MEMBER", "CUSTOMER_PICKED", "AGENT_BUSY_ON_ANOTHER_CALL",
-            "SILENCE_ISSUE", "LANGUAGE_BARRIER", "ANSWERED_VOICE_ISSUE", "CUSTOMER_ABUSIVE",
-            "AUTOMATED_VOICE", "FORWARDED_CALL", "RINGING", "BUSY", "SWITCHED_OFF",
-            "WRONG_NUMBER", "DO_NOT_KNOW_THE_PERSON", "NOT_IN_CONTACT_ANYMORE", "OUT_OF_NETWORK", "OUT_OF_SERVICES",
-            "CALL_BACK_LATER", "WILL_ASK_TO_PAY", "GAVE_ALTERNATE_NUMBER",
-            "ANSWERED_DISCONNECTED", "CALL_DISCONNECTED_BY_CUSTOMER", "NOT_AVAILABLE", "WRONG_PERSON", 
-            "NO_INCOMING_CALLS", "RINGING_DISCONNECTED", "OTHERS"
-        ]
-        
-        pay_labels = [
-            "PAID", "PTP", "PARTIAL_PAYMENT", "SETTLEMENT", "WILL_PAY_AFTER_VISIT",
-            "DENIED_TO_PAY", "NO_PAYMENT_COMMITMENT", "NO_PROOF_GIVEN", "WANT_FORECLOSURE", "WANTS_TO_RENEGOTIATE_LOAN_TERMS",
-            "None"
-        ]
-
-        # 1. FUZZY Label Mapping (Don't be too strict)
-        disp = str(result.get("disposition", "OTHERS")).upper().replace(" ", "_")
-
-        # Pre-check transcript for family member keywords (more reliable than model label)
-        family_keywords = ["beta", "beti", "pati", "patni", "bhai", "bhabhi", "devar", "son", "daughter",
-                           "wife", "husband", "brother", "sister", "ghar pe nahi", "ghar par nahi",
-                           "abhi nahi hain", "at home nahi", "not at home", "nahi hain", "ghar mein nahi"]
-        lower_t = transcript.lower()
-        agent_asking_for_borrower = any(kw in lower_t for kw in ["se baat", "se baat ho", "bol raha hoon", "bol rahi hoon", "speaking"])
-        family_answered = any(kw in lower_t for kw in family_keywords)
-
-        # 1.5 System Message Heuristics (Very Reliable)
-        if any(kw in lower_t for kw in ["switched off", "switch off", "out of reach", "band aa raha", "switch-off", "nahi lag raha"]):
-            result["disposition"] = "SWITCHED_OFF"
-        elif any(kw in lower_t for kw in ["not reachable", "out of network", "network area", "kshetra se bahar"]):
-            result["disposition"] = "OUT_OF_NETWORK"
-        elif any(kw in lower_t for kw in ["busy", "another call", "vyast", "waiting"]):
-            result["disposition"] = "BUSY"
-        elif any(kw in lower_t for kw in ["ringing", "bell", "ghanti"]):
-            if "pick" not in lower_t and "hello" in lower_t:
-                result["disposition"] = "RINGING"
-        elif family_answered and agent_asking_for_borrower:
-            result["disposition"] = "ANSWERED_BY_FAMILY_MEMBER"
-        elif disp not in call_labels:
-            if "FAMILY" in disp or "MEMBER" in disp: result["disposition"] = "ANSWERED_BY_FAMILY_MEMBER"
-            elif "BUSY" in disp: result["disposition"] = "BUSY"
-            elif "WRONG" in disp: result["disposition"] = "WRONG_NUMBER"
-            elif "ANSWER" in disp: result["disposition"] = "ANSWERED"
-            elif len(disp) > 2 and disp.replace("_", "").isalnum():
-                result["disposition"] = disp
-            else:
-                result["disposition"] = "OTHERS"
+        return clean_output(result, transcript, current_date)
+
+    def _prepare_transcript(self, transcript):
+        # Handle cases where transcript might be a dict (from raw test data)
+        if isinstance(transcript, dict):
+            transcript = transcript.get("transcript", str(transcript))
         else:
-            result["disposition"] = disp
-
-        p_disp = str(result.get("payment_disposition", "None")).upper().replace(" ", "_")
-        paid_keywords = ["paid", "kattesa", "kattida", "kattivi", "adachu", "jama", "pay kar diya", "bhar diya", "done"]
-        if any(kw in lower_t for kw in paid_keywords) and "will" not in lower_t:
-            result["payment_disposition"] = "PAID"
-        elif p_disp not in pay_labels:
-            if "CLAIM" in p_disp: result["payment_disposition"] = "PAID"
-            elif "PROMISE" in p_disp or "PTP" in p_disp: result["payment_disposition"] = "PTP"
-            elif "REFUSE" in p_disp or "DENY" in p_disp: result["payment_disposition"] = "DENIED_TO_PAY"
-            else: result["payment_disposition"] = "None"
-        elif p_disp == "WANTS_TO_RENEGOTIATE_LOAN_TERMS":
-            marathi_ptp_kws = ["pudhchya", "pudhcha", "deu shakto", "udya", "पुढच्या", "देऊ शकतो", "उद्या", "करतो", "karel"]
-            if any(kw in lower_t for kw in marathi_ptp_kws):
-                result["payment_disposition"] = "PTP"
-                result["reason_for_not_paying"] = "OTHER_REASONS"
+            transcript = str(transcript)
+
+        # Cheap character cap so pathological inputs are not tokenized in full.
+        # The exact fit to the context window happens in token space (see _suffix_ids).
+        if len(transcript) > MAX_TRANSCRIPT_CHARS:
+            if TRUNCATION_MODE == "head_tail":
+                head = int(MAX_TRANSCRIPT_CHARS * TRUNCATION_HEAD_FRACTION)
+                transcript = transcript[:head] + TRUNCATION_MARKER + transcript[len(transcript) - (MAX_TRANSCRIPT_CHARS - head):]
             else:
-                result["payment_disposition"] = p_disp
-        elif p_disp == "WILL_PAY_AFTER_VISIT" or any(kw in lower_t for kw in ["വീട്ടിലേക്ക്", "വീട്ടിൽ", "வீட்டிற்கு", "இல்லத்திற்கு", "మనెగె", "ఇంటికి", "ghar pe aao", "home visit", "collector"]):
-            # Safety Heuristic: Ensure visit keywords are present or mapped
-            visit_keywords = ["ghar", "home", "visit", "bhej", "collector", "pickup", "pick up", "address", "location", "dikkat", "call cut", "milne", "വീട്ടിലേക്ക്", "വീട്ടിൽ", "வீட்டிற்கு", "ఇంటికి", "ಮನೆಗೆ"]
-            lower_t = transcript.lower()
-            if any(kw in lower_t for kw in visit_keywords):
-                result["payment_disposition"] = "WILL_PAY_AFTER_VISIT"
+                transcript = transcript[:MAX_TRANSCRIPT_CHARS] + TRUNCATION_MARKER
+        return transcript
+
+    def estimate_tokens(self, transcript):
+        """Transcript length in tokens; the scheduler batches transcripts of similar length together."""
+        return len(self.tokenizer(self._prepare_transcript(transcript), add_special_tokens=False)["input_ids"])
+
+    def memory_profile(self):
+        """Approximate GPU cost of a batch, for memory-aware batch sizing (see batch_sizing.py)."""
+        cfg = self.model.config
+        heads = cfg.num_attention_heads
+        head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // heads
+        kv_heads = getattr(cfg, "num_key_value_heads", None) or heads
+        elem = 2  # fp16 activations and KV cache (only the weights are 4-bit)
+        return {
+            "device": self.device,
+            "kv_bytes_per_token": 2 * cfg.num_hidden_layers * kv_heads * head_dim * elem,
+            # One layer's hidden states, projections and MLP intermediates during prefill
+            "prefill_bytes_per_token": (4 * cfg.hidden_size + 3 * cfg.intermediate_size) * elem,
+            # Every row holds its own copy of the prefix cache and grows by the answer
+            "fixed_tokens": self._prefix_ids().shape[1] + MAX_NEW_TOKENS,
+            # Last-position logits in fp32, plus their masked copy
+            "row_bytes": cfg.vocab_size * 4 * 2,
+        }
+
+    def _parse_output(self, generated_text, transcript, current_date, row=None):
+        # `row` collects this row's json_extract / clean_output timings when given
+        row = row if row is not None else {}
+        try:
+            t0 = time.perf_counter()
+            json_start = generated_text.find('{')
+            json_end = generated_text.rfind('}') + 1
+            if json_start != -1 and json_end != -1:
+                result = json.loads(generated_text[json_start:json_end])
             else:
-                # If it's a commitment with date/amount but no visit keyword, it's likely a PTP
-                # We check for presence of amt/date in the raw result before cleanup
-                ptp_candidate = result.get("ptp_details", {})
-                if (ptp_candidate.get("amount") or ptp_candidate.get("date")) and "pay" in lower_t:
-                    result["payment_disposition"] = "PTP"
-                else:
-                    # If no commitment details, it might just be the model hallucinating the label
-                    result["payment_disposition"] = "PTP" # Safer default if it predicted a payment intent
-        else:
-            result["payment_disposition"] = p_disp
-
-        # 2. Reason Mapping (Fuzzy)
-        reason = str(result.get("reason_for_not_paying", "None")).upper().replace(" ", "_")
-        medical_keywords = ["medical", "hospital", "doctor", "health", "bimari", "ilaj", "accident", "emergency", "operation", "treat", "ആശുപത്രി", "അസുഖം", "மருத்துவம்", "వైద్యం", "ಆಸ್ಪತ್ರೆ"]
-        job_keywords = ["work", "job", "வேலை", "ఉద్యోగం", "ಕೆಲಸ", "ജോലി", "unemployed", "nauki", "kaam", "business"]
-        
-        if any(kw in lower_t for kw in job_keywords) and ("loss" in lower_t or "poyi" in lower_t or "vela" in lower_t or "hogide" in lower_t or "poyindi" in lower_t or "nahi" in lower_t):
-             result["reason_for_not_paying"] = "JOB_CHANGED_WAITING_FOR_SALARY"
-        elif "JOB" in reason: 
-            result["reason_for_not_paying"] = "JOB_CHANGED_WAITING_FOR_SALARY"
-        elif "MEDICAL" in reason or any(kw in lower_t for kw in medical_keywords):
-            result["reason_for_not_paying"] = "MEDICAL_ISSUE"
-
-        # 3. PTP Details Rescue & Validation
-        ptp = result.get("ptp_details", {})
-        if not isinstance(ptp, dict): ptp = {"amount": None, "date": None}
-        
-        # Amount Validation (Intelligent Match)
-        amt = ptp.get("amount")
-        if amt:
-            try:
-                # Clean amount for comparison (5,000 -> 5000)
-                clean_amt = str(int(float(str(amt).replace(',', ''))))
-                found = False
-                # Check for direct or fuzzy digits in transcript
-                if clean_amt in transcript.replace(',', ''):
-                    found = True
-                
-                if not found: ptp["amount"] = None # Still verify it's supported by text
-                else: ptp["amount"] = clean_amt
-            except: ptp["amount"] = None
-
-        # 4. Date Validation & "Parso" Correction
-        p_date = ptp.get("date")
-        if p_date and current_date:
-            try:
-                import calendar
-                import re
-                from datetime import datetime, timedelta, date as dt_date
-                c_y, c_m, c_d = map(int, current_date.split('-'))
-                dt_today = dt_date(c_y, c_m, c_d)
-                
-                # Intelligent "Parso" Recovery
-                l_trans = transcript.lower()
-                if "parso" in l_trans:
-                    # Force Today + 2
-                    ptp["date"] = str(dt_today + timedelta(days=2))
-                elif "kal" in l_trans and ptp.get("date") == current_date:
-                    # If model said Today but transcript said Kal, fix it to Today + 1
-                    ptp["date"] = str(dt_today + timedelta(days=1))
-
-                # Extract YYYY-MM-DD if there's a timestamp
-                raw_date = str(ptp["date"])
-                if "T" in raw_date:
-                    raw_date = raw_date.split("T")[0]
-                elif " " in raw_date:
-                    raw_date = raw_date.split(" ")[0]
-                
-                # Check if it matches YYYY-MM-DD
-                match = re.search(r'\d{4}-\d{2}-\d{2}', raw_date)
-                if match:
-                    raw_date = match.group(0)
-                    ptp["date"] = raw_date
-                else:
-                    ptp["date"] = None
-
-                if ptp["date"]:
-                    # Structural cleanup (Feb 30 fix)
-                    try:
-                        datetime.strptime(str(ptp["date"]), "%Y-%m-%d")
-                    except ValueError:
-                        # If invalid date (e.g. Feb 30), Cap it at month end
-                        parts = str(ptp["date"]).split('-')
-                        if len(parts) == 3:
-                            y, m, d = int(parts[0]), int(parts[1]), int(parts[2])
-                            # Get max days in that month/year
-                            _, max_days = calendar.monthrange(y, m)
-                            if d > max_days: 
-                                ptp["date"] = f"{y:04d}-{m:02d}-{max_days:02d}"
-            except:
-                ptp["date"] = None
-                
-        # Clean up PTP details if it is not a PTP commitment
-        if result.get("payment_disposition") not in ["PTP", "PARTIAL_PAYMENT", "SETTLEMENT"]:
-            ptp["amount"] = None
-            ptp["date"] = None
-
-        # 5. Balanced PTP Enforcement (Negative Rules)
-        # Rule: Only downgrade if BOTH vague AND lacks specific commitment details
-        if result.get("payment_disposition") == "PTP":
-            lower_t = transcript.lower()
-            commitment_words = ["pay", "paid", "amount", "rupaye", "kal", "aaj", "parso", "tarikh", "send", "karunga", "dena"]
-            # Be very careful with "vague" words - in Hinglish, "koshish" is often polite commitment
-            # Only downgrade if it's truly non-committal
-            is_non_committal = "sochunga" in lower_t or "dekhunga" in lower_t
-            has_strong_keyword = any(w in lower_t for w in commitment_words)
-
-            if is_non_committal and not has_strong_keyword:
-                # Only downgrade if NO date/amount were found as well
-                if ptp.get("date") is None and ptp.get("amount") is None:
-                    result["payment_disposition"] = "NO_PAYMENT_COMMITMENT"
-                    result["remarks"] = result.get("remarks", "") + " (Policy Downgrade: Non-committal)"
-            
-        result["ptp_details"] = ptp
-        # Ensure confidence_score is never null in a successful response
+                raise ValueError("No JSON found")
+            t1 = time.perf_counter()
+            row["json_extract"] = t1 - t0
+
+            result = self.clean_output(result, transcript, current_date)
+            row["clean_output"] = time.perf_counter() - t1
+            return result
+        except Exception as e:
+            return {"error": str(e), "raw": generated_text}
+
+    def _prefix_ids(self):
+        prefix = self.format_prefix()
+        if self.prefix_cache is not None:
+            return self.prefix_cache.get(prefix)[0]
+        return self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.device)
+
+    def _suffix_ids(self, transcripts, dates, budget, timer):
+        """Tokenize each request suffix once and fit its transcript into `budget` tokens.
+
+        Suffixes that fit are used exactly as tokenized. Longer ones keep the Context line
+        and the "### Response:" marker intact and cut the transcript in token space: the
+        head only, or head + tail (TRUNCATION_MODE=head_tail, where PTP commitments
+        usually are), with a truncation marker at the cut.
+        """
+        suffixes, spans = [], []
+        with timer.stage("prompt_build"):
+            for t, d in zip(transcripts, dates):
+                before, after = self.format_input("\x00", current_date=d).split("\x00")
+                suffixes.append(before + t + after)
+                spans.append((len(before), len(before) + len(t), after))
+        # Tokenization and truncation; _build_inputs adds the tensor assembly
+        t0 = time.perf_counter()
+        enc = self.tokenizer(suffixes, add_special_tokens=False, return_offsets_mapping=True)
+
+        rows = []
+        for ids, offsets, (start, end, after) in zip(enc["input_ids"], enc["offset_mapping"], spans):
+            if len(ids) <= budget:
+                rows.append(ids)
+                continue
+            TRUNCATED_TRANSCRIPTS.inc()
+            head = [tid for tid, (s, e) in zip(ids, offsets) if e <= start]
+            body = [tid for tid, (s, e) in zip(ids, offsets) if e > start and s < end]
+            tail = self.tokenizer(after, add_special_tokens=False)["input_ids"]
+            keep = max(0, budget - len(head) - len(tail) - len(self.marker_ids))
+            if TRUNCATION_MODE == "head_tail":
+                n_head = int(keep * TRUNCATION_HEAD_FRACTION)
+                body = body[:n_head] + self.marker_ids + body[len(body) - (keep - n_head):]
+            else:
+                body = body[:keep] + self.marker_ids
+            rows.append(head + body + tail)
+        timer.add("tokenize", time.perf_counter() - t0)
+        return rows
+
+    def _build_inputs(self, transcripts, dates, timer):
+        """Prefix ids + left-padded per-request suffixes, plus a batch-sized copy of the prefix cache.
+
+        Padding sits between the prefix and each suffix; the attention mask hides it and
+        position ids are derived from the mask, so rows stay aligned with the cached prefix.
+        """
+        prefix_ids = self._prefix_ids()
+        prefix_len = prefix_ids.shape[1]
+        # Leave room for the answer so prompt + generation never exceeds MAX_SEQ_LEN
+        rows = self._suffix_ids(transcripts, dates, MAX_SEQ_LEN - MAX_NEW_TOKENS - prefix_len, timer)
+        timer.rows = [{"prompt_tokens": prefix_len + len(r)} for r in rows]
+        t0 = time.perf_counter()
+        batch_size, width = len(rows), max(len(r) for r in rows)
+        suffix_ids = torch.full((batch_size, width), self.tokenizer.pad_token_id, dtype=torch.long)
+        suffix_mask = torch.zeros((batch_size, width), dtype=torch.long)
+        for row, ids in enumerate(rows):
+            suffix_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            suffix_mask[row, width - len(ids):] = 1
+        inputs = {
+            "input_ids": torch.cat([prefix_ids.expand(batch_size, -1), suffix_ids.to(self.device)], dim=1),
+            "attention_mask": torch.cat([
+                torch.ones((batch_size, prefix_len), dtype=torch.long, device=self.device),
+                suffix_mask.to(self.device),
+            ], dim=1),
+        }
+        past_key_values = self.prefix_cache.expand(batch_size) if self.prefix_cache is not None else None
+        timer.add("tokenize", time.perf_counter() - t0)
+        return inputs, past_key_values
+
+    def _generate(self, transcripts, dates, timer, streamer=None):
+        """Left-padded generate() over prepared transcripts; returns the decoded completions.
+
+        Fills `timer` with tokenize / prefill / decode / detokenize times and per-row token counts.
+        """
+        inputs, past_key_values = self._build_inputs(transcripts, dates, timer)
+        if self.schema_decoder is not None:
+            return self._generate_schema(inputs, past_key_values, timer, streamer)
+        first_token = FirstTokenTimer()
+        # generate() only supports prompt lookup for a single row (and does not report acceptance)
+        speculative = {}
+        if PROMPT_LOOKUP_TOKENS and len(transcripts) == 1:
+            speculative["prompt_lookup_num_tokens"] = PROMPT_LOOKUP_TOKENS
+        started = time.perf_counter()
+        outputs = self.model.generate(
+            **inputs,
+            past_key_values=past_key_values,
+            max_new_tokens=MAX_NEW_TOKENS,
+            use_cache=True,
+            do_sample=False,
+            stopping_criteria=StoppingCriteriaList([self.stop_on_json.for_generation(), first_token]),
+            streamer=streamer,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **speculative,
+        )
+        finished = time.perf_counter()
+        prefill_end = first_token.at or finished
+        timer.stages["prefill"] = prefill_end - started
+        timer.stages["decode"] = finished - prefill_end
+
+        prompt_len = inputs["input_ids"].shape[-1]
+        new_tokens = outputs[:, prompt_len:]
+        generated_counts = (new_tokens != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        for row, n in zip(timer.rows, generated_counts):
+            row["generated_tokens"] = n
+            PROMPT_TOKENS.observe(row["prompt_tokens"])
+            GENERATED_TOKENS.observe(n)
+        if timer.stages["decode"] > 0:
+            DECODE_TOKENS_PER_SECOND.observe(sum(generated_counts) / timer.stages["decode"])
+        with timer.stage("detokenize"):
+            return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def _generate_schema(self, inputs, past_key_values, timer, streamer=None):
+        """Schema-constrained counterpart of the generate() call in `_generate`."""
+        outputs, rows = self.schema_decoder.generate(
+            self.model, inputs["input_ids"], inputs["attention_mask"], past_key_values,
+            self.tokenizer.pad_token_id, timer, streamer=streamer,
+            lookup_tokens=PROMPT_LOOKUP_TOKENS, lookup_ngram=PROMPT_LOOKUP_MAX_NGRAM,
+        )
+        for row, tokens, decoded in zip(timer.rows, outputs, rows):
+            row["generated_tokens"] = len(tokens)
+            row["forced_tokens"] = len(tokens) - decoded.sampled
+            PROMPT_TOKENS.observe(row["prompt_tokens"])
+            GENERATED_TOKENS.observe(len(tokens))
+            SCHEMA_FORCED_TOKENS.inc(row["forced_tokens"])
+            if PROMPT_LOOKUP_TOKENS:
+                row["draft_tokens"] = decoded.drafted
+                row["accepted_tokens"] = decoded.accepted
+                SPEC_DRAFT_TOKENS.inc(decoded.drafted)
+                SPEC_ACCEPTED_TOKENS.inc(decoded.accepted)
+        if timer.stages["decode"] > 0:
+            DECODE_TOKENS_PER_SECOND.observe(sum(len(t) for t in outputs) / timer.stages["decode"])
+        with timer.stage("detokenize"):
+            return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def _prepare_items(self, items):
+        transcripts, dates = [], []
+        for transcript, current_date in items:
+            if current_date is None: current_date = str(date.today())
+            transcripts.append(self._prepare_transcript(transcript))
+            dates.append(current_date)
+        return transcripts, dates
+
+    @torch.inference_mode()
+    def predict_batch(self, items, timings=None):
+        """Run one left-padded generate() over a list of (transcript, current_date) pairs.
+
+        If `timings` is a dict it receives the batch's stage breakdown (`StageTimer.as_dict()`).
+        """
+        timer = StageTimer()
+        with timer.stage("lock_wait"):
+            self.lock.acquire()
         try:
-            val = float(result.get("confidence_score", 0.85))
-            result["confidence_score"] = min(max(val, 0.0), 1.0)
-        except:
-            result["confidence_score"] = 0.85
-            
-        return result
+            with maybe_profile(f"batch{len(items)}"):
+                with timer.stage("prompt_build"):
+                    transcripts, dates = self._prepare_items(items)
+                generated = self._generate(transcripts, dates, timer)
+                results = [
+                    self._parse_output(g, t, d, row)
+                    for g, t, d, row in zip(generated, transcripts, dates, timer.rows)
+                ]
+        finally:
+            self.lock.release()
+        if timings is not None:
+            timings.update(timer.as_dict())
+        return results
 
     @torch.inference_mode()
-    def predict(self, transcript, current_date=None):
-        with self.lock:
-            if current_date is None: current_date = str(date.today())
-            
-            # Handle cases where transcript might be a dict (from raw test data)
-            if isinstance(transcript, dict):
-                transcript = transcript.get("transcript", str(transcript))
-            else:
-                transcript = str(transcript)
-
-            # Hard Truncation to prevent CUDA Illegal Memory Access
-            # 8192 is the absolute max. We truncate transcript to ~7500 tokens.
-            # Character count is a safe proxy (1 token ~ 3 chars). 22,000 chars is safe.
-            if len(transcript) > 22000:
-                transcript = transcript[:22000] + "... [TRUNCATED]"
-
-            prompt = self.format_prompt(transcript, current_date=current_date)
-            inputs = self.tokenizer([prompt], return_tensors="pt").to(self.device)
-            
-            # Additional safety: hard truncate input_ids if they still exceed context
-            if inputs["input_ids"].shape[1] > MAX_SEQ_LEN:
-                 inputs["input_ids"] = inputs["input_ids"][:, :MAX_SEQ_LEN]
-                 inputs["attention_mask"] = inputs["attention_mask"][:, :MAX_SEQ_LEN]
-
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=512,
-                use_cache=True,
-                do_sample=False,
-                stopping_criteria=self.stop_criteria,
-                eos_token_id=self.tokenizer.eos_token_id,
-                pad_token_id=self.tokenizer.eos_token_id,
-            )
-            
-            generated_ids = outputs[0][inputs["input_ids"].shape[-1]:]
-            generated_text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+    def predict_stream(self, transcript, current_date, on_partial, timings=None):
+        """Single-request generate() that reports each JSON field to `on_partial` as soon as it closes.
 
-            try:
-                json_start = generated_text.find('{')
-                json_end = generated_text.rfind('}') + 1
-                if json_start != -1 and json_end != -1:
-                    result = json.loads(generated_text[json_start:json_end])
-                else:
-                    raise ValueError("No JSON found")
-                
-                return self.clean_output(result, transcript, current_date)
-            except Exception as e:
-                return {"error": str(e), "raw": generated_text}
+        Partial values are the raw model output; the returned dict is the usual
+        `clean_output`-normalized result.
+        """
+        timer = StageTimer()
+        with timer.stage("lock_wait"):
+            self.lock.acquire()
+        try:
+            with maybe_profile("stream"):
+                with timer.stage("prompt_build"):
+                    transcripts, dates = self._prepare_items([(transcript, current_date)])
+                streamer = JsonFieldStreamer(self.tokenizer, on_partial)
+                generated = self._generate(transcripts, dates, timer, streamer=streamer)
+                result = self._parse_output(generated[0], transcripts[0], dates[0], timer.rows[0])
+        finally:
+            self.lock.release()
+        if timings is not None:
+            timings.update(timer.as_dict())
+        return result
+
+    def predict(self, transcript, current_date=None):
+        return self.predict_batch([(transcript, current_date)])[0]
 
 _model_instance = None
 def get_model():
@@ -0,0 +1,354 @@
+import itertools
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from queue import Empty, Queue
+
+from bulk import (
+    find_transcript_column, iter_rows, prediction_row, transcript_text,
+    csv_header, csv_line, jsonl_line,
+)
+
+# =========================
+# CONFIG
+# =========================
+# Stored job inputs and the progress database; kept outside the source tree and any temp
+# directory, since unfinished jobs resume from it after a restart
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(
+    os.getenv("XDG_DATA_HOME", os.path.expanduser("~/.local/share")), "disposition_api", "jobs",
+))
+# Rows submitted to the scheduler and not yet checkpointed, per job
+JOB_MAX_IN_FLIGHT = int(os.getenv("JOB_MAX_IN_FLIGHT", "64"))
+# Checkpoint completed rows to SQLite every N rows (and at the end of the job)
+JOB_CHECKPOINT_ROWS = int(os.getenv("JOB_CHECKPOINT_ROWS", "32"))
+# A running job belongs to the process holding its lease; the owner renews it every
+# third of this, and another API process takes the job over once it has expired
+JOB_LEASE_S = float(os.getenv("JOB_LEASE_S", "60"))
+# Times a row whose prediction raised is re-submitted before the job fails
+JOB_ROW_RETRIES = int(os.getenv("JOB_ROW_RETRIES", "2"))
+
+JOB_INPUT_KINDS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "json", ".xls": "excel", ".xlsx": "excel"}
+JOB_OUTPUT_FORMATS = ("csv", "jsonl")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    input_path TEXT,
+    kind TEXT,
+    output_format TEXT,
+    status TEXT,
+    total_rows INTEGER,
+    done_rows INTEGER DEFAULT 0,
+    error TEXT,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT,
+    row_idx INTEGER,
+    data TEXT,
+    PRIMARY KEY (job_id, row_idx)
+);
+"""
+
+
+class JobNotFound(KeyError):
+    pass
+
+
+class JobLost(RuntimeError):
+    """The job's lease expired and another process took it over."""
+
+
+def load_job_rows(path, kind):
+    """Yield dict rows of a stored job input (CSV / JSON Lines without loading the file)."""
+    if kind in ("csv", "jsonl"):
+        with open(path, "rb") as f:
+            yield from iter_rows(f, kind)
+        return
+    # JSON arrays and Excel sheets cannot be read incrementally
+    import pandas as pd
+    df = pd.read_excel(path) if kind == "excel" else pd.read_json(path)
+    yield from df.to_dict(orient="records")
+
+
+class JobManager:
+    """Runs bulk prediction jobs in the background with progress checkpointed to SQLite.
+
+    Completed rows are committed to `job_results` as they finish, so after a crash or a
+    service restart `resume()` re-queues unfinished jobs and only the missing rows run again.
+
+    Several API processes can share one `jobs_dir`: a job is only processed by the
+    process that claimed it (`owner`, renewed `lease_until`), and checkpoints are only
+    written while the claim holds. Jobs whose owner died are picked up by whichever
+    process is idle once the lease expires.
+    """
+    def __init__(self, submit, jobs_dir=JOBS_DIR, lease_s=JOB_LEASE_S, row_retries=JOB_ROW_RETRIES):
+        self.submit = submit
+        self.jobs_dir = jobs_dir
+        self.lease_s = max(1.0, float(lease_s))
+        self.row_retries = max(0, int(row_retries))
+        # Unique per JobManager, so a restarted process never inherits a stale claim
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(jobs_dir, "jobs.db"), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self._migrate()
+        self.db_lock = threading.Lock()
+        self.pending = Queue()
+        # Per-job throughput of the current process (rows, seconds) for ETA estimates
+        self.session_stats = {}
+        self._thread = threading.Thread(target=self._run, name="job-runner", daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._heartbeat, name="job-lease", daemon=True).start()
+
+    def _migrate(self):
+        # Databases created before jobs had owners
+        columns = {r["name"] for r in self.db.execute("PRAGMA table_info(jobs)")}
+        for name, decl in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if name not in columns:
+                try:
+                    self.db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+                except sqlite3.OperationalError:
+                    pass  # added by another process meanwhile
+        self.db.commit()
+
+    def _execute(self, sql, params=(), many=False):
+        with self.db_lock:
+            cur = self.db.executemany(sql, params) if many else self.db.execute(sql, params)
+            self.db.commit()
+            return cur.fetchall()
+
+    def create(self, filename, fileobj, output_format="csv"):
+        ext = os.path.splitext((filename or "").lower())[1]
+        kind = JOB_INPUT_KINDS.get(ext, "csv")
+        if output_format not in JOB_OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format for jobs: {output_format}")
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        input_path = os.path.join(job_dir, f"input{ext or '.csv'}")
+        with open(input_path, "wb") as out:
+            shutil.copyfileobj(fileobj, out)
+        self._execute(
+            "INSERT INTO jobs (id, filename, input_path, kind, output_format, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, filename, input_path, kind, output_format, "queued", time.time()),
+        )
+        self.pending.put(job_id)
+        return job_id
+
+    def resume(self):
+        """Re-queue unfinished jobs nobody holds a lease on (new, or their owner stopped)."""
+        rows = self._execute(
+            "SELECT id FROM jobs WHERE status IN ('queued', 'running') AND (owner IS NULL OR lease_until < ?) "
+            "ORDER BY created_at",
+            (time.time(),),
+        )
+        for row in rows:
+            print(f"Resuming job {row['id']}")
+            self.pending.put(row["id"])
+        return len(rows)
+
+    def _claim(self, job_id):
+        """Atomically take ownership of an unfinished job; False if another process holds it."""
+        now = time.time()
+        with self.db_lock:
+            cur = self.db.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, started_at = COALESCE(started_at, ?) "
+                "WHERE id = ? AND status IN ('queued', 'running') AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+                (self.owner, now + self.lease_s, now, job_id, self.owner, now),
+            )
+            self.db.commit()
+            return cur.rowcount == 1
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_s / 3)
+            try:
+                self._execute(
+                    "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running'",
+                    (time.time() + self.lease_s, self.owner),
+                )
+            except sqlite3.Error as e:
+                print(f"ERROR renewing job leases: {e}")
+
+    def _checkpoint(self, job_id, completed):
+        """Commit finished rows if this process still owns the job (else raise JobLost)."""
+        with self.db_lock:
+            try:
+                cur = self.db.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                    (time.time() + self.lease_s, job_id, self.owner),
+                )
+                if cur.rowcount != 1:
+                    raise JobLost(f"Job {job_id} was taken over by another process")
+                self.db.executemany("INSERT OR REPLACE INTO job_results (job_id, row_idx, data) VALUES (?, ?, ?)", completed)
+                # Counted, not incremented, so rows written twice are not counted twice
+                self.db.execute(
+                    "UPDATE jobs SET done_rows = (SELECT COUNT(*) FROM job_results WHERE job_id = ?) WHERE id = ?",
+                    (job_id, job_id),
+                )
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    def _finish(self, job_id, status, error=None):
+        """Record the job's outcome and release it (only while this process owns it)."""
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ?, owner = NULL, lease_until = NULL "
+            "WHERE id = ? AND owner = ?",
+            (status, error, time.time(), job_id, self.owner),
+        )
+
+    def _job(self, job_id):
+        rows = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            raise JobNotFound(job_id)
+        return dict(rows[0])
+
+    def status(self, job_id):
+        job = self._job(job_id)
+        total, done = job["total_rows"], job["done_rows"] or 0
+        rows, seconds = self.session_stats.get(job_id, (0, 0.0))
+        throughput = rows / seconds if seconds > 0 else None
+        eta = None
+        if job["status"] == "running" and throughput and total is not None:
+            eta = round((total - done) / throughput, 1)
+        return {
+            "job_id": job_id,
+            "filename": job["filename"],
+            "status": job["status"],
+            "output_format": job["output_format"],
+            "total_rows": total,
+            "done_rows": done,
+            "progress": round(done / total, 4) if total else None,
+            "rows_per_second": round(throughput, 3) if throughput else None,
+            "eta_seconds": eta,
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+        }
+
+    def iter_result(self, job_id):
+        """Yield the finished job's output file (csv / jsonl) in row order."""
+        job = self._job(job_id)
+        if job["output_format"] == "csv":
+            yield csv_header()
+        last = -1
+        while True:
+            # Page through results so a big job is never loaded at once
+            rows = self._execute(
+                "SELECT row_idx, data FROM job_results WHERE job_id = ? AND row_idx > ? ORDER BY row_idx LIMIT 1000",
+                (job_id, last),
+            )
+            if not rows:
+                return
+            for row in rows:
+                out = json.loads(row["data"])
+                yield csv_line(out) if job["output_format"] == "csv" else jsonl_line(out)
+            last = rows[-1]["row_idx"]
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self.pending.get(timeout=self.lease_s)
+            except Empty:
+                # Idle: look for jobs whose owner stopped renewing its lease
+                self.resume()
+                continue
+            try:
+                self._process(job_id)
+            except JobLost as e:
+                print(f"Stopped job {job_id}: {e}")
+            except Exception as e:
+                print(f"ERROR in job {job_id}: {e}")
+                self._finish(job_id, "failed", str(e))
+
+    def _process(self, job_id):
+        job = self._job(job_id)
+        if job["status"] not in ("queued", "running"):
+            return
+        if not self._claim(job_id):
+            print(f"Job {job_id} is being processed by another process")
+            return
+        # One counting pass, then the rows are streamed again: the upload is never held in memory
+        total = sum(1 for _ in load_job_rows(job["input_path"], job["kind"]))
+        rows = load_job_rows(job["input_path"], job["kind"])
+        first = next(rows, None)
+        if first is None:
+            raise ValueError("Uploaded file has no rows.")
+        transcript_col = find_transcript_column(first.keys())
+        if transcript_col is None:
+            raise ValueError("No transcript/text column found in uploaded file.")
+
+        done = {r["row_idx"] for r in self._execute("SELECT row_idx FROM job_results WHERE job_id = ?", (job_id,))}
+        self._execute(
+            "UPDATE jobs SET total_rows = ?, done_rows = ? WHERE id = ? AND owner = ?",
+            (total, len(done), job_id, self.owner),
+        )
+        session_start, session_rows = time.monotonic(), 0
+        window, completed = deque(), []
+
+        def checkpoint():
+            self._checkpoint(job_id, completed)
+            completed.clear()
+            self.session_stats[job_id] = (session_rows, time.monotonic() - session_start)
+
+        def complete(idx, pred, transcript):
+            nonlocal session_rows
+            completed.append((job_id, idx, json.dumps(prediction_row(pred, transcript), ensure_ascii=False)))
+            session_rows += 1
+            if len(completed) >= JOB_CHECKPOINT_ROWS:
+                checkpoint()
+
+        def drain_one():
+            idx, transcript, fut, attempt = window.popleft()
+            try:
+                pred = fut.result()
+            except Exception as e:
+                # A row that raised is never checkpointed as done: retry it, then fail the
+                # job with its error rather than shipping an error row as a result
+                if attempt >= self.row_retries:
+                    checkpoint()
+                    raise RuntimeError(f"Row {idx} failed after {attempt + 1} attempts: {e}") from e
+                print(f"Job {job_id} row {idx} failed ({e}); retrying")
+                window.append((idx, transcript, self.submit(transcript), attempt + 1))
+                return
+            complete(idx, pred, transcript)
+
+        try:
+            for idx, row in enumerate(itertools.chain([first], rows)):
+                # Rows finished before a restart are skipped, not re-read into memory
+                if idx in done:
+                    continue
+                transcript = transcript_text(row.get(transcript_col))
+                if not transcript:
+                    # Nothing to send to the model (an empty or NaN cell)
+                    complete(idx, ValueError("Transcript is empty"), transcript)
+                    continue
+                window.append((idx, transcript, self.submit(transcript), 0))
+                if len(window) >= JOB_MAX_IN_FLIGHT:
+                    drain_one()
+            while window:
+                drain_one()
+            checkpoint()
+        except BaseException:
+            # Lease lost or job failed: rows still queued would only run for nobody
+            for _, _, fut, _ in window:
+                fut.cancel()
+            raise
+        self._finish(job_id, "completed")
+        print(f"Job {job_id} completed ({total} rows)")
@@ -0,0 +1,91 @@
+# =========================
+# KEYWORD RULES
+# =========================
+# Every transcript keyword check used by postprocess.clean_output, by category.
+# All keywords are lowercase; they are matched against transcript.lower().
+KEYWORD_RULES = {
+    # Agent asked for the borrower by name
+    "agent_asking_for_borrower": ["se baat", "se baat ho", "bol raha hoon", "bol rahi hoon", "speaking"],
+    "family": ["beta", "beti", "pati", "patni", "bhai", "bhabhi", "devar", "son", "daughter",
+               "wife", "husband", "brother", "sister", "ghar pe nahi", "ghar par nahi",
+               "abhi nahi hain", "at home nahi", "not at home", "nahi hain", "ghar mein nahi"],
+    # System messages
+    "switched_off": ["switched off", "switch off", "out of reach", "band aa raha", "switch-off", "nahi lag raha"],
+    "out_of_network": ["not reachable", "out of network", "network area", "kshetra se bahar"],
+    "busy": ["busy", "another call", "vyast", "waiting"],
+    "ringing": ["ringing", "bell", "ghanti"],
+    "pick": ["pick"],
+    "hello": ["hello"],
+    # Payment
+    "paid": ["paid", "kattesa", "kattida", "kattivi", "adachu", "jama", "pay kar diya", "bhar diya", "done"],
+    "will": ["will"],
+    "pay": ["pay"],
+    "marathi_ptp": ["pudhchya", "pudhcha", "deu shakto", "udya", "पुढच्या", "देऊ शकतो", "उद्या", "करतो", "karel"],
+    "visit_trigger": ["വീട്ടിലേക്ക്", "വീട്ടിൽ", "வீட்டிற்கு", "இல்லத்திற்கு", "మనెగె", "ఇంటికి", "ghar pe aao", "home visit", "collector"],
+    "visit": ["ghar", "home", "visit", "bhej", "collector", "pickup", "pick up", "address", "location", "dikkat",
+              "call cut", "milne", "വീട്ടിലേക്ക്", "വീട്ടിൽ", "வீட்டிற்கு", "ఇంటికి", "ಮನೆಗೆ"],
+    # Reason for not paying
+    "medical": ["medical", "hospital", "doctor", "health", "bimari", "ilaj", "accident", "emergency", "operation",
+                "treat", "ആശുപത്രി", "അസുഖം", "மருத்துவம்", "వైద్యం", "ಆಸ್ಪತ್ರೆ"],
+    "job": ["work", "job", "வேலை", "ఉద్యోగం", "ಕೆಲಸ", "ജോലി", "unemployed", "nauki", "kaam", "business"],
+    "job_lost": ["loss", "poyi", "vela", "hogide", "poyindi", "nahi"],
+    # Dates
+    "parso": ["parso"],
+    "kal": ["kal"],
+    # PTP enforcement
+    "commitment": ["pay", "paid", "amount", "rupaye", "kal", "aaj", "parso", "tarikh", "send", "karunga", "dena"],
+    "non_committal": ["sochunga", "dekhunga"],
+}
+
+
+class KeywordMatcher:
+    """Compiled form of a keyword rule table.
+
+    Keywords are deduplicated across categories and linked by substring implication:
+    if "nahi" is absent, "ghar pe nahi" and "nahi hain" are too, and if "se baat ho" is
+    present, so is "se baat". `scan(text)` returns a `KeywordHits` view that searches each
+    distinct keyword at most once (with C-level `in`), and only when a category is asked for.
+    """
+    def __init__(self, rules):
+        self.rules = {cat: tuple(dict.fromkeys(kws)) for cat, kws in rules.items()}
+        keywords = list(dict.fromkeys(kw for kws in self.rules.values() for kw in kws))
+        self.substrings = {kw: tuple(k for k in keywords if k != kw and k in kw) for kw in keywords}
+        self.superstrings = {kw: tuple(k for k in keywords if k != kw and kw in k) for kw in keywords}
+
+    def scan(self, lower_text):
+        return KeywordHits(self, lower_text)
+
+
+class KeywordHits:
+    """Lazily evaluated keyword-category hits for one (lowercased) text."""
+    __slots__ = ("matcher", "text", "_keywords", "_categories")
+
+    def __init__(self, matcher, text):
+        self.matcher = matcher
+        self.text = text
+        self._keywords = {}
+        self._categories = {}
+
+    def _has_keyword(self, kw):
+        hit = self._keywords.get(kw)
+        if hit is None:
+            hit = kw in self.text
+            implied = self.matcher.substrings[kw] if hit else self.matcher.superstrings[kw]
+            for k in implied:
+                self._keywords[k] = hit
+            self._keywords[kw] = hit
+        return hit
+
+    def has(self, category):
+        hit = self._categories.get(category)
+        if hit is None:
+            hit = any(self._has_keyword(kw) for kw in self.matcher.rules[category])
+            self._categories[category] = hit
+        return hit
+
+    def categories(self):
+        """Every category with at least one keyword in the text."""
+        return {cat for cat in self.matcher.rules if self.has(cat)}
+
+
+TRANSCRIPT_KEYWORDS = KeywordMatcher(KEYWORD_RULES)
@@ -0,0 +1,112 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus metrics shared by the API server and the inference scheduler.
+# Kept in one module so every component registers against the same collectors.
+
+# Request level
+REQUEST_COUNT = Counter("disposition_requests_total", "Total number of /predict requests")
+REQUEST_ERRORS = Counter("disposition_request_errors_total", "Total number of failed /predict requests")
+INFERENCE_TIME = Histogram("disposition_inference_seconds", "Inference latency in seconds")
+MODEL_LOADED = Gauge("disposition_model_loaded", "Whether the model is loaded (1 = loaded)")
+MODEL_READY = Gauge("disposition_model_ready", "Whether the model is loaded and warmed up (1 = ready)")
+# Seconds spent per startup step: load_model, warmup, total, and the model's own
+# model_weights / stop_tables / schema_tables / prefix_cache steps (summed over replicas)
+STARTUP_PHASE_SECONDS = Gauge("disposition_startup_phase_seconds", "Duration of each startup phase", ["phase"])
+# Items per /ws protocol v2 frame: "in" = transcripts per request frame, "out" = results per response frame
+WS_FRAME_ITEMS = Histogram(
+    "disposition_ws_frame_items", "Items per /ws v2 frame", ["direction"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+# GPU
+GPU_AVAILABLE = Gauge("disposition_gpu_available", "Whether CUDA GPU is available (1/0)")
+# Per-GPU metrics will be labeled by index
+GPU_UTIL = Gauge("disposition_gpu_util_percent", "GPU utilization percent", ["gpu"])
+GPU_MEM_TOTAL = Gauge("disposition_gpu_mem_total_mb", "GPU memory total (MB)", ["gpu"])
+GPU_MEM_USED = Gauge("disposition_gpu_mem_used_mb", "GPU memory used (MB)", ["gpu"])
+
+# Batching scheduler
+# Labeled by model replica (one scheduler per replica, see model_pool.py)
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "disposition_scheduler_queue_depth", "Requests waiting in the batching queue", ["replica", "lane"],
+)
+BATCH_SIZE = Histogram(
+    "disposition_batch_size", "Requests per generate() batch", ["replica"],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+BATCH_TIME = Histogram("disposition_batch_seconds", "Wall time of one batched generate() call", ["replica"])
+QUEUE_WAIT = Histogram(
+    "disposition_queue_wait_seconds", "Time a request waited in the queue before reaching the model", ["replica"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+# Queue + inference time per priority lane (interactive / bulk)
+LANE_LATENCY = Histogram(
+    "disposition_lane_latency_seconds", "Time from enqueue to result per scheduler lane", ["lane"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128),
+)
+# Admission control: reason is queue_full or deadline
+REQUESTS_SHED = Counter("disposition_requests_shed_total", "Requests rejected or dropped before inference", ["reason"])
+# Real transcript tokens / (batch size x longest transcript) per batch (see BATCH_LENGTH_BUCKETS)
+PADDING_EFFICIENCY = Histogram(
+    "disposition_batch_padding_efficiency", "Share of a batch's padded transcript block that is real tokens", ["replica"],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0),
+)
+# Memory-aware batch sizing (see batch_sizing.py)
+BATCH_MEMORY_BUDGET = Gauge("disposition_batch_memory_budget_mb", "GPU memory the next batch may use", ["replica"])
+BATCH_MEMORY_LIMITED = Counter(
+    "disposition_batch_memory_limited_total", "Batches cut below BATCH_MAX_SIZE because the next row did not fit in memory",
+    ["replica"],
+)
+BATCH_OOM = Counter("disposition_batch_oom_total", "CUDA out-of-memory errors caught and retried as smaller batches", ["replica"])
+REPLICA_ROUTED = Counter("disposition_replica_requests_total", "Requests routed to each model replica", ["replica"])
+# Requests sent to CPU replicas (see CPU_ROUTING); reason is bulk, overflow or queue_full
+CPU_ROUTED = Counter("disposition_cpu_routed_total", "Requests routed to CPU replicas", ["reason"])
+
+# Model worker processes (INFERENCE_WORKERS=process, see model_worker.py)
+WORKER_UP = Gauge("disposition_model_worker_up", "Whether the API is connected to the model worker (1/0)", ["replica"])
+WORKER_RESTARTS = Counter("disposition_model_worker_restarts_total", "Model worker processes restarted after exiting", ["replica"])
+
+# Result cache
+CACHE_HITS = Counter("disposition_cache_hits_total", "Result cache hits", ["tier"])
+CACHE_MISSES = Counter("disposition_cache_misses_total", "Result cache misses")
+CACHE_SIZE = Gauge("disposition_cache_entries", "Entries in the in-memory result cache")
+
+# Rule-based fast path (see fast_path.py); short-circuit rate per rule = hits / checked
+FAST_PATH_CHECKED = Counter("disposition_fast_path_checked_total", "Transcripts checked against the fast path rules")
+FAST_PATH_HITS = Counter(
+    "disposition_fast_path_hits_total", "Transcripts answered by a fast path rule without the model", ["rule", "version"],
+)
+
+# Request dedup
+SINGLEFLIGHT_JOINED = Counter(
+    "disposition_singleflight_joined_total", "Requests that joined an identical in-flight generation",
+)
+
+# Prompt construction
+TRUNCATED_TRANSCRIPTS = Counter(
+    "disposition_truncated_transcripts_total", "Transcripts cut to fit the context window",
+)
+
+# Per-stage timings and token counts (see profiling.py)
+STAGE_TIME = Histogram(
+    "disposition_stage_seconds", "Time spent per inference stage (batch-level stages are observed once per batch)",
+    ["stage"], buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+PROMPT_TOKENS = Histogram(
+    "disposition_prompt_tokens", "Prompt tokens per request (prefix included)",
+    buckets=(256, 512, 1024, 1536, 2048, 3072, 4096, 6144, 8192),
+)
+GENERATED_TOKENS = Histogram(
+    "disposition_generated_tokens", "Generated tokens per request", buckets=(16, 32, 48, 64, 96, 128, 192, 256, 512),
+)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "disposition_decode_tokens_per_second", "Generated tokens per second of decode, per batch",
+    buckets=(10, 25, 50, 100, 200, 400, 800, 1600, 3200),
+)
+# Schema-constrained decoding (SCHEMA_DECODING=1): output tokens appended without a model step
+SCHEMA_FORCED_TOKENS = Counter(
+    "disposition_schema_forced_tokens_total", "Output tokens filled in from the response schema instead of decoded",
+)
+# Prompt-lookup speculative decoding (PROMPT_LOOKUP_TOKENS > 0); acceptance rate = accepted / draft
+SPEC_DRAFT_TOKENS = Counter("disposition_spec_draft_tokens_total", "Draft tokens proposed by prompt lookup")
+SPEC_ACCEPTED_TOKENS = Counter("disposition_spec_accepted_tokens_total", "Draft tokens that matched the greedy output")
@@ -0,0 +1,184 @@
+import itertools
+import os
+import threading
+
+from metrics import REPLICA_ROUTED, CPU_ROUTED
+from scheduler import BatchScheduler, INTERACTIVE, BULK, QueueFull
+
+# =========================
+# CONFIG
+# =========================
+# Comma-separated devices to load replicas on (default: every visible CUDA device)
+MODEL_DEVICES = os.getenv("MODEL_DEVICES", "")
+# Model replicas (each with its own scheduler) per device
+MODEL_REPLICAS_PER_DEVICE = int(os.getenv("MODEL_REPLICAS_PER_DEVICE", "1"))
+# CPU replicas (model_runtime.CpuRuntime) next to the GPU ones; on a host without CUDA,
+# the number of replicas (at least one)
+CPU_REPLICAS = int(os.getenv("CPU_REPLICAS", "0"))
+# Which requests the CPU replicas take: "bulk" (every /upload and job row), "overflow"
+# (any request while the GPU replicas are saturated), or both ("bulk,overflow")
+CPU_ROUTING = {r.strip() for r in os.getenv("CPU_ROUTING", "overflow").lower().split(",") if r.strip()}
+# A GPU replica with this many queued + running rows counts as saturated
+CPU_OVERFLOW_LOAD = int(os.getenv("CPU_OVERFLOW_LOAD", "32"))
+# Overflow stops once a CPU replica has this many rows; requests then queue on the GPU
+CPU_MAX_LOAD = int(os.getenv("CPU_MAX_LOAD", "8"))
+
+
+def visible_devices(default="cuda"):
+    """Devices from MODEL_DEVICES, else one entry per visible CUDA GPU."""
+    if MODEL_DEVICES.strip():
+        return [d.strip() for d in MODEL_DEVICES.split(",") if d.strip()]
+    if default != "cuda":
+        return [default]
+    import torch
+    count = torch.cuda.device_count()
+    return [f"cuda:{i}" for i in range(count)]
+
+
+def replica_devices(backend="gpu"):
+    """(devices, cpu_devices): replicas for all traffic, and CPU replicas for CPU_ROUTING.
+
+    `backend` is INFERENCE_BACKEND. With "cpu", or "gpu" on a host without CUDA, every
+    replica runs on the CPU runtime and takes all traffic.
+    """
+    cpu_devices = [f"cpu:{i}" for i in range(CPU_REPLICAS)]
+    if backend == "stub":
+        return visible_devices(default="cpu"), cpu_devices
+    devices = visible_devices() if backend != "cpu" else []
+    if not devices:
+        if backend != "cpu":
+            print("No CUDA device found; serving from the CPU runtime")
+        return [f"cpu:{i}" for i in range(max(1, CPU_REPLICAS))], []
+    return devices, cpu_devices
+
+
+class ModelPool:
+    """Routes each request to the replica with the fewest queued + running rows.
+
+    Every replica is a `BatchScheduler` over its own backend, so GPU replicas and CPU
+    stub workers are interchangeable. The pool exposes the scheduler interface
+    (`submit` / `predict` / `qsize` / `backend`), so callers do not know how many
+    replicas there are.
+
+    `cpu_replicas` are slower CPU replicas kept out of the normal rotation. Per
+    `routing` they take bulk-lane requests ("bulk") and/or spill-over ("overflow"):
+    requests that find every GPU replica at `overflow_load` rows or with a full queue,
+    while a CPU replica has fewer than `cpu_max_load`.
+    """
+    def __init__(self, schedulers, cpu_replicas=(), routing=CPU_ROUTING,
+                 overflow_load=CPU_OVERFLOW_LOAD, cpu_max_load=CPU_MAX_LOAD):
+        if not schedulers:
+            raise ValueError("ModelPool needs at least one replica")
+        self.replicas = list(schedulers)
+        self.cpu_replicas = list(cpu_replicas)
+        self.routing = set(routing)
+        self.overflow_load = overflow_load
+        self.cpu_max_load = cpu_max_load
+        self._rr = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_devices(cls, factory, devices, per_device=MODEL_REPLICAS_PER_DEVICE, cpu_devices=(), **scheduler_kwargs):
+        """Build `per_device` replicas on each device (one per CPU device) with `factory(device) -> backend`."""
+        schedulers = []
+        for device in devices:
+            for n in range(per_device):
+                name = f"{device}#{n}"
+                print(f"Loading replica {name}...")
+                schedulers.append(BatchScheduler(
+                    factory(device), name=name, memory_share=1.0 / per_device, **scheduler_kwargs,
+                ))
+        cpu = []
+        for device in cpu_devices:
+            print(f"Loading CPU replica {device}...")
+            cpu.append(BatchScheduler(factory(device), name=device, **scheduler_kwargs))
+        return cls(schedulers, cpu)
+
+    @property
+    def all_replicas(self):
+        return self.replicas + self.cpu_replicas
+
+    @property
+    def backend(self):
+        # The first replica (a GPU one when there are any) speaks for the pool; CPU
+        # replicas tag their futures with their own backend (see `_route`)
+        return self.replicas[0].backend
+
+    def start(self):
+        for r in self.all_replicas:
+            r.start()
+        return self
+
+    def stop(self, timeout=None):
+        for r in self.all_replicas:
+            r.stop(timeout)
+
+    def load_timings(self):
+        """Seconds per loading step, summed over replicas (they load one after another)."""
+        totals = {}
+        for r in self.all_replicas:
+            for step, seconds in getattr(r.backend, "load_timings", {}).items():
+                totals[step] = totals.get(step, 0.0) + seconds
+        return totals
+
+    def warmup(self, transcript, rounds=1, batch_size=1):
+        """Run throwaway batches on every replica so the first real request is not the slow one.
+
+        Goes straight to the replicas (not through the result cache) and uses both a
+        single-row and a full batch, which compiles/caches the CUDA kernels and
+        allocator blocks for both shapes and touches the prefix KV cache.
+        """
+        for _ in range(rounds):
+            for size in sorted({1, max(1, batch_size)}):
+                # CPU replicas only warm up on single rows; a full batch there takes minutes
+                replicas = self.all_replicas if size == 1 else self.replicas
+                futures = [r.submit(transcript) for r in replicas for _ in range(size)]
+                for f in futures:
+                    f.result()
+
+    def qsize(self):
+        return sum(r.qsize() for r in self.all_replicas)
+
+    def pick(self, replicas=None):
+        """Least-loaded replica; ties rotate so idle replicas share the traffic."""
+        replicas = replicas or self.replicas
+        with self._lock:
+            start = next(self._rr) % len(replicas)
+            order = replicas[start:] + replicas[:start]
+            return min(order, key=lambda r: r.load())
+
+    def _overflow(self):
+        """A CPU replica with room for spill-over, or None."""
+        if "overflow" not in self.routing or not self.cpu_replicas:
+            return None
+        replica = self.pick(self.cpu_replicas)
+        return replica if replica.load() < self.cpu_max_load else None
+
+    def _route(self, replica, reason, transcript, current_date, on_partial, deadline, lane):
+        REPLICA_ROUTED.labels(replica=replica.name).inc()
+        if reason is not None:
+            CPU_ROUTED.labels(reason=reason).inc()
+        fut = replica.submit(transcript, current_date, on_partial=on_partial, deadline=deadline, lane=lane)
+        # Which backend answered, so the service does not cache a CPU replica's answer as the GPU model's
+        fut.backend = replica.backend
+        return fut
+
+    def submit(self, transcript, current_date=None, on_partial=None, deadline=None, lane=INTERACTIVE):
+        args = (transcript, current_date, on_partial, deadline, lane)
+        if lane == BULK and "bulk" in self.routing and self.cpu_replicas:
+            return self._route(self.pick(self.cpu_replicas), "bulk", *args)
+        replica = self.pick()
+        if replica.load() >= self.overflow_load:
+            cpu = self._overflow()
+            if cpu is not None:
+                return self._route(cpu, "overflow", *args)
+        try:
+            return self._route(replica, None, *args)
+        except QueueFull:
+            cpu = self._overflow()
+            if cpu is None:
+                raise
+            return self._route(cpu, "queue_full", *args)
+
+    def predict(self, transcript, current_date=None, timeout=None):
+        return self.submit(transcript, current_date).result(timeout=timeout)
@@ -0,0 +1,119 @@
+import os
+import threading
+
+import torch
+
+# =========================
+# CONFIG
+# =========================
+# Weights for CPU replicas (empty = same as the GPU model). Pre-quantized 4-bit
+# (bitsandbytes) checkpoints only load on CUDA; point this at the merged fp16/fp32 model.
+CPU_MODEL_PATH = os.getenv("CPU_MODEL_PATH", "")
+# "int8": dynamic int8 quantization of the Linear layers (weights int8, activations
+# quantized per batch); "none" keeps fp32
+CPU_QUANTIZATION = os.getenv("CPU_QUANTIZATION", "int8").lower()
+# torch threads per CPU replica (0 = available cores / CPU replicas)
+CPU_THREADS = int(os.getenv("CPU_THREADS", "0"))
+# Same setting model_pool sizes the CPU replicas from; read here so the runtime does
+# not import the pool
+CPU_REPLICAS = int(os.getenv("CPU_REPLICAS", "0"))
+# Pin each CPU replica to its own block of CPU_THREADS cores (model worker processes only)
+CPU_PIN_THREADS = os.getenv("CPU_PIN_THREADS", "1") == "1"
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_slot(device):
+    """Index of a CPU replica from its device string ("cpu" / "cpu:2")."""
+    _, _, slot = str(device).partition(":")
+    return int(slot) if slot else 0
+
+
+class CudaRuntime:
+    """Unsloth 4-bit model pinned to one GPU (the production path)."""
+    name = "cuda"
+
+    def __init__(self, device="cuda"):
+        self.device = device
+        self.model_path = None
+
+    def load(self, model_path, max_seq_len, dtype=None, load_in_4bit=True):
+        """(model, tokenizer) ready for inference on `self.device`."""
+        if not torch.cuda.is_available():
+            raise RuntimeError("CUDA is not available. Use a cpu device (MODEL_DEVICES=cpu) for the CPU runtime.")
+        from unsloth import FastLanguageModel
+        self.model_path = model_path
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=model_path,
+            max_seq_length=max_seq_len,
+            dtype=dtype,
+            load_in_4bit=load_in_4bit,
+            # Pin the whole model to one GPU so replicas on other devices stay independent
+            device_map={"": self.device},
+        )
+        FastLanguageModel.for_inference(model)
+        return model, tokenizer
+
+
+class CpuRuntime:
+    """Plain transformers model on the CPU, with int8 dynamic quantization and thread pinning.
+
+    Generation, schema decoding and the prefix KV cache are device-agnostic torch code,
+    so `DispositionModel` runs unchanged on top of it. `device` may carry a replica slot
+    ("cpu:1"); the slot picks the block of cores the replica is pinned to.
+    """
+    name = "cpu"
+
+    def __init__(self, device="cpu"):
+        self.slot = cpu_slot(device)
+        self.device = "cpu"
+        self.model_path = None
+
+    def pin_threads(self):
+        cores = available_cores()
+        threads = CPU_THREADS or max(1, len(cores) // max(1, CPU_REPLICAS))
+        # torch's thread count is per process: next to GPU replicas in the same process
+        # (INFERENCE_WORKERS=thread) it would also throttle theirs, so it is only set in a
+        # model worker process or when this process has not initialized CUDA
+        if threading.current_thread() is not threading.main_thread() and torch.cuda.is_initialized():
+            print(f"CPU replica {self.slot}: sharing {torch.get_num_threads()} threads with the GPU replicas")
+            return
+        torch.set_num_threads(threads)
+        # CPU_REPLICAS counts every CPU replica (overflow ones, or all of them on a host
+        # without CUDA). Affinity is per thread and inherited by the threads created later,
+        # so it is only set from a worker process's main thread; in-process replicas share
+        # the API's cores.
+        if not CPU_PIN_THREADS or not hasattr(os, "sched_setaffinity") \
+                or threading.current_thread() is not threading.main_thread():
+            print(f"CPU replica {self.slot}: {threads} threads")
+            return
+        block = cores[self.slot * threads:(self.slot + 1) * threads]
+        if len(block) < threads:
+            print(f"CPU replica {self.slot}: {threads} threads, not pinned ({len(cores)} cores available)")
+            return
+        os.sched_setaffinity(0, block)
+        print(f"CPU replica {self.slot}: {threads} threads pinned to cores {block[0]}-{block[-1]}")
+
+    def load(self, model_path, max_seq_len, dtype=None, load_in_4bit=True):
+        """(model, tokenizer) on the CPU; `dtype` and `load_in_4bit` are GPU options and ignored."""
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        self.pin_threads()
+        path = self.model_path = CPU_MODEL_PATH or model_path
+        tokenizer = AutoTokenizer.from_pretrained(path)
+        tokenizer.model_max_length = max_seq_len
+        model = AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+        model.eval()
+        if CPU_QUANTIZATION == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif CPU_QUANTIZATION != "none":
+            raise ValueError(f"Unknown CPU_QUANTIZATION: {CPU_QUANTIZATION}")
+        return model, tokenizer
+
+
+def runtime_for(device):
+    """The runtime that loads a replica on `device`."""
+    return CpuRuntime(device) if str(device).startswith("cpu") else CudaRuntime(device)
@@ -0,0 +1,466 @@
+import argparse
+import itertools
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from datetime import date
+from multiprocessing.connection import Client, Listener
+
+from metrics import WORKER_UP, WORKER_RESTARTS
+from scheduler import QueueFull, DeadlineExceeded, INTERACTIVE
+
+# =========================
+# CONFIG
+# =========================
+# "thread" runs the model inside the API process; "process" moves every replica into
+# its own supervised worker process
+INFERENCE_WORKERS = os.getenv("INFERENCE_WORKERS", "thread").lower()
+# Comma-separated host:port (or unix socket path) of already running model workers.
+# When set the API connects to them instead of spawning its own, so several uvicorn
+# workers can share the same GPUs.
+MODEL_WORKER_ADDRESSES = os.getenv("MODEL_WORKER_ADDRESSES", "")
+# Same for already running CPU-runtime workers, which join the pool as CPU replicas
+MODEL_WORKER_CPU_ADDRESSES = os.getenv("MODEL_WORKER_CPU_ADDRESSES", "")
+# Spawned workers listen on consecutive ports from here
+MODEL_WORKER_BASE_PORT = int(os.getenv("MODEL_WORKER_BASE_PORT", "9100"))
+# Optional Prometheus port per spawned worker (consecutive from here, 0 = off)
+MODEL_WORKER_METRICS_BASE_PORT = int(os.getenv("MODEL_WORKER_METRICS_BASE_PORT", "0"))
+# Shared secret for connections to the workers (messages are pickled, so whoever has it
+# can run code in the worker). Required for MODEL_WORKER_ADDRESSES and for workers started
+# by hand; spawned workers get a random one each.
+MODEL_WORKER_AUTHKEY = os.getenv("MODEL_WORKER_AUTHKEY", "")
+# How long to wait for a worker to come up (model load included) before failing requests
+MODEL_WORKER_CONNECT_TIMEOUT_S = float(os.getenv("MODEL_WORKER_CONNECT_TIMEOUT_S", "900"))
+# Times a request is re-sent after its worker died mid-generation
+MODEL_WORKER_RETRIES = int(os.getenv("MODEL_WORKER_RETRIES", "1"))
+MODEL_WORKER_RESTART_DELAY_S = float(os.getenv("MODEL_WORKER_RESTART_DELAY_S", "2"))
+
+# Exit code of a worker that hit an unrecoverable CUDA error (the supervisor restarts it)
+FATAL_EXIT_CODE = 3
+
+# Refuse to start rather than talk to external workers without a secret
+if (MODEL_WORKER_ADDRESSES.strip() or MODEL_WORKER_CPU_ADDRESSES.strip()) and not MODEL_WORKER_AUTHKEY:
+    raise RuntimeError("MODEL_WORKER_AUTHKEY must be set when MODEL_WORKER_ADDRESSES / MODEL_WORKER_CPU_ADDRESSES are used")
+
+
+def parse_address(address):
+    """"host:port" -> (host, port); anything else is a unix socket path."""
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}" if isinstance(address, tuple) else address
+
+
+def is_fatal(exc):
+    # After an illegal memory access the CUDA context is unusable until the process exits
+    msg = str(exc)
+    return "CUDA error" in msg or "illegal memory access" in msg
+
+
+def load_backend(kind, device):
+    if kind == "stub":
+        from stub_model import StubDispositionModel
+        return StubDispositionModel()
+    from inference import DispositionModel
+    if kind == "cpu" and not device.startswith("cpu"):
+        device = "cpu"
+    return DispositionModel(device=device)
+
+
+# =========================
+# Worker side
+# =========================
+class WorkerServer:
+    """Serves one model replica to any number of API processes over a local socket.
+
+    Every connection feeds the same `BatchScheduler`, so requests from several
+    front-end processes are batched together. Messages are pickled tuples:
+
+        client -> worker   ("hello",) | ("cancel", rid)
+                           ("submit", rid, transcript, current_date, stream, deadline_in_s, lane)
+        worker -> client   ("info", info) | ("partial", rid, fields) | ("result", rid, (dict, timings)) | ("error", rid, exception)
+    """
+    def __init__(self, scheduler, address, authkey):
+        self.scheduler = scheduler
+        self.address = address
+        self.authkey = authkey
+        backend = scheduler.backend
+        self.info = {
+            "name": scheduler.name,
+            "model_id": getattr(backend, "model_id", type(backend).__name__),
+            "prompt_version": getattr(backend, "prompt_version", None),
+            "device": getattr(backend, "device", None),
+            "load_timings": getattr(backend, "load_timings", {}),
+        }
+
+    def serve_forever(self):
+        # Only listen once the model is loaded: a successful connect means "ready"
+        listener = Listener(self.address, authkey=self.authkey)
+        print(f"Model worker {self.info['name']} listening on {format_address(self.address)}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Rejected model worker connection: {e}")
+                continue
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        send_lock = threading.Lock()
+        futures = {}
+
+        def send(msg):
+            with send_lock:
+                try:
+                    conn.send(msg)
+                except (OSError, EOFError):
+                    pass  # client went away; its futures are cancelled below
+
+        try:
+            while True:
+                msg = conn.recv()
+                if msg[0] == "hello":
+                    send(("info", self.info))
+                elif msg[0] == "submit":
+                    _, rid, transcript, current_date, stream, deadline_in_s, lane = msg
+                    on_partial = (lambda fields, rid=rid: send(("partial", rid, fields))) if stream else None
+                    # Deadlines travel as time remaining; monotonic clocks differ between processes
+                    deadline = None if deadline_in_s is None else time.monotonic() + deadline_in_s
+                    try:
+                        fut = self.scheduler.submit(
+                            transcript, current_date, on_partial=on_partial, deadline=deadline, lane=lane,
+                        )
+                    except QueueFull as e:
+                        send(("error", rid, e))
+                        continue
+                    futures[rid] = fut
+                    fut.add_done_callback(lambda f, rid=rid: self._reply(send, futures, rid, f))
+                elif msg[0] == "cancel":
+                    fut = futures.get(msg[1])
+                    if fut is not None:
+                        fut.cancel()
+        except (EOFError, OSError):
+            pass
+        finally:
+            for fut in list(futures.values()):
+                fut.cancel()
+            conn.close()
+
+    def _reply(self, send, futures, rid, fut):
+        futures.pop(rid, None)
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is None:
+            send(("result", rid, (fut.result(), getattr(fut, "timings", None))))
+        elif is_fatal(e):
+            # Exit without answering: clients re-send the batch to the restarted worker
+            print(f"FATAL in model worker {self.info['name']}: {e}")
+            os._exit(FATAL_EXIT_CODE)
+        elif isinstance(e, (QueueFull, DeadlineExceeded)):
+            send(("error", rid, e))
+        else:
+            send(("error", rid, RuntimeError(str(e))))
+
+
+def _exit_with_parent(parent_pid):
+    """Stop a spawned worker when the API process that supervises it is gone."""
+    while True:
+        if os.getppid() != parent_pid:
+            os._exit(0)
+        time.sleep(1.0)
+
+
+def main(argv=None):
+    from scheduler import BatchScheduler
+
+    parser = argparse.ArgumentParser(description="Serve one model replica to the API over a local socket")
+    parser.add_argument("--backend", default=os.getenv("INFERENCE_BACKEND", "gpu").lower(), choices=("gpu", "cpu", "stub"))
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--address", default=f"127.0.0.1:{MODEL_WORKER_BASE_PORT}")
+    parser.add_argument("--name", default=None)
+    parser.add_argument("--metrics-port", type=int, default=0)
+    parser.add_argument("--parent-pid", type=int, default=0)
+    args = parser.parse_args(argv)
+    if not MODEL_WORKER_AUTHKEY:
+        parser.error("MODEL_WORKER_AUTHKEY must be set (the worker unpickles whatever its clients send)")
+
+    if args.parent_pid:
+        threading.Thread(target=_exit_with_parent, args=(args.parent_pid,), daemon=True).start()
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+        start_http_server(args.metrics_port)
+    name = args.name or f"{args.device}@{args.address}"
+    scheduler = BatchScheduler(load_backend(args.backend, args.device), name=name).start()
+    WorkerServer(scheduler, parse_address(args.address), MODEL_WORKER_AUTHKEY.encode("utf-8")).serve_forever()
+
+
+# =========================
+# API side
+# =========================
+class WorkerInfo:
+    """What the API needs to know about a remote backend (cache keys, logging)."""
+    def __init__(self, name, model_id, prompt_version, device, load_timings=None):
+        self.name = name
+        self.model_id = model_id
+        self.prompt_version = prompt_version
+        self.device = device
+        self.load_timings = load_timings or {}
+
+
+class WorkerProcess:
+    """Runs `model_worker.py` as a child process and starts it again whenever it exits.
+
+    The worker gets a random `authkey` through its environment (never the command line,
+    which other local users can read), kept across restarts so its client can reconnect.
+    """
+    def __init__(self, backend_kind, device, address, name, metrics_port=0):
+        self.backend_kind = backend_kind
+        self.device = device
+        self.address = address
+        self.name = name
+        self.metrics_port = metrics_port
+        self.authkey = secrets.token_bytes(32).hex()
+        self.proc = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._spawn()
+        threading.Thread(target=self._watch, name=f"model-worker-watch-{self.name}", daemon=True).start()
+        return self
+
+    def _spawn(self):
+        cmd = [
+            sys.executable, os.path.abspath(__file__),
+            "--backend", self.backend_kind, "--device", self.device,
+            "--address", format_address(self.address), "--name", self.name,
+            "--metrics-port", str(self.metrics_port), "--parent-pid", str(os.getpid()),
+        ]
+        self.proc = subprocess.Popen(cmd, env={**os.environ, "MODEL_WORKER_AUTHKEY": self.authkey})
+
+    def _watch(self):
+        while self._running:
+            code = self.proc.wait()
+            if not self._running:
+                return
+            print(f"Model worker {self.name} exited with code {code}; restarting in {MODEL_WORKER_RESTART_DELAY_S}s")
+            WORKER_RESTARTS.labels(replica=self.name).inc()
+            time.sleep(MODEL_WORKER_RESTART_DELAY_S)
+            if self._running:
+                self._spawn()
+
+    def stop(self):
+        self._running = False
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+class _Call:
+    __slots__ = ("args", "future", "on_partial", "deadline", "lane", "attempts", "streamed")
+
+    def __init__(self, args, future, on_partial, deadline, lane):
+        self.args = args
+        self.future = future
+        self.on_partial = on_partial
+        self.deadline = deadline
+        self.lane = lane
+        self.attempts = 0
+        self.streamed = False
+
+
+class WorkerClient:
+    """Scheduler-compatible handle on a model worker process.
+
+    Exposes `submit` / `predict` / `load` / `qsize` / `backend` like `BatchScheduler`, so
+    `ModelPool` routes across local and remote replicas alike. If the worker dies the
+    client reconnects once it is back and re-sends the requests that were in flight
+    (up to `retries` times); a streaming request that already sent fields fails instead,
+    since replaying it would repeat frames the client has seen.
+    """
+    def __init__(self, address, authkey, name=None, process=None,
+                 connect_timeout_s=MODEL_WORKER_CONNECT_TIMEOUT_S, retries=MODEL_WORKER_RETRIES):
+        self.address = parse_address(address)
+        self.name = name or format_address(self.address)
+        self.process = process
+        self.authkey = authkey.encode("utf-8") if isinstance(authkey, str) else authkey
+        self.connect_timeout_s = connect_timeout_s
+        self.retries = retries
+        self.backend = None
+        self._calls = {}
+        self._ids = itertools.count()
+        # Re-entrant: failing a call runs callbacks that may cancel another call
+        self._lock = threading.RLock()
+        self._conn = None
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        self._connect()
+        threading.Thread(target=self._read_loop, name=f"model-worker-client-{self.name}", daemon=True).start()
+        return self
+
+    def stop(self, timeout=None):
+        self._running = False
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+        if self.process is not None:
+            self.process.stop()
+
+    def load(self):
+        with self._lock:
+            return len(self._calls)
+
+    def qsize(self):
+        return self.load()
+
+    def submit(self, transcript, current_date=None, on_partial=None, deadline=None, lane=INTERACTIVE) -> Future:
+        if current_date is None: current_date = str(date.today())
+        rid = next(self._ids)
+        call = _Call((transcript, current_date, on_partial is not None), Future(), on_partial, deadline, lane)
+        with self._lock:
+            self._calls[rid] = call
+            self._send_call(rid, call)
+
+        def on_done(f):
+            if f.cancelled():
+                self._cancel(rid)
+
+        call.future.add_done_callback(on_done)
+        return call.future
+
+    def predict(self, transcript, current_date=None, timeout=None):
+        return self.submit(transcript, current_date).result(timeout=timeout)
+
+    def _send(self, msg):
+        # Call with _lock held. A failed send is picked up by the reader as a disconnect.
+        if self._conn is None:
+            return
+        try:
+            self._conn.send(msg)
+        except (OSError, EOFError):
+            pass
+
+    def _send_call(self, rid, call):
+        if self._conn is None:
+            return  # sent after reconnecting
+        call.attempts += 1
+        deadline_in_s = None if call.deadline is None else call.deadline - time.monotonic()
+        self._send(("submit", rid) + call.args + (deadline_in_s, call.lane))
+
+    def _cancel(self, rid):
+        with self._lock:
+            if self._calls.pop(rid, None) is not None:
+                self._send(("cancel", rid))
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout_s
+        while True:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                conn.send(("hello",))
+                _, info = conn.recv()
+                break
+            except (OSError, EOFError):
+                if not self._running or time.monotonic() > deadline:
+                    raise RuntimeError(f"Model worker {self.name} is not reachable")
+                time.sleep(0.5)
+        self.backend = WorkerInfo(**info)
+        with self._lock:
+            self._conn = conn
+        WORKER_UP.labels(replica=self.name).set(1)
+        print(f"Connected to model worker {self.name} ({info['model_id']} on {info['device']})")
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                msg = self._conn.recv()
+            except (EOFError, OSError):
+                if self._running:
+                    self._reconnect()
+                continue
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        kind, rid, payload = msg
+        if kind == "partial":
+            call = self._calls.get(rid)
+            if call is not None and call.on_partial is not None:
+                call.streamed = True
+                call.on_partial(payload)
+            return
+        with self._lock:
+            call = self._calls.pop(rid, None)
+        if call is None:
+            return  # cancelled meanwhile
+        try:
+            if kind == "result":
+                result, call.future.timings = payload
+                call.future.set_result(result)
+            else:
+                call.future.set_exception(payload)
+        except InvalidStateError:
+            pass
+
+    def _fail(self, calls, message):
+        for call in calls:
+            try:
+                call.future.set_exception(RuntimeError(message))
+            except InvalidStateError:
+                pass
+
+    def _reconnect(self):
+        print(f"Lost connection to model worker {self.name}; waiting for it to come back")
+        WORKER_UP.labels(replica=self.name).set(0)
+        with self._lock:
+            self._conn = None
+            lost = [rid for rid, c in self._calls.items() if c.streamed or c.attempts > self.retries]
+            lost = [self._calls.pop(rid) for rid in lost]
+        self._fail(lost, f"Model worker {self.name} crashed")
+        while self._running:
+            try:
+                self._connect()
+                break
+            except RuntimeError as e:
+                with self._lock:
+                    pending = list(self._calls.values())
+                    self._calls.clear()
+                self._fail(pending, str(e))
+        with self._lock:
+            for rid, call in list(self._calls.items()):
+                self._send_call(rid, call)
+
+
+def remote_workers(backend_kind, devices, per_device=1, first_port=0, cpu=False):
+    """Clients for MODEL_WORKER_ADDRESSES (MODEL_WORKER_CPU_ADDRESSES with `cpu`), or for
+    freshly spawned supervised workers on ports from MODEL_WORKER_BASE_PORT + `first_port`."""
+    addresses = MODEL_WORKER_CPU_ADDRESSES if cpu else MODEL_WORKER_ADDRESSES
+    if addresses.strip():
+        return [WorkerClient(a.strip(), MODEL_WORKER_AUTHKEY) for a in addresses.split(",") if a.strip()]
+    clients = []
+    for device in devices:
+        for n in range(per_device):
+            i = first_port + len(clients)
+            name = f"{device}#{n}"
+            address = ("127.0.0.1", MODEL_WORKER_BASE_PORT + i)
+            metrics_port = MODEL_WORKER_METRICS_BASE_PORT + i if MODEL_WORKER_METRICS_BASE_PORT else 0
+            process = WorkerProcess(backend_kind, device, address, name, metrics_port).start()
+            clients.append(WorkerClient(address, process.authkey, name=name, process=process))
+    return clients
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import json
+
+
+class PartialJsonParser:
+    """Incrementally extracts completed top-level fields from a JSON object as it is generated.
+
+    `feed(text)` appends newly generated text and returns a dict of the fields whose value
+    became complete since the previous call, in the order the model emitted them. Values are
+    the raw model output (before `clean_output`).
+    """
+    def __init__(self):
+        self.buf = ""
+        self.pos = None  # index just after the last consumed field, None until '{' is seen
+        self.decoder = json.JSONDecoder()
+        self.done = False
+
+    def _skip_ws(self, i):
+        while i < len(self.buf) and self.buf[i] in " \t\r\n":
+            i += 1
+        return i
+
+    def feed(self, text):
+        self.buf += text
+        fields = {}
+        if self.done:
+            return fields
+        if self.pos is None:
+            start = self.buf.find('{')
+            if start == -1:
+                return fields
+            self.pos = start + 1
+        while True:
+            i = self._skip_ws(self.pos)
+            if i < len(self.buf) and self.buf[i] in ",":
+                i = self._skip_ws(i + 1)
+            if i < len(self.buf) and self.buf[i] == "}":
+                self.done = True
+                return fields
+            try:
+                key, i = self.decoder.raw_decode(self.buf, i)
+                i = self._skip_ws(i)
+                if i >= len(self.buf) or self.buf[i] != ":":
+                    return fields
+                i = self._skip_ws(i + 1)
+                value, end = self.decoder.raw_decode(self.buf, i)
+            except ValueError:
+                # Key or value still being generated
+                return fields
+            # A number is only complete once a delimiter follows it ("0.9" may become "0.95")
+            after = self._skip_ws(end)
+            if after >= len(self.buf) or self.buf[after] not in ",}":
+                return fields
+            fields[key] = value
+            self.pos = after
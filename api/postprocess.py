@@ -0,0 +1,188 @@
+import calendar
+import re
+from datetime import date, datetime, timedelta
+
+from keywords import TRANSCRIPT_KEYWORDS
+from schema import CALL_LABELS, PAY_LABELS
+
+ISO_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def clean_output(result: dict, transcript: str, current_date: str) -> dict:
+    """Normalize a raw model answer against the label sets and the transcript's keywords.
+
+    Shared by the model path (DispositionModel) and the fast path, so an answer means the
+    same thing whichever of them produced it. Mutates and returns `result`.
+    """
+    if not isinstance(result, dict): return {"error": "Invalid format", "raw": str(result)}
+
+    call_labels = CALL_LABELS
+    pay_labels = PAY_LABELS
+
+    # 1. FUZZY Label Mapping (Don't be too strict)
+    disp = str(result.get("disposition", "OTHERS")).upper().replace(" ", "_")
+
+    # Transcript keyword categories (see keywords.KEYWORD_RULES), evaluated lazily
+    lower_t = transcript.lower()
+    kw = TRANSCRIPT_KEYWORDS.scan(lower_t)
+
+    # Pre-check transcript for family member keywords (more reliable than model label)
+    agent_asking_for_borrower = kw.has("agent_asking_for_borrower")
+    family_answered = kw.has("family")
+
+    # 1.5 System Message Heuristics (Very Reliable)
+    if kw.has("switched_off"):
+        result["disposition"] = "SWITCHED_OFF"
+    elif kw.has("out_of_network"):
+        result["disposition"] = "OUT_OF_NETWORK"
+    elif kw.has("busy"):
+        result["disposition"] = "BUSY"
+    elif kw.has("ringing"):
+        if not kw.has("pick") and kw.has("hello"):
+            result["disposition"] = "RINGING"
+    elif family_answered and agent_asking_for_borrower:
+        result["disposition"] = "ANSWERED_BY_FAMILY_MEMBER"
+    elif disp not in call_labels:
+        if "FAMILY" in disp or "MEMBER" in disp: result["disposition"] = "ANSWERED_BY_FAMILY_MEMBER"
+        elif "BUSY" in disp: result["disposition"] = "BUSY"
+        elif "WRONG" in disp: result["disposition"] = "WRONG_NUMBER"
+        elif "ANSWER" in disp: result["disposition"] = "ANSWERED"
+        elif len(disp) > 2 and disp.replace("_", "").isalnum():
+            result["disposition"] = disp
+        else:
+            result["disposition"] = "OTHERS"
+    else:
+        result["disposition"] = disp
+
+    p_disp = str(result.get("payment_disposition", "None")).upper().replace(" ", "_")
+    if kw.has("paid") and not kw.has("will"):
+        result["payment_disposition"] = "PAID"
+    elif p_disp not in pay_labels:
+        if "CLAIM" in p_disp: result["payment_disposition"] = "PAID"
+        elif "PROMISE" in p_disp or "PTP" in p_disp: result["payment_disposition"] = "PTP"
+        elif "REFUSE" in p_disp or "DENY" in p_disp: result["payment_disposition"] = "DENIED_TO_PAY"
+        else: result["payment_disposition"] = "None"
+    elif p_disp == "WANTS_TO_RENEGOTIATE_LOAN_TERMS":
+        if kw.has("marathi_ptp"):
+            result["payment_disposition"] = "PTP"
+            result["reason_for_not_paying"] = "OTHER_REASONS"
+        else:
+            result["payment_disposition"] = p_disp
+    elif p_disp == "WILL_PAY_AFTER_VISIT" or kw.has("visit_trigger"):
+        # Safety Heuristic: Ensure visit keywords are present or mapped
+        if kw.has("visit"):
+            result["payment_disposition"] = "WILL_PAY_AFTER_VISIT"
+        else:
+            # If it's a commitment with date/amount but no visit keyword, it's likely a PTP
+            # We check for presence of amt/date in the raw result before cleanup
+            ptp_candidate = result.get("ptp_details", {})
+            if (ptp_candidate.get("amount") or ptp_candidate.get("date")) and kw.has("pay"):
+                result["payment_disposition"] = "PTP"
+            else:
+                # If no commitment details, it might just be the model hallucinating the label
+                result["payment_disposition"] = "PTP" # Safer default if it predicted a payment intent
+    else:
+        result["payment_disposition"] = p_disp
+
+    # 2. Reason Mapping (Fuzzy)
+    reason = str(result.get("reason_for_not_paying", "None")).upper().replace(" ", "_")
+    if kw.has("job") and kw.has("job_lost"):
+         result["reason_for_not_paying"] = "JOB_CHANGED_WAITING_FOR_SALARY"
+    elif "JOB" in reason: 
+        result["reason_for_not_paying"] = "JOB_CHANGED_WAITING_FOR_SALARY"
+    elif "MEDICAL" in reason or kw.has("medical"):
+        result["reason_for_not_paying"] = "MEDICAL_ISSUE"
+
+    # 3. PTP Details Rescue & Validation
+    ptp = result.get("ptp_details", {})
+    if not isinstance(ptp, dict): ptp = {"amount": None, "date": None}
+    
+    # Amount Validation (Intelligent Match)
+    amt = ptp.get("amount")
+    if amt:
+        try:
+            # Clean amount for comparison (5,000 -> 5000)
+            clean_amt = str(int(float(str(amt).replace(',', ''))))
+            found = False
+            # Check for direct or fuzzy digits in transcript
+            if clean_amt in transcript.replace(',', ''):
+                found = True
+            
+            if not found: ptp["amount"] = None # Still verify it's supported by text
+            else: ptp["amount"] = clean_amt
+        except: ptp["amount"] = None
+
+    # 4. Date Validation & "Parso" Correction
+    p_date = ptp.get("date")
+    if p_date and current_date:
+        try:
+            c_y, c_m, c_d = map(int, current_date.split('-'))
+            dt_today = date(c_y, c_m, c_d)
+            
+            # Intelligent "Parso" Recovery
+            if kw.has("parso"):
+                # Force Today + 2
+                ptp["date"] = str(dt_today + timedelta(days=2))
+            elif kw.has("kal") and ptp.get("date") == current_date:
+                # If model said Today but transcript said Kal, fix it to Today + 1
+                ptp["date"] = str(dt_today + timedelta(days=1))
+
+            # Extract YYYY-MM-DD if there's a timestamp
+            raw_date = str(ptp["date"])
+            if "T" in raw_date:
+                raw_date = raw_date.split("T")[0]
+            elif " " in raw_date:
+                raw_date = raw_date.split(" ")[0]
+            
+            # Check if it matches YYYY-MM-DD
+            match = ISO_DATE_RE.search(raw_date)
+            if match:
+                raw_date = match.group(0)
+                ptp["date"] = raw_date
+            else:
+                ptp["date"] = None
+
+            if ptp["date"]:
+                # Structural cleanup (Feb 30 fix)
+                try:
+                    datetime.strptime(str(ptp["date"]), "%Y-%m-%d")
+                except ValueError:
+                    # If invalid date (e.g. Feb 30), Cap it at month end
+                    parts = str(ptp["date"]).split('-')
+                    if len(parts) == 3:
+                        y, m, d = int(parts[0]), int(parts[1]), int(parts[2])
+                        # Get max days in that month/year
+                        _, max_days = calendar.monthrange(y, m)
+                        if d > max_days: 
+                            ptp["date"] = f"{y:04d}-{m:02d}-{max_days:02d}"
+        except:
+            ptp["date"] = None
+            
+    # Clean up PTP details if it is not a PTP commitment
+    if result.get("payment_disposition") not in ["PTP", "PARTIAL_PAYMENT", "SETTLEMENT"]:
+        ptp["amount"] = None
+        ptp["date"] = None
+
+    # 5. Balanced PTP Enforcement (Negative Rules)
+    # Rule: Only downgrade if BOTH vague AND lacks specific commitment details
+    if result.get("payment_disposition") == "PTP":
+        # Be very careful with "vague" words - in Hinglish, "koshish" is often polite commitment
+        # Only downgrade if it's truly non-committal
+        is_non_committal = kw.has("non_committal")
+        has_strong_keyword = kw.has("commitment")
+
+        if is_non_committal and not has_strong_keyword:
+            # Only downgrade if NO date/amount were found as well
+            if ptp.get("date") is None and ptp.get("amount") is None:
+                result["payment_disposition"] = "NO_PAYMENT_COMMITMENT"
+                result["remarks"] = result.get("remarks", "") + " (Policy Downgrade: Non-committal)"
+        
+    result["ptp_details"] = ptp
+    # Ensure confidence_score is never null in a successful response
+    try:
+        val = float(result.get("confidence_score", 0.85))
+        result["confidence_score"] = min(max(val, 0.0), 1.0)
+    except:
+        result["confidence_score"] = 0.85
+        
+    return result
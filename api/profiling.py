@@ -0,0 +1,67 @@
+import os
+import random
+import time
+from contextlib import contextmanager, nullcontext
+
+# =========================
+# CONFIG
+# =========================
+# Fraction of model batches run under torch.profiler (0 = off, 1 = every batch)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Traces go next to the other per-host caches, outside the source tree
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.expanduser("~/.cache/disposition_api/profiles"))
+
+# Per-row stages (the rest of a batch's stages are shared by every row in it)
+ROW_STAGES = ("json_extract", "clean_output")
+
+
+class StageTimer:
+    """Wall-clock seconds per named stage of one batch, plus per-row details.
+
+    `rows` holds one dict per batch row (token counts, per-row stages); `as_dict()`
+    is the `timings` payload backends hand back to the scheduler.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.rows = []
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def as_dict(self):
+        return {"stages": dict(self.stages), "rows": [dict(r) for r in self.rows]}
+
+
+def maybe_profile(tag, rate=PROFILE_SAMPLE_RATE, out_dir=PROFILE_DIR):
+    """torch.profiler context for a sampled fraction of calls, else a no-op context."""
+    if rate <= 0 or random.random() >= rate:
+        return nullcontext()
+    return _profile(tag, out_dir)
+
+
+@contextmanager
+def _profile(tag, out_dir):
+    import torch
+    from torch.profiler import profile, ProfilerActivity
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, record_shapes=True) as prof:
+        yield
+    path = os.path.join(out_dir, f"{tag}_{int(time.time() * 1000)}.json")
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        # Open in chrome://tracing or https://ui.perfetto.dev
+        prof.export_chrome_trace(path)
+        print(f"Profiler trace written to {path}")
+    except Exception as e:
+        print(f"WARNING: could not write profiler trace {path}: {e}")
@@ -0,0 +1,116 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_HITS, CACHE_MISSES, CACHE_SIZE
+
+# =========================
+# CONFIG
+# =========================
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))  # 0 disables the cache
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", str(24 * 3600)))
+# Optional SQLite file shared across restarts (empty = memory only)
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "")
+RESULT_CACHE_DB_MAX_ROWS = int(os.getenv("RESULT_CACHE_DB_MAX_ROWS", "1000000"))
+
+
+def normalize_transcript(transcript):
+    """Whitespace-insensitive form of a transcript used for the cache key."""
+    return " ".join(str(transcript).split())
+
+
+def backend_identity(backend):
+    """(model id, runtime, prompt version) of a replica's backend; part of the cache key.
+
+    The runtime is the device type ("cuda" / "cpu"): an int8 CPU replica can answer
+    differently from the 4-bit GPU model loaded from the same checkpoint.
+    """
+    device = str(getattr(backend, "device", None) or "")
+    return (getattr(backend, "model_id", type(backend).__name__), device.partition(":")[0] or None,
+            getattr(backend, "prompt_version", None))
+
+
+def cache_key(transcript, current_date, model_id, runtime, prompt_version):
+    payload = json.dumps([normalize_transcript(transcript), current_date, model_id, runtime, prompt_version],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """LRU + TTL cache of cleaned predictions, optionally backed by SQLite.
+
+    Decoding is greedy (`do_sample=False`), so the same transcript, date, model, runtime
+    and prompt always produce the same result; only successful predictions are stored.
+    """
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl_s=RESULT_CACHE_TTL_S, db_path=RESULT_CACHE_DB,
+                 db_max_rows=RESULT_CACHE_DB_MAX_ROWS):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.db_max_rows = db_max_rows
+        self._entries = OrderedDict()  # key -> (stored_at, result)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_puts = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data TEXT, stored_at REAL)")
+            self._db.commit()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl_s:
+                    self._entries.move_to_end(key)
+                    CACHE_HITS.labels(tier="memory").inc()
+                    return copy.deepcopy(entry[1])
+                del self._entries[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT data, stored_at FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl_s:
+                    result = json.loads(row[0])
+                    self._remember(key, row[1], result)
+                    CACHE_HITS.labels(tier="disk").inc()
+                    return copy.deepcopy(result)
+        CACHE_MISSES.inc()
+        return None
+
+    def put(self, key, result):
+        if not isinstance(result, dict) or "error" in result:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, copy.deepcopy(result))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, data, stored_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(result, ensure_ascii=False), now),
+                )
+                self._db_puts += 1
+                if self._db_puts % 1000 == 0:
+                    self._evict_db(now)
+                self._db.commit()
+
+    def _remember(self, key, stored_at, result):
+        self._entries[key] = (stored_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        CACHE_SIZE.set(len(self._entries))
+
+    def _evict_db(self, now):
+        self._db.execute("DELETE FROM results WHERE stored_at < ?", (now - self.ttl_s,))
+        self._db.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.db_max_rows,),
+        )
@@ -0,0 +1,517 @@
+import bisect
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import date
+
+from metrics import (
+    SCHEDULER_QUEUE_DEPTH, BATCH_SIZE, BATCH_TIME, QUEUE_WAIT, REQUESTS_SHED, LANE_LATENCY, STAGE_TIME,
+    PADDING_EFFICIENCY, BATCH_OOM,
+)
+from profiling import ROW_STAGES
+from batch_sizing import BatchSizeController, is_oom
+
+# =========================
+# CONFIG
+# =========================
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "25"))
+# Queued interactive requests per replica before new ones are rejected (0 = unbounded)
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+# Minimum share of batch rows given to the bulk lane while interactive work is waiting
+BULK_MIN_SHARE = float(os.getenv("BULK_MIN_SHARE", "0.1"))
+# Upper bounds (in transcript tokens) of the length buckets batches are formed in (empty = one bucket)
+BATCH_LENGTH_BUCKETS = [int(b) for b in os.getenv("BATCH_LENGTH_BUCKETS", "128,256,512,1024,2048").split(",") if b.strip()]
+# A request queued this long makes its bucket the next one served, however empty it is
+BATCH_BUCKET_MAX_WAIT_MS = float(os.getenv("BATCH_BUCKET_MAX_WAIT_MS", "2000"))
+
+# Priority lanes: live /predict and /ws traffic goes ahead of /upload and job rows
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+
+class QueueFull(RuntimeError):
+    """Raised by `submit()` when the queue is at its max depth.
+
+    `retry_after` is a hint in whole seconds: roughly how long the queue takes to drain.
+    """
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Keep retry_after when sent across a model worker socket
+        return (QueueFull, (str(self), self.retry_after))
+
+
+class DeadlineExceeded(RuntimeError):
+    """Set on a request whose deadline passed before it reached the model."""
+
+
+class StreamCancelled(RuntimeError):
+    """Raised from a streaming request's field callback once its caller has cancelled it."""
+
+
+class StreamFuture(Future):
+    """Future of a streaming request.
+
+    A future that is already running cannot be cancelled, so `cancel()` also marks it
+    `abandoned`; the scheduler then stops the generation at the next field instead of
+    spending GPU time on an answer nobody reads.
+    """
+    abandoned = False
+
+    def cancel(self):
+        self.abandoned = True
+        return super().cancel()
+
+
+class InferenceRequest:
+    """One queued transcript plus the future its caller is waiting on."""
+    __slots__ = ("transcript", "current_date", "on_partial", "future", "enqueued_at", "deadline", "lane", "length")
+
+    def __init__(self, transcript, current_date, on_partial=None, deadline=None, lane=INTERACTIVE, length=None):
+        self.transcript = transcript
+        self.current_date = current_date
+        # Streaming requests get field-by-field callbacks and always run as a batch of one
+        self.on_partial = on_partial
+        self.future = StreamFuture() if on_partial is not None else Future()
+        self.enqueued_at = time.monotonic()
+        # time.monotonic() after which nobody is waiting for the answer any more
+        self.deadline = deadline
+        self.lane = lane
+        # Transcript length in tokens (estimated by the backend on the worker thread), for
+        # length bucketing; None until the request leaves the intake queue
+        self.length = length
+
+    def expired(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+
+class LengthBuckets:
+    """One lane's queue, split into FIFO deques by transcript length.
+
+    `len()` and `head()` treat it as a single queue ordered by arrival; `popleft(bucket)`
+    takes the oldest request of one bucket.
+    """
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.queues = [deque() for _ in range(len(self.bounds) + 1)]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def bucket(self, length):
+        return bisect.bisect_left(self.bounds, length)
+
+    def append(self, req):
+        self.queues[self.bucket(req.length)].append(req)
+        self.size += 1
+
+    def head(self):
+        """Oldest queued request, or None."""
+        heads = [q[0] for q in self.queues if q]
+        return min(heads, key=lambda r: r.enqueued_at) if heads else None
+
+    def peek(self, bucket):
+        queue = self.queues[bucket]
+        return queue[0] if queue else None
+
+    def popleft(self, bucket=None):
+        if bucket is None:
+            bucket = self.bucket(self.head().length)
+        self.size -= 1
+        return self.queues[bucket].popleft()
+
+    def fullest(self):
+        """Bucket with the most queued requests."""
+        return max(range(len(self.queues)), key=lambda b: len(self.queues[b]))
+
+
+class BatchScheduler:
+    """Collects requests from every endpoint into one queue and runs them as GPU batches.
+
+    A single worker thread owns the backend. It dispatches as soon as `max_batch_size`
+    requests are waiting, or when the oldest waiting request has been queued for
+    `max_wait_ms`. The backend is anything exposing
+    `predict_batch(items: list[tuple[transcript, current_date]]) -> list[dict]`,
+    so `DispositionModel` and the CPU `StubDispositionModel` are interchangeable.
+    Streaming requests additionally use `predict_stream(transcript, current_date, on_partial)`.
+    Both take a `timings` dict that the backend fills with its stage breakdown; each
+    request's future gets a `timings` attribute (queue wait, stages, token counts)
+    before it resolves.
+
+    Requests wait in one of two lanes. Interactive requests fill a batch before bulk
+    rows do, but the bulk lane earns `bulk_min_share` of every dispatched row while it
+    has work queued and is served first once that credit reaches a whole row, so a
+    steady stream of live calls cannot starve an upload.
+
+    Admission control: interactive submissions are rejected with `QueueFull` once
+    `max_queue` of them are waiting (bulk callers pace themselves), and requests whose
+    deadline has passed are failed with `DeadlineExceeded` when they reach the head of
+    their lane instead of being sent to the model.
+
+    Length bucketing: each lane is split by transcript length (`length_buckets`, in
+    tokens, from the backend's `estimate_tokens(transcript)` if it has one) and a batch
+    is formed within one bucket, so short calls are not padded to the length of a long
+    one. The next batch comes from the fullest bucket, unless the oldest request has
+    been queued for `bucket_max_wait_ms`; then its bucket goes next, which bounds how
+    long a lone long transcript can wait. Lengths are estimated on the worker thread:
+    `submit()` only appends to an intake queue, so callers on an event loop never
+    tokenize.
+
+    Memory-aware sizing: when the backend has a `memory_profile()` and GPU telemetry is
+    available (see batch_sizing.py), a batch also stops growing once the next row would
+    not fit in the free GPU memory (`memory_share` of it when replicas share a device).
+    A batch that still hits CUDA OOM is re-run in halves instead of failing its requests.
+    """
+    def __init__(self, backend, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, name="0",
+                 max_queue=SCHEDULER_MAX_QUEUE, bulk_min_share=BULK_MIN_SHARE,
+                 length_buckets=BATCH_LENGTH_BUCKETS, bucket_max_wait_ms=BATCH_BUCKET_MAX_WAIT_MS, memory_share=1.0):
+        self.backend = backend
+        self.name = name
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_s = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = max(0, int(max_queue))
+        self.bulk_min_share = min(1.0, max(0.0, float(bulk_min_share)))
+        self.bucket_max_wait_s = max(0.0, float(bucket_max_wait_ms)) / 1000.0
+        self._estimate_tokens = getattr(backend, "estimate_tokens", None)
+        self._memory = BatchSizeController.for_backend(backend, name=name, share=memory_share)
+        # Moving average of batch wall time, for Retry-After hints
+        self._batch_s = None
+        self._lanes = {lane: LengthBuckets(length_buckets) for lane in LANES}
+        # Submitted requests not yet measured and bucketed, and how many of them per lane
+        self._intake = deque()
+        self._intake_size = {lane: 0 for lane in LANES}
+        # Bulk rows owed to the bulk lane (see class docstring)
+        self._bulk_credit = 0.0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._active = 0  # rows currently inside a backend call
+        self._queue_depth = {lane: SCHEDULER_QUEUE_DEPTH.labels(replica=name, lane=lane) for lane in LANES}
+        self._lane_latency = {lane: LANE_LATENCY.labels(lane=lane) for lane in LANES}
+        self._batch_size = BATCH_SIZE.labels(replica=name)
+        self._batch_time = BATCH_TIME.labels(replica=name)
+        self._queue_wait = QUEUE_WAIT.labels(replica=name)
+        self._padding_efficiency = PADDING_EFFICIENCY.labels(replica=name)
+        self._oom = BATCH_OOM.labels(replica=name)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"batch-scheduler-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _queued(self):
+        return sum(len(q) for q in self._lanes.values()) + len(self._intake)
+
+    def _lane_size(self, lane):
+        return len(self._lanes[lane]) + self._intake_size[lane]
+
+    def qsize(self):
+        with self._cond:
+            return self._queued()
+
+    def load(self):
+        """Queued plus currently running rows; used for least-loaded routing."""
+        with self._cond:
+            return self._queued() + self._active
+
+    def submit(self, transcript, current_date=None, on_partial=None, deadline=None, lane=INTERACTIVE) -> Future:
+        """Queue a transcript; the returned future resolves to the cleaned prediction dict.
+
+        If `on_partial` is given it is called from the worker thread with each newly
+        completed JSON field while the model is still generating. `deadline` is a
+        `time.monotonic()` value after which the request is dropped unless it already
+        reached the model. `lane` is `INTERACTIVE` or `BULK`.
+        """
+        if current_date is None: current_date = str(date.today())
+        if lane not in self._lanes:
+            raise ValueError(f"Unknown scheduler lane: {lane}")
+        req = InferenceRequest(transcript, current_date, on_partial, deadline, lane)
+        with self._cond:
+            waiting = self._lane_size(lane)
+            if lane == INTERACTIVE and self.max_queue and waiting >= self.max_queue:
+                REQUESTS_SHED.labels(reason="queue_full").inc()
+                # Retry once the queue has roughly drained
+                batches = waiting / self.max_batch_size
+                raise QueueFull(
+                    f"Inference queue is full ({waiting} waiting)",
+                    retry_after=max(1, math.ceil(batches * (self._batch_s or 1.0))),
+                )
+            self._intake.append(req)
+            self._intake_size[lane] += 1
+            self._queue_depth[lane].set(waiting + 1)
+            self._cond.notify()
+        return req.future
+
+    def predict(self, transcript, current_date=None, timeout=None):
+        """Blocking helper with the same signature as `DispositionModel.predict`."""
+        return self.submit(transcript, current_date).result(timeout=timeout)
+
+    def _length(self, transcript):
+        if self._estimate_tokens is not None:
+            return self._estimate_tokens(transcript)
+        # Roughly 4 characters per token
+        return len(str(transcript)) // 4
+
+    def _admit(self):
+        """Measure intake requests and move them into their buckets (call with `_cond` held).
+
+        The lock is released while the backend tokenizes, so submitters never wait on it.
+        """
+        while self._intake:
+            reqs = list(self._intake)
+            self._intake.clear()
+            failed = []
+            self._cond.release()
+            try:
+                for r in reqs:
+                    try:
+                        r.length = self._length(r.transcript)
+                    except Exception as e:
+                        failed.append((r, e))
+            finally:
+                self._cond.acquire()
+            for r in reqs:
+                self._intake_size[r.lane] -= 1
+                if r.length is not None:
+                    self._lanes[r.lane].append(r)
+            for r, e in failed:
+                if r.future.set_running_or_notify_cancel():
+                    r.future.set_exception(e)
+
+    def _drop_expired(self):
+        """Pop expired requests from the head of each lane's buckets (call with `_cond` held)."""
+        now = time.monotonic()
+        expired = []
+        for lanes in self._lanes.values():
+            for bucket, queue in enumerate(lanes.queues):
+                while queue and queue[0].expired(now):
+                    expired.append(lanes.popleft(bucket))
+        return expired
+
+    def _lane_order(self):
+        """Lanes in the order they fill the next batch (call with `_cond` held)."""
+        if self._lanes[BULK] and self._bulk_credit >= 1.0:
+            return (BULK, INTERACTIVE)
+        return (INTERACTIVE, BULK)
+
+    def _pop_into(self, batch, lane, bucket, limit, now, expired, budget=None):
+        """Move requests of one lane and bucket into `batch`; True if memory cut it short."""
+        lanes = self._lanes[lane]
+        longest = max((r.length for r in batch), default=0)
+        while len(batch) < limit:
+            req = lanes.peek(bucket)
+            # A streaming request runs as a batch of one: it is only taken into an empty
+            # batch (which then stops growing), otherwise left for a later round
+            if req is None or req.on_partial is not None and batch:
+                break
+            # The first row always goes; an oversized one is left to the OOM fallback
+            if budget is not None and batch and not req.expired(now) \
+                    and not self._memory.fits(len(batch) + 1, max(longest, req.length), budget):
+                return True
+            lanes.popleft(bucket)
+            if req.expired(now):
+                expired.append(req)
+            else:
+                batch.append(req)
+                longest = max(longest, req.length)
+                if req.on_partial is not None:
+                    break
+        return False
+
+    def _pick_bucket(self, now):
+        """Length bucket of the next batch (call with `_cond` held)."""
+        oldest = min((q.head() for q in self._lanes.values() if q), key=lambda r: r.enqueued_at)
+        if now - oldest.enqueued_at >= self.bucket_max_wait_s:
+            return self._lanes[oldest.lane].bucket(oldest.length)
+        lane = next(lane for lane in self._lane_order() if self._lanes[lane])
+        return self._lanes[lane].fullest()
+
+    def _take(self, now, expired):
+        """Pop the next batch across lanes (call with `_cond` held)."""
+        bulk_waiting = bool(self._lanes[BULK])
+        bucket = self._pick_bucket(now)
+        budget = self._memory.budget() if self._memory is not None else None
+        batch = []
+        limited = False
+        # An owed bulk lane gets its whole rows of credit first, then interactive fills
+        # the batch and bulk tops up whatever is left
+        rounds = [(INTERACTIVE, self.max_batch_size), (BULK, self.max_batch_size)]
+        if bulk_waiting and self._bulk_credit >= 1.0:
+            rounds.insert(0, (BULK, min(self.max_batch_size, int(self._bulk_credit))))
+        for lane, limit in rounds:
+            limited = self._pop_into(batch, lane, bucket, limit, now, expired, budget)
+            if limited or batch and batch[0].on_partial is not None:
+                break
+        if limited:
+            self._memory.limited()
+        self._settle_credit(batch, bulk_waiting)
+        return batch
+
+    def _settle_credit(self, batch, bulk_waiting):
+        if not bulk_waiting:
+            self._bulk_credit = 0.0
+            return
+        served = sum(1 for r in batch if r.lane == BULK)
+        credit = self._bulk_credit + self.bulk_min_share * len(batch) - served
+        self._bulk_credit = min(float(self.max_batch_size), max(0.0, credit))
+
+    def _update_depth(self):
+        for lane in LANES:
+            self._queue_depth[lane].set(self._lane_size(lane))
+
+    def _next_batch(self):
+        """Next batch to run, plus the expired requests skipped on the way."""
+        with self._cond:
+            while self._running and not self._queued():
+                self._cond.wait()
+            if not self._running:
+                return [], []
+            self._admit()
+            expired = self._drop_expired()
+            if not self._queued():
+                self._update_depth()
+                return [], expired
+            head = next(self._lanes[lane].head() for lane in self._lane_order() if self._lanes[lane])
+            if head.on_partial is not None:
+                self._lanes[head.lane].popleft()
+                self._settle_credit([head], bool(self._lanes[BULK]))
+                self._update_depth()
+                return [head], expired
+            # The wait window is measured from the oldest request, so work that queued
+            # up while the previous batch was on the GPU goes out immediately.
+            oldest = min(q.head().enqueued_at for q in self._lanes.values() if q)
+            deadline = oldest + self.max_wait_s
+            while self._running and self._queued() < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._admit()
+            batch = self._take(time.monotonic(), expired)
+            if not batch and not expired:
+                # Nothing could be taken; wait for the queue to change instead of spinning
+                self._cond.wait(self.max_wait_s or 0.001)
+            self._update_depth()
+            return batch, expired
+
+    @staticmethod
+    def _forward(req):
+        """Field callback for a streaming request that aborts once the caller cancelled it."""
+        def on_partial(fields):
+            if req.future.abandoned:
+                raise StreamCancelled("Streaming request was cancelled")
+            req.on_partial(fields)
+        return on_partial
+
+    def _call_backend(self, batch, timings):
+        """Run `batch` on the backend; on CUDA OOM back off and re-run it in halves."""
+        try:
+            if batch[0].on_partial is not None:
+                r = batch[0]
+                results = [self.backend.predict_stream(r.transcript, r.current_date, self._forward(r), timings=timings)]
+            else:
+                items = [(r.transcript, r.current_date) for r in batch]
+                results = self.backend.predict_batch(items, timings=timings)
+        except Exception as e:
+            # A single row has nothing left to split; it fails like any other error
+            if not is_oom(e) or len(batch) == 1:
+                raise
+            oom = True
+        else:
+            oom = False
+        if not oom:
+            if self._memory is not None:
+                self._memory.on_success()
+            return results
+        # Retried outside the except block, so the failed attempt's tensors (held by the
+        # traceback) are freed before the smaller batches allocate
+        self._oom.inc()
+        if self._memory is not None:
+            self._memory.on_oom(len(batch))
+        else:
+            print(f"CUDA OOM on replica {self.name} with {len(batch)} rows; retrying in halves")
+        half = len(batch) // 2
+        first, second = {}, {}
+        results = self._call_backend(batch[:half], first) + self._call_backend(batch[half:], second)
+        # Stage times add up over the retried halves
+        stages = dict(first.get("stages", {}))
+        for stage, seconds in second.get("stages", {}).items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        timings.update({
+            "stages": stages,
+            "rows": (first.get("rows") or [{} for _ in batch[:half]]) + (second.get("rows") or [{} for _ in batch[half:]]),
+        })
+        return results
+
+    def _run(self):
+        while self._running:
+            batch, expired = self._next_batch()
+            for r in expired:
+                if r.future.set_running_or_notify_cancel():
+                    REQUESTS_SHED.labels(reason="deadline").inc()
+                    r.future.set_exception(DeadlineExceeded("Deadline passed while the request was queued"))
+            # Skip requests whose caller already gave up (e.g. cancelled asyncio wrapper)
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            now = time.monotonic()
+            for r in batch:
+                self._queue_wait.observe(now - r.enqueued_at)
+            self._batch_size.observe(len(batch))
+            # Share of the padded prompt block that is real transcript tokens
+            longest = max(r.length for r in batch)
+            padding_efficiency = sum(r.length for r in batch) / (len(batch) * longest) if longest else 1.0
+            self._padding_efficiency.observe(padding_efficiency)
+            with self._cond:
+                self._active = len(batch)
+            started = time.monotonic()
+            timings = {}
+            try:
+                with self._batch_time.time():
+                    results = self._call_backend(batch, timings)
+            except Exception as e:
+                if not isinstance(e, StreamCancelled):
+                    print(f"ERROR in batch of {len(batch)}: {e}")
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            finally:
+                finished = time.monotonic()
+                with self._cond:
+                    self._active = 0
+                    elapsed = finished - started
+                    self._batch_s = elapsed if self._batch_s is None else 0.8 * self._batch_s + 0.2 * elapsed
+                for r in batch:
+                    self._lane_latency[r.lane].observe(finished - r.enqueued_at)
+            stages = timings.get("stages", {})
+            rows = timings.get("rows") or [{} for _ in batch]
+            for stage, seconds in stages.items():
+                STAGE_TIME.labels(stage=stage).observe(seconds)
+            for r, res, row in zip(batch, results, rows):
+                for stage in ROW_STAGES:
+                    if stage in row:
+                        STAGE_TIME.labels(stage=stage).observe(row[stage])
+                r.future.timings = {
+                    "lane": r.lane, "batch_size": len(batch), "queue_wait": started - r.enqueued_at,
+                    "padding_efficiency": padding_efficiency, **stages, **row,
+                }
+                r.future.set_result(res)
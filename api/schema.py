@@ -0,0 +1,51 @@
+from pydantic import BaseModel
+
+# =========================
+# LABELS
+# =========================
+# Label sets used to normalize model output (postprocess.clean_output) and,
+# with schema-constrained decoding, the only values the model may generate.
+CALL_LABELS = [
+    "ANSWERED", "ANSWERED_BY_FAMILY_MEMBER", "CUSTOMER_PICKED", "AGENT_BUSY_ON_ANOTHER_CALL",
+    "SILENCE_ISSUE", "LANGUAGE_BARRIER", "ANSWERED_VOICE_ISSUE", "CUSTOMER_ABUSIVE",
+    "AUTOMATED_VOICE", "FORWARDED_CALL", "RINGING", "BUSY", "SWITCHED_OFF",
+    "WRONG_NUMBER", "DO_NOT_KNOW_THE_PERSON", "NOT_IN_CONTACT_ANYMORE", "OUT_OF_NETWORK", "OUT_OF_SERVICES",
+    "CALL_BACK_LATER", "WILL_ASK_TO_PAY", "GAVE_ALTERNATE_NUMBER",
+    "ANSWERED_DISCONNECTED", "CALL_DISCONNECTED_BY_CUSTOMER", "NOT_AVAILABLE", "WRONG_PERSON",
+    "NO_INCOMING_CALLS", "RINGING_DISCONNECTED", "OTHERS"
+]
+
+PAY_LABELS = [
+    "PAID", "PTP", "PARTIAL_PAYMENT", "SETTLEMENT", "WILL_PAY_AFTER_VISIT",
+    "DENIED_TO_PAY", "NO_PAYMENT_COMMITMENT", "NO_PROOF_GIVEN", "WANT_FORECLOSURE", "WANTS_TO_RENEGOTIATE_LOAN_TERMS",
+    "None"
+]
+
+REASON_LABELS = [
+    "FUNDS_ISSUE", "TECHNICAL_ISSUE", "JOB_CHANGED_WAITING_FOR_SALARY", "MEDICAL_ISSUE", "RATE_OF_INTEREST_ISSUES",
+    "SALARY_NOT_CREDITED", "SERVICE_ISSUE", "CUSTOMER_NOT_TELLING_REASON", "OTHER_REASONS",
+]
+
+# Enum fields for constrained decoding ("None" is generated as JSON null)
+FIELD_LABELS = {
+    "disposition": CALL_LABELS,
+    "payment_disposition": [l for l in PAY_LABELS if l != "None"],
+    "reason_for_not_paying": REASON_LABELS,
+}
+# Fields the prompt always has the model fill, even though the API response allows null
+REQUIRED_FIELDS = {"disposition", "ptp_details", "remarks", "confidence_score"}
+
+
+# Nested Model for Ptp Details
+class PtpDetails(BaseModel):
+    amount: float | str | None = None
+    date: str | None = None
+
+# Response Model
+class DispositionResponse(BaseModel):
+    disposition: str | None = None
+    payment_disposition: str | None = None
+    reason_for_not_paying: str | None = None
+    ptp_details: PtpDetails | None = None
+    remarks: str | None = None
+    confidence_score: float | None = None
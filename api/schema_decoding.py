@@ -0,0 +1,556 @@
+import hashlib
+import inspect
+import json
+import os
+import re
+import time
+import typing
+
+from pydantic import BaseModel
+
+# torch is imported where the masks and the decode loop need it, so the schema,
+# trie and cursor logic can be used (and tested) without it
+
+# Max tokens per generated string / number value (the closing quote is forced after that)
+MAX_NUMBER_TOKENS = 16
+
+# Vocabulary classes used to build per-step token masks. Token text is the decoded
+# string of a single token id; special/added tokens are never allowed. Bump
+# VOCAB_CLASSES_VERSION when a class changes so cached tables are rebuilt.
+VOCAB_CLASSES_VERSION = 2
+VOCAB_CLASSES = {
+    # Inside a JSON string: anything that does not end it or need escaping
+    "string_body": lambda t: bool(t) and '"' not in t and "\\" not in t and all(ord(c) >= 0x20 for c in t),
+    # Ends the string being decoded; the closing quote itself is forced
+    "string_end": lambda t: t.startswith('"'),
+    # First token of a number (optionally after the space following ':'); JSON allows
+    # no leading zeros, so a lone 0 can only be followed by a fraction
+    "int_start": lambda t: re.fullmatch(r" ?(0|[1-9]\d*)", t) is not None,
+    "decimal_start": lambda t: re.fullmatch(r" ?(0|[1-9]\d*)\.\d*", t) is not None,
+    "digits": lambda t: re.fullmatch(r"\d+", t) is not None,
+    "decimal_point": lambda t: re.fullmatch(r"\d*\.\d*", t) is not None,
+    "fraction_start": lambda t: re.fullmatch(r"\.\d*", t) is not None,
+    # Ends the number being decoded; the following ',' / '}' is forced
+    "number_end": lambda t: re.match(r"\s*[,}]", t) is not None,
+}
+
+
+def vocab_cache_key(tokenizer, size):
+    """Stable key for per-vocabulary tables cached on disk (hash of the tokenizer)."""
+    if getattr(tokenizer, "is_fast", False):
+        fingerprint = tokenizer.backend_tokenizer.to_str()
+    else:
+        fingerprint = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return hashlib.sha256(f"{size}:{fingerprint}".encode("utf-8")).hexdigest()[:16]
+
+
+def compile_schema(model_cls, labels, required=()):
+    """Flatten a pydantic response model into JSON literals and value slots, in field order.
+
+    Returns a list whose items are either literal JSON text (keys, punctuation) or
+    `(kind, name, options, nullable)` value slots: kind is "enum" for fields in
+    `labels`, "number" for float/int fields and "string" otherwise. Nested models are
+    inlined. Fields are nullable when their annotation allows None, unless listed in
+    `required`.
+    """
+    parts = []
+
+    def literal(text):
+        if parts and isinstance(parts[-1], str):
+            parts[-1] += text
+        else:
+            parts.append(text)
+
+    def obj(cls):
+        literal("{")
+        for i, (name, info) in enumerate(cls.model_fields.items()):
+            literal((", " if i else "") + json.dumps(name) + ":")
+            args = typing.get_args(info.annotation) or (info.annotation,)
+            nullable = type(None) in args and name not in required
+            nested = [a for a in args if isinstance(a, type) and issubclass(a, BaseModel)]
+            if nested:
+                literal(" ")
+                obj(nested[0])
+            elif name in labels:
+                parts.append(("enum", name, list(labels[name]), nullable))
+            elif float in args or int in args:
+                parts.append(("number", name, None, nullable))
+            else:
+                parts.append(("string", name, None, nullable))
+        literal("}")
+
+    obj(model_cls)
+    return parts
+
+
+# =========================
+# Value slots
+# =========================
+# Each slot hands out a cursor per row. A cursor is driven by the row decoder:
+# `start()` / `feed(token)` return (tokens to append, finished) and `allowed()`
+# returns (vocab class names, extra token ids) for the next model step.
+
+def build_trie(options):
+    """Token trie over {token_ids: value}; a node's None key holds the value of an option ending there."""
+    root = {}
+    for ids, value in options.items():
+        node = root
+        for tok in ids:
+            node = node.setdefault(tok, {})
+        node[None] = value
+    return root
+
+
+class _TrieCursor:
+    """Walks a trie of whole options, skipping every step that has only one way forward."""
+    def __init__(self, node):
+        self.node = node
+        self.value = None
+
+    def _forced(self):
+        out = []
+        while None not in self.node and len(self.node) == 1:
+            tok, self.node = next(iter(self.node.items()))
+            out.append(tok)
+        finished = None in self.node
+        if finished:
+            self.value = self.node[None]
+        return out, finished
+
+    def start(self):
+        return self._forced()
+
+    def allowed(self):
+        return (), tuple(k for k in self.node if k is not None)
+
+    def feed(self, tok):
+        self.node = self.node[tok]
+        out, finished = self._forced()
+        return [tok] + out, finished
+
+
+class EnumSlot:
+    def __init__(self, tokenizer, options, nullable):
+        choices = {tuple(_ids(tokenizer, " " + json.dumps(o))): o for o in options}
+        if nullable:
+            choices[tuple(_ids(tokenizer, " null"))] = None
+        self.trie = build_trie(choices)
+
+    def cursor(self, vocab):
+        return _TrieCursor(self.trie)
+
+
+class StringSlot:
+    def __init__(self, tokenizer, nullable, max_tokens):
+        openers = {tuple(_ids(tokenizer, ' "')): "open", tuple(_ids(tokenizer, '"')): "open"}
+        if nullable:
+            openers[tuple(_ids(tokenizer, " null"))] = None
+        self.open_trie = build_trie(openers)
+        self.close_ids = _ids(tokenizer, '"')
+        self.max_tokens = max_tokens
+
+    def cursor(self, vocab):
+        return _StringCursor(self, vocab)
+
+
+class _StringCursor:
+    def __init__(self, slot, vocab):
+        self.slot = slot
+        self.vocab = vocab
+        self.opener = _TrieCursor(slot.open_trie)
+        self.count = 0
+
+    def _opened(self, out, finished):
+        if finished and self.opener.value is not None:
+            # Opening quote done; the string body needs the model
+            self.opener = None
+            return out, False
+        return out, finished
+
+    def start(self):
+        return self._opened(*self.opener.start())
+
+    def allowed(self):
+        if self.opener is not None:
+            return self.opener.allowed()
+        return ("string_body", "string_end"), ()
+
+    def feed(self, tok):
+        if self.opener is not None:
+            return self._opened(*self.opener.feed(tok))
+        if self.vocab.member("string_end", tok):
+            return list(self.slot.close_ids), True
+        self.count += 1
+        if self.count >= self.slot.max_tokens:
+            return [tok] + self.slot.close_ids, True
+        return [tok], False
+
+
+class NumberSlot:
+    def __init__(self, tokenizer, nullable, max_tokens=MAX_NUMBER_TOKENS):
+        self.null_trie = build_trie({tuple(_ids(tokenizer, " null")): None}) if nullable else {}
+        # Tokenizers that split digits from the preceding space (Qwen) need the space on its own
+        space = _ids(tokenizer, " ")
+        self.space_ids = tuple(space) if len(space) == 1 else ()
+        self.zero_ids = _ids(tokenizer, "0")
+        self.max_tokens = max_tokens
+
+    def cursor(self, vocab):
+        return _NumberCursor(self, vocab)
+
+
+class _NumberCursor:
+    def __init__(self, slot, vocab):
+        self.slot = slot
+        self.vocab = vocab
+        self.null = None
+        self.count = 0
+        # None before the first digit, then "zero" (an integer part of just 0), "int" or "fraction"
+        self.part = None
+        self.needs_digit = False
+        self.spaced = False
+
+    def start(self):
+        return [], False
+
+    def allowed(self):
+        if self.null is not None:
+            return self.null.allowed()
+        if self.part is None:
+            extra = tuple(k for k in self.slot.null_trie if k is not None)
+            return ("int_start", "decimal_start"), extra + (() if self.spaced else self.slot.space_ids)
+        if self.needs_digit:
+            return ("digits",), ()
+        if self.part == "zero":
+            return ("fraction_start", "number_end"), ()
+        if self.part == "int":
+            return ("digits", "decimal_point", "number_end"), ()
+        return ("digits", "number_end"), ()
+
+    def feed(self, tok):
+        if self.null is None and self.part is None and tok in self.slot.null_trie:
+            self.null = _TrieCursor(self.slot.null_trie)
+        if self.null is not None:
+            return self.null.feed(tok)
+        if self.part is None and tok in self.slot.space_ids:
+            self.spaced = True
+            return [tok], False
+        if self.part is not None and not self.needs_digit and self.vocab.member("number_end", tok):
+            return [], True
+        text = self.vocab.text(tok)
+        if "." in text:
+            self.part = "fraction"
+        elif self.part is None:
+            self.part = "zero" if text.strip() == "0" else "int"
+        self.needs_digit = text.endswith(".")
+        self.count += 1
+        if self.count >= self.slot.max_tokens:
+            # Out of budget: close the number, keeping it valid JSON
+            return [tok] + (self.slot.zero_ids if self.needs_digit else []), True
+        return [tok], False
+
+
+def accepts_logits_to_keep(model):
+    """Whether the model's forward() takes `logits_to_keep` (transformers >= 4.50)."""
+    try:
+        params = inspect.signature(getattr(model, "forward", model)).parameters
+    except (TypeError, ValueError):
+        return False
+    return "logits_to_keep" in params
+
+
+def _ids(tokenizer, text):
+    return tokenizer(text, add_special_tokens=False)["input_ids"]
+
+
+# =========================
+# Decoding
+# =========================
+class VocabMasks:
+    """Boolean tables over the vocabulary for each `VOCAB_CLASSES` entry.
+
+    Built by decoding every token id once and cached on disk keyed by a hash of the
+    tokenizer (like the StopOnJson brace tables). A CPU copy answers per-token
+    membership checks without a device sync.
+    """
+    def __init__(self, tokenizer, tables, device=None):
+        self.tokenizer = tokenizer
+        self.cpu = tables
+        self.tables = {name: t.to(device) for name, t in tables.items()}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, vocab_size=None, device=None, cache_dir=None):
+        size = max(len(tokenizer), vocab_size or 0)
+        names = sorted(VOCAB_CLASSES)
+        path = None
+        if cache_dir:
+            key = vocab_cache_key(tokenizer, size)
+            path = os.path.join(cache_dir, f"schema_vocab_v{VOCAB_CLASSES_VERSION}_{key}.pt")
+        import torch
+        if path and os.path.exists(path):
+            try:
+                tables = torch.load(path)
+                if sorted(tables) == names:
+                    return cls(tokenizer, tables, device)
+            except Exception as e:
+                print(f"WARNING: ignoring unreadable schema vocab cache {path}: {e}")
+
+        tables = {name: torch.zeros(size, dtype=torch.bool) for name in names}
+        special = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}))
+        for tid in range(len(tokenizer)):
+            if tid in special:
+                continue
+            text = tokenizer.decode([tid])
+            for name in names:
+                if VOCAB_CLASSES[name](text):
+                    tables[name][tid] = True
+        if path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                torch.save(tables, path)
+            except OSError as e:
+                print(f"WARNING: could not write schema vocab cache {path}: {e}")
+        return cls(tokenizer, tables, device)
+
+    def member(self, name, tok):
+        return bool(self.cpu[name][tok])
+
+    def text(self, tok):
+        return self.tokenizer.decode([tok])
+
+
+class PromptLookup:
+    """Prompt-lookup drafting: find the output's last n-gram in the prompt and propose what followed it.
+
+    Remarks, amounts and dates are often copied from the transcript, so the tokens
+    after the latest occurrence of the current n-gram (longest first, down to one
+    token) are a cheap guess at the next ones.
+    """
+    def __init__(self, prompt_ids, max_ngram=3, num_tokens=8):
+        self.prompt = list(prompt_ids)
+        self.max_ngram = max_ngram
+        self.num_tokens = num_tokens
+        # n-gram -> end position of its latest occurrence that still has a continuation
+        self.index = {}
+        for n in range(1, max_ngram + 1):
+            for end in range(n, len(self.prompt)):
+                self.index[tuple(self.prompt[end - n:end])] = end
+
+    def draft(self, tokens):
+        for n in range(min(self.max_ngram, len(tokens)), 0, -1):
+            end = self.index.get(tuple(tokens[-n:]))
+            if end is not None:
+                return self.prompt[end:end + self.num_tokens]
+        return []
+
+
+class _RowDecoder:
+    """Output state of one batch row: appends literals and forced tokens, asks the model only at real choices."""
+    def __init__(self, items, vocab):
+        self.items = items
+        self.vocab = vocab
+        self.index = 0
+        self.cursor = None
+        self.tokens = []
+        # Tokens chosen by the model (the rest were filled in from the schema)
+        self.sampled = 0
+        # Prompt-lookup draft tokens proposed for / accepted into this row
+        self.drafted = 0
+        self.accepted = 0
+        self.done = False
+
+    def allowed(self):
+        return self.cursor.allowed()
+
+    def step(self, tok=None):
+        """Feed the model's pick (None on the first call); returns the tokens to append."""
+        out = []
+        if tok is not None:
+            emitted, finished = self.cursor.feed(tok)
+            self.sampled += emitted[:1] == [tok]
+            out += emitted
+            if finished:
+                self.index, self.cursor = self.index + 1, None
+        while self.cursor is None and self.index < len(self.items):
+            item = self.items[self.index]
+            if isinstance(item, list):
+                out += item
+                self.index += 1
+                continue
+            self.cursor = item.cursor(self.vocab)
+            emitted, finished = self.cursor.start()
+            out += emitted
+            if finished:
+                self.index, self.cursor = self.index + 1, None
+        self.done = self.index == len(self.items)
+        self.tokens += out
+        return out
+
+
+class SchemaDecoder:
+    """Greedy decoding restricted to JSON matching a pydantic response model.
+
+    Keys, punctuation and any value with a single possible continuation (e.g. the
+    rest of a label once its prefix is unique) are appended without a model step;
+    the model only runs at real choices, with its logits masked to the tokens the
+    schema allows there. Every output is valid JSON and the number of model steps
+    is bounded by the schema, not by max_new_tokens.
+    """
+    def __init__(self, tokenizer, parts, vocab, max_string_tokens):
+        self.vocab = vocab
+        self.items = []
+        for part in parts:
+            if isinstance(part, str):
+                self.items.append(_ids(tokenizer, part))
+                continue
+            kind, _, options, nullable = part
+            if kind == "enum":
+                self.items.append(EnumSlot(tokenizer, options, nullable))
+            elif kind == "number":
+                self.items.append(NumberSlot(tokenizer, nullable))
+            else:
+                self.items.append(StringSlot(tokenizer, nullable, max_string_tokens))
+        self._masks = {}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, response_model, labels, required=(), max_string_tokens=64,
+                       vocab_size=None, device=None, cache_dir=None):
+        vocab = VocabMasks.from_tokenizer(tokenizer, vocab_size, device, cache_dir)
+        return cls(tokenizer, compile_schema(response_model, labels, required), vocab, max_string_tokens)
+
+    def row(self):
+        return _RowDecoder(self.items, self.vocab)
+
+    def mask(self, names, ids):
+        key = (names, ids)
+        mask = self._masks.get(key)
+        if mask is None:
+            import torch
+            mask = torch.zeros_like(next(iter(self.vocab.tables.values())))
+            for name in names:
+                mask |= self.vocab.tables[name]
+            if ids:
+                mask[list(ids)] = True
+            self._masks[key] = mask
+        return mask
+
+    def generate(self, model, input_ids, attention_mask, past_key_values, pad_token_id, timer, streamer=None,
+                 lookup_tokens=0, lookup_ngram=3):
+        """Decode every row of a left-padded batch; returns (output token ids per row, rows).
+
+        `past_key_values` may hold a cache of the first positions of `input_ids` (the
+        shared prefix). Rows advance by different numbers of tokens per step; shorter
+        chunks are left-padded and masked out, so each row's last position is always
+        its latest real token.
+
+        With `lookup_tokens` > 0 each step also carries up to that many draft tokens per
+        row, copied from the row's prompt (see `PromptLookup`). The model scores them in
+        the same forward pass and a draft token is kept only while it equals the masked
+        greedy pick, so the output is the same as without drafting. Rejected positions
+        are masked out of the attention instead of being cut from the cache, which lets
+        every row keep a different number of them.
+        """
+        import torch
+        with torch.inference_mode():
+            return self._generate(model, input_ids, attention_mask, past_key_values, pad_token_id, timer,
+                                  streamer, lookup_tokens, lookup_ngram)
+
+    def _generate(self, model, input_ids, attention_mask, past_key_values, pad_token_id, timer, streamer,
+                  lookup_tokens, lookup_ngram):
+        import torch
+        device = input_ids.device
+        rows = [self.row() for _ in range(input_ids.shape[0])]
+        cached = past_key_values.get_seq_length() if past_key_values is not None else 0
+        lookups = []
+        if lookup_tokens > 0:
+            for ids, mask in zip(input_ids[:, cached:].tolist(), attention_mask[:, cached:].tolist()):
+                prompt = [t for t, m in zip(ids, mask) if m]
+                lookups.append(PromptLookup(prompt, lookup_ngram, lookup_tokens))
+        # The opening literal is the same for every row: prefill it with the prompt
+        opening = torch.tensor([r.step() for r in rows], dtype=torch.long, device=device)
+        if streamer is not None:
+            streamer.put(input_ids[0].cpu())
+        streamed = 0
+        input_ids = torch.cat([input_ids, opening], dim=1)
+        attention_mask = torch.cat([attention_mask, torch.ones_like(opening)], dim=1)
+
+        # Full-vocab logits for every prefilled position would dwarf the KV cache, so only
+        # the last positions are asked for where the model's forward() supports it
+        trims_logits = accepts_logits_to_keep(model)
+
+        def forward(new_ids, past, keep):
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -new_ids.shape[1]:]
+            extra = {"logits_to_keep": keep} if trims_logits else {}
+            out = model(
+                input_ids=new_ids, attention_mask=attention_mask, position_ids=position_ids,
+                past_key_values=past, use_cache=True, **extra,
+            )
+            return out.logits[:, -keep:, :], out.past_key_values
+
+        started = time.perf_counter()
+        logits, past = forward(input_ids[:, cached:], past_key_values, 1)
+        drafts = [[] for _ in rows]
+        prefill = None
+        while True:
+            # Verify: walk each row's drafts, one position per pass across the batch
+            chunks = [[] for _ in rows]
+            rejected = [0] * len(rows)
+            verifying = [i for i, r in enumerate(rows) if not r.done]
+            width = logits.shape[1]
+            j = 0
+            while verifying:
+                allowed = torch.stack([self.mask(*rows[i].allowed()) for i in verifying])
+                at = torch.tensor([width - 1 - len(drafts[i]) + j for i in verifying], device=device)
+                step_logits = logits[torch.tensor(verifying, device=device), at].float()
+                picks = step_logits.masked_fill(~allowed, float("-inf")).argmax(dim=-1).tolist()
+                if prefill is None:
+                    # .tolist() synchronized the device, so this is the real end of the prefill
+                    prefill = time.perf_counter()
+                still = []
+                for i, tok in zip(verifying, picks):
+                    draft = drafts[i]
+                    emitted = rows[i].step(tok)
+                    # The draft token is in the cache, so it stays if the output has it there.
+                    # It only counts as accepted when it was the model's pick, not when the
+                    # schema put it there (e.g. the closing quote forced for a string-end pick).
+                    kept = int(j < len(draft) and emitted[:1] == [draft[j]])
+                    if kept and tok == draft[j]:
+                        rows[i].accepted += 1
+                    if kept and len(emitted) == 1 and not rows[i].done:
+                        # Its logits are the next position's
+                        still.append(i)
+                        continue
+                    chunks[i] = emitted[kept:]
+                    rejected[i] = len(draft) - j - kept
+                verifying = still
+                j += 1
+            for i, n in enumerate(rejected):
+                if n:
+                    attention_mask[i, attention_mask.shape[1] - n:] = 0
+            if streamer is not None and len(rows[0].tokens) > streamed:
+                streamer.put(torch.tensor(rows[0].tokens[streamed:]))
+                streamed = len(rows[0].tokens)
+            if all(r.done for r in rows):
+                break
+
+            # Draft and run the next step
+            for i, r in enumerate(rows):
+                drafts[i] = lookups[i].draft(r.tokens) if lookups and not r.done else []
+                r.drafted += len(drafts[i])
+                chunks[i] = chunks[i] + drafts[i]
+            width = max(len(c) for c in chunks)
+            step_ids = torch.full((len(rows), width), pad_token_id, dtype=torch.long)
+            step_mask = torch.zeros((len(rows), width), dtype=torch.long)
+            for i, chunk in enumerate(chunks):
+                if chunk:
+                    step_ids[i, width - len(chunk):] = torch.tensor(chunk, dtype=torch.long)
+                    step_mask[i, width - len(chunk):] = 1
+            attention_mask = torch.cat([attention_mask, step_mask.to(device)], dim=1)
+            logits, past = forward(step_ids.to(device), past, width)
+        finished = time.perf_counter()
+        prefill = prefill or finished
+        timer.stages["prefill"] = prefill - started
+        timer.stages["decode"] = finished - prefill
+        if streamer is not None:
+            streamer.end()
+        return [r.tokens for r in rows], rows
@@ -0,0 +1,136 @@
+import threading
+from concurrent.futures import Future
+from datetime import date
+
+from metrics import SINGLEFLIGHT_JOINED
+from result_cache import ResultCache, backend_identity, cache_key
+from scheduler import INTERACTIVE
+
+
+class _InFlight:
+    """A generation shared by every concurrent caller with the same key."""
+    __slots__ = ("leader", "deadline", "lane", "waiters")
+
+    def __init__(self, leader, deadline, lane):
+        self.leader = leader
+        # The shared request is dropped at this deadline, so later callers need their own
+        self.deadline = deadline
+        self.lane = lane
+        self.waiters = 0
+
+    def can_join(self, deadline, lane):
+        # Live calls never wait behind a bulk-lane generation
+        if lane == INTERACTIVE and self.lane != INTERACTIVE:
+            return False
+        return self.deadline is None or (deadline is not None and deadline <= self.deadline)
+
+
+class InferenceService:
+    """Front door used by every endpoint: cheap shortcuts first, then the batching scheduler.
+
+    `submit()` mirrors `BatchScheduler.submit()` and always returns a
+    `concurrent.futures.Future`, already resolved when the answer needs no GPU work.
+    Concurrent identical requests (same transcript and date) share one in-flight
+    generation; each caller still gets its own future, so one client cancelling does
+    not cancel the others. A caller only joins a generation whose deadline is no earlier
+    than its own and whose lane is at least as urgent.
+
+    Results are cached under the identity (model, runtime, prompt) of the scheduler's
+    `backend`, i.e. the pool's first GPU replica. An answer from a replica with another
+    identity (a CPU replica taking bulk or overflow rows) is returned but not cached.
+    """
+    def __init__(self, scheduler, cache=None, fast_path=None):
+        self.scheduler = scheduler
+        self.cache = cache if cache is not None else ResultCache()
+        # Optional FastPath: rule-based answers for calls that never reached a person
+        self.fast_path = fast_path
+        self.identity = backend_identity(scheduler.backend)
+        self._inflight = {}
+        # Re-entrant: cancelling the leader runs _finish on the same thread
+        self._inflight_lock = threading.RLock()
+
+    def submit(self, transcript, current_date=None, on_partial=None, use_cache=True, deadline=None, lane=INTERACTIVE) -> Future:
+        if current_date is None: current_date = str(date.today())
+        if self.fast_path is not None:
+            hit = self.fast_path.classify(transcript, current_date)
+            if hit is not None:
+                rule, result = hit
+                fut = Future()
+                fut.timings = {"fast_path": rule, "rules_version": self.fast_path.version}
+                fut.set_result(result)
+                return fut
+        key = cache_key(transcript, current_date, *self.identity)
+        if use_cache and self.cache.enabled:
+            hit = self.cache.get(key)
+            if hit is not None:
+                fut = Future()
+                fut.timings = {"cache_hit": True}
+                fut.set_result(hit)
+                return fut
+
+        # Streaming requests need their own generation to get field callbacks
+        if on_partial is not None:
+            fut = self.scheduler.submit(transcript, current_date, on_partial=on_partial, deadline=deadline, lane=lane)
+            fut.add_done_callback(lambda f: self._store(key, f))
+            return fut
+
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            if entry is not None and entry.can_join(deadline, lane):
+                SINGLEFLIGHT_JOINED.inc()
+                return self._follow(entry)
+            entry = _InFlight(self.scheduler.submit(transcript, current_date, deadline=deadline, lane=lane), deadline, lane)
+            self._inflight[key] = entry
+            follower = self._follow(entry)
+        entry.leader.add_done_callback(lambda f: self._finish(key, entry, f))
+        return follower
+
+    def _follow(self, entry):
+        """Per-caller future mirroring the shared leader (call with `_inflight_lock` held)."""
+        fut = Future()
+        entry.waiters += 1
+
+        def relay(leader):
+            if not fut.set_running_or_notify_cancel():
+                return
+            if leader.cancelled():
+                fut.set_exception(RuntimeError("Request was cancelled"))
+            elif leader.exception() is not None:
+                fut.set_exception(leader.exception())
+            else:
+                fut.timings = getattr(leader, "timings", None)
+                fut.set_result(leader.result())
+
+        def on_follower_done(f):
+            # Cancel the shared generation only once every caller has given up on it
+            if f.cancelled():
+                with self._inflight_lock:
+                    entry.waiters -= 1
+                    if entry.waiters == 0:
+                        entry.leader.cancel()
+
+        fut.add_done_callback(on_follower_done)
+        entry.leader.add_done_callback(relay)
+        return fut
+
+    def _finish(self, key, entry, fut):
+        # Store before dropping the in-flight entry so a late duplicate finds one or the other
+        self._store(key, fut)
+        with self._inflight_lock:
+            # A caller with a later deadline may have replaced this entry meanwhile
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+
+    def _store(self, key, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        # Set by ModelPool: the replica that answered, when it may not be the keyed one
+        backend = getattr(fut, "backend", None)
+        if backend is not None and backend_identity(backend) != self.identity:
+            return
+        if self.cache.enabled:
+            self.cache.put(key, fut.result())
+
+    def predict(self, transcript, current_date=None, timeout=None, use_cache=True, deadline=None):
+        """Blocking helper with the same signature as `DispositionModel.predict`."""
+        return self.submit(transcript, current_date, use_cache=use_cache, deadline=deadline).result(timeout=timeout)
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+from datetime import date
+
+from partial_json import PartialJsonParser
+
+# =========================
+# CONFIG
+# =========================
+# Fake GPU cost: a fixed per-batch overhead plus a per-row cost, so batching gains are visible.
+STUB_BATCH_LATENCY_MS = float(os.getenv("STUB_BATCH_LATENCY_MS", "200"))
+STUB_ITEM_LATENCY_MS = float(os.getenv("STUB_ITEM_LATENCY_MS", "20"))
+
+
+class StubDispositionModel:
+    """Deterministic CPU stand-in for `DispositionModel`.
+
+    Exposes the same `predict` / `predict_batch` contract but never touches torch,
+    so the scheduler and the HTTP layer can be exercised on a machine without a GPU.
+    """
+    def __init__(self, batch_latency_ms=STUB_BATCH_LATENCY_MS, item_latency_ms=STUB_ITEM_LATENCY_MS):
+        self.lock = threading.Lock()
+        self.batch_latency_s = batch_latency_ms / 1000.0
+        self.item_latency_s = item_latency_ms / 1000.0
+        self.device = "cpu"
+        self.model_id = "stub"
+        self.prompt_version = "stub"
+        print(f"Using stub backend ({batch_latency_ms}ms/batch + {item_latency_ms}ms/item)")
+
+    def _fake_result(self, transcript, current_date):
+        lower_t = str(transcript).lower()
+        result = {
+            "disposition": "ANSWERED",
+            "payment_disposition": None,
+            "reason_for_not_paying": None,
+            "ptp_details": {"amount": None, "date": None},
+            "remarks": "stub prediction",
+            "confidence_score": 0.5,
+        }
+        if "switched off" in lower_t or "switch off" in lower_t:
+            result["disposition"] = "SWITCHED_OFF"
+        elif "pay" in lower_t or "dunga" in lower_t:
+            result["payment_disposition"] = "PTP"
+            result["ptp_details"]["date"] = current_date
+        return result
+
+    def predict_batch(self, items, timings=None):
+        with self.lock:
+            delay = self.batch_latency_s + self.item_latency_s * len(items)
+            time.sleep(delay)
+            if timings is not None:
+                timings.update({"stages": {"decode": delay}, "rows": [{} for _ in items]})
+            return [self._fake_result(t, d or str(date.today())) for t, d in items]
+
+    def predict_stream(self, transcript, current_date, on_partial, timings=None):
+        with self.lock:
+            started = time.perf_counter()
+            result = self._fake_result(transcript, current_date or str(date.today()))
+            text = json.dumps(result)
+            # Spread the fake generation time over small chunks, like tokens arriving
+            chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+            delay = (self.batch_latency_s + self.item_latency_s) / len(chunks)
+            parser = PartialJsonParser()
+            for chunk in chunks:
+                time.sleep(delay)
+                fields = parser.feed(chunk)
+                if fields:
+                    on_partial(fields)
+            if timings is not None:
+                timings.update({"stages": {"decode": time.perf_counter() - started}, "rows": [{}]})
+            return result
+
+    def predict(self, transcript, current_date=None):
+        return self.predict_batch([(transcript, current_date)])[0]
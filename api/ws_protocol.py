@@ -0,0 +1,85 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # optional: only the v2 MessagePack encoding needs it
+    msgpack = None
+
+# /ws protocol versions, negotiated on connect through Sec-WebSocket-Protocol
+# (or ?v=2&encoding=msgpack for clients that cannot set subprotocols):
+#   v1  one {"transcript", ...} JSON message per request, one result frame per message
+#   v2  {"items": [{"id", "transcript", ...}, ...]} per frame; results come back in
+#       completion order as {"results": [{"id", ...}, ...]}, several per frame when
+#       they finish together (e.g. in the same model batch)
+SUBPROTOCOLS = {
+    "disposition.v1": (1, "json"),
+    "disposition.v2.json": (2, "json"),
+    "disposition.v2.msgpack": (2, "msgpack"),
+}
+ENCODINGS = ("json", "msgpack")
+# Per-item fields; the same keys at frame level are defaults for every item
+ITEM_DEFAULTS = ("current_date", "use_cache", "deadline_ms", "debug")
+
+
+class ProtocolError(ValueError):
+    """A v2 frame that cannot be processed; answered with a frame-level error."""
+
+
+def available_encodings():
+    return [e for e in ENCODINGS if e != "msgpack" or msgpack is not None]
+
+
+def negotiate(offered, query):
+    """Pick (version, encoding, subprotocol) for a new connection.
+
+    `offered` is the client's Sec-WebSocket-Protocol list in preference order; the
+    first supported one wins. Without one, `query` (?v=, ?encoding=) decides and the
+    default is v1 JSON, so existing clients are unaffected.
+    """
+    for name in offered:
+        if name in SUBPROTOCOLS:
+            version, encoding = SUBPROTOCOLS[name]
+            if encoding in available_encodings():
+                return version, encoding, name
+    version = 2 if str(query.get("v", "1")) == "2" else 1
+    encoding = query.get("encoding", "json") if version == 2 else "json"
+    if encoding not in available_encodings():
+        raise ProtocolError(f"Unsupported encoding {encoding!r} (available: {', '.join(available_encodings())})")
+    return version, encoding, None
+
+
+def decode(message, encoding):
+    """Payload of a received ASGI websocket message (text frames are always JSON)."""
+    if message.get("text") is not None:
+        return json.loads(message["text"])
+    if encoding == "msgpack":
+        return msgpack.unpackb(message.get("bytes") or b"", raw=False)
+    return json.loads(message.get("bytes") or b"")
+
+
+def encode(payload, encoding):
+    """(text, bytes) for one outgoing frame; exactly one of them is set."""
+    if encoding == "msgpack":
+        return None, msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str), None
+
+
+def frame_items(frame, max_items):
+    """The items of a v2 frame with frame-level defaults applied.
+
+    Raises ProtocolError for a malformed frame; per-item problems (missing id,
+    empty transcript) are left to the caller so they are answered per item.
+    """
+    if not isinstance(frame, dict) or not isinstance(frame.get("items"), list):
+        raise ProtocolError('v2 frames must be an object with an "items" array')
+    items = frame["items"]
+    if len(items) > max_items:
+        raise ProtocolError(f"Too many items in one frame ({len(items)} > {max_items})")
+    defaults = {k: frame[k] for k in ITEM_DEFAULTS if k in frame}
+    out = []
+    for item in items:
+        if isinstance(item, dict):
+            out.append({**defaults, **item})
+        else:
+            out.append({**defaults, "id": None, "error": "items must be objects"})
+    return out
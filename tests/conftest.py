@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service modules import each other flat (`from scheduler import ...`), as api/app.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
@@ -0,0 +1,115 @@
+import time
+
+import pytest
+
+import gpu_telemetry
+from batch_sizing import BatchSizeController, is_oom
+from gpu_telemetry import MB, FakeTelemetry
+from scheduler import BatchScheduler, BULK
+
+from test_scheduler import prediction
+
+
+class OutOfMemoryError(RuntimeError):
+    """Same name as torch.cuda.OutOfMemoryError, which is what is_oom() looks for."""
+
+
+class OomBackend:
+    """A CUDA-looking backend that runs out of memory above `max_rows` rows (or on "huge")."""
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.attempts = []
+
+    def memory_profile(self):
+        # 1 MiB per transcript token, nothing else
+        return {"device": "cuda:0", "kv_bytes_per_token": MB // 2, "prefill_bytes_per_token": MB // 2,
+                "fixed_tokens": 0, "row_bytes": 0}
+
+    def estimate_tokens(self, transcript):
+        return 10
+
+    def predict_batch(self, items, timings=None):
+        self.attempts.append(len(items))
+        if len(items) > self.max_rows or any(t == "huge" for t, _ in items):
+            raise OutOfMemoryError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return [prediction(t) for t, _ in items]
+
+
+@pytest.fixture
+def telemetry(monkeypatch):
+    # What GPU_TELEMETRY=fake selects, installed as the process-wide provider
+    fake = FakeTelemetry(total_mb=16384, free_mb=8192)
+    monkeypatch.setattr(gpu_telemetry, "_telemetry", fake)
+    return fake
+
+
+def make(backend, **kw):
+    kw = {"max_batch_size": 8, "max_wait_ms": 5, "length_buckets": [], **kw}
+    scheduler = BatchScheduler(backend, **kw)
+    assert scheduler._memory is not None
+    return scheduler
+
+
+def run(scheduler, transcripts):
+    futures = [scheduler.submit(t, lane=BULK) for t in transcripts]
+    scheduler.start()
+    try:
+        return [f.result(timeout=5) for f in futures]
+    finally:
+        scheduler.stop(1)
+
+
+def test_oom_batch_is_halved_and_rerun(telemetry):
+    backend = OomBackend(max_rows=2)
+    scheduler = make(backend)
+    results = run(scheduler, [f"call {i}" for i in range(8)])
+    assert [r["remarks"] for r in results] == [f"call {i}" for i in range(8)]
+    assert backend.attempts == [8, 4, 2, 2, 4, 2, 2]
+    # One backoff per failed attempt, each handing cached blocks back first
+    assert scheduler._memory.scale == pytest.approx(scheduler._memory.backoff ** 3)
+    assert telemetry.released == 3
+
+
+def test_budget_backs_off_and_grows_back(telemetry):
+    controller = BatchSizeController.for_backend(OomBackend(max_rows=1))
+    controller.recovery_batches, controller.recovery_step = 2, 0.25
+    full = controller.budget()
+    assert full == pytest.approx(8192 * MB * controller.utilization - controller.reserve)
+    controller.on_oom(8)
+    assert controller.scale == controller.backoff
+    assert controller.budget() == pytest.approx(full * controller.backoff)
+    scales = []
+    for _ in range(6):
+        controller.on_success()
+        scales.append(controller.scale)
+    assert scales == [0.5, 0.75, 0.75, 1.0, 1.0, 1.0]
+
+
+def test_batches_stop_growing_at_free_memory(telemetry):
+    # 10 tokens per row at 1 MiB per token: 40 MiB free fits 4 rows
+    telemetry.free_mb = 40
+    backend = OomBackend(max_rows=8)
+    scheduler = make(backend)
+    scheduler._memory.utilization, scheduler._memory.reserve = 1.0, 0.0
+    run(scheduler, [f"call {i}" for i in range(8)])
+    assert backend.attempts == [4, 4]
+
+
+def test_single_row_oom_fails_that_request_and_the_worker_lives_on(telemetry):
+    backend = OomBackend(max_rows=8)
+    scheduler = make(backend).start()
+    try:
+        huge = scheduler.submit("huge")
+        with pytest.raises(OutOfMemoryError) as e:
+            huge.result(timeout=5)
+        assert is_oom(e.value)
+        time.sleep(0.05)
+        assert scheduler.submit("small").result(timeout=5)["remarks"] == "small"
+    finally:
+        scheduler.stop(1)
+    assert backend.attempts == [1, 1]
+
+
+def test_no_telemetry_means_no_controller(monkeypatch):
+    monkeypatch.setattr(gpu_telemetry, "_telemetry", False)
+    assert BatchSizeController.for_backend(OomBackend(max_rows=1)) is None
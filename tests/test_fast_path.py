@@ -0,0 +1,94 @@
+import pytest
+
+from fast_path import DEFAULT_FAST_PATH_RULES, FastPath
+from postprocess import clean_output
+from schema import DispositionResponse
+
+SYSTEM_MESSAGES = [
+    ("Agent: Hello? The number you are calling is switched off, please try again later.", "switched_off"),
+    ("Agent: Hello? Aap jis number par call kar rahe hain woh abhi switch off hai.", "switched_off"),
+    ("Agent: Hello? The number you are calling is not reachable at the moment.", "out_of_network"),
+    ("Agent: Hello? Aapka dial kiya hua number network kshetra se bahar hai.", "out_of_network"),
+    ("Agent: Hello? The number you are calling is busy, please try again later.", "busy"),
+    ("Agent: Hello? Aap jis number par call kar rahe hain woh abhi vyast hai, kripya baad mein call karein.", "busy"),
+    ("Agent: Hello? Hello? [ringing]", "ringing"),
+]
+
+# Live calls: someone answered, whatever words they used
+LIVE_CALLS = [
+    "Salary nahi aayi, waiting hai, 10 tarik ko de dunga",
+    "Main abhi another call par hoon, shaam ko 2000 de dunga",
+    "Abhi busy hoon, baad mein baat karte hain",
+    "Agent: Hello sir? Borrower: Haan, dusra phone switched off hai, isi pe baat karo.",
+    "Agent: Hello? Customer: Hello, haan bolo. Network issue tha, not reachable tha main.",
+    "Agent: Hello, phone ringing tha, aapne pick nahi kiya. Borrower: Haan bolo.",
+    "Agent: Hello? Borrower: Vyast hoon, waiting on another call.",
+    # A bare "ringing" is not an operator message
+    "Agent: Hello? Phone ringing, ringing...",
+]
+
+# A system message plus a phrase clean_output ranks higher: the fast path must not
+# answer with the lower-precedence disposition
+MIXED = [
+    "Agent: Hello? The number you are calling is busy. Number nahi lag raha.",
+    "Agent: Hello? The number you are calling is busy, out of reach.",
+    "Agent: Hello? The number you are calling is not reachable. Switch off hai shayad.",
+    "Agent: Hello? Hello? [ringing] The number you are calling is busy.",
+    "Agent: Hello? Phone is ringing. Kshetra se bahar hai.",
+]
+
+
+@pytest.fixture(scope="module")
+def fast_path():
+    return FastPath(DEFAULT_FAST_PATH_RULES)
+
+
+@pytest.mark.parametrize("transcript,rule", SYSTEM_MESSAGES)
+def test_system_messages_hit(fast_path, transcript, rule):
+    hit = fast_path.classify(transcript)
+    assert hit is not None and hit[0] == rule
+
+
+@pytest.mark.parametrize("transcript", LIVE_CALLS)
+def test_live_calls_go_to_the_model(fast_path, transcript):
+    assert fast_path.classify(transcript) is None
+
+
+@pytest.mark.parametrize("transcript", [t for t, _ in SYSTEM_MESSAGES] + LIVE_CALLS + MIXED)
+def test_same_disposition_as_the_model_path(fast_path, transcript):
+    hit = fast_path.classify(transcript, "2024-01-01")
+    if hit is None:
+        return
+    # Whatever the model answers, clean_output's system-message overrides decide these calls
+    for answer in ("ANSWERED", "CALL_BACK_LATER"):
+        model = clean_output({"disposition": answer, "payment_disposition": None}, transcript, "2024-01-01")
+        assert model["disposition"] == hit[1]["disposition"]
+
+
+@pytest.mark.parametrize("transcript", MIXED)
+def test_higher_precedence_phrases_win(fast_path, transcript):
+    hit = fast_path.classify(transcript)
+    expected = clean_output({"disposition": "ANSWERED"}, transcript, None)["disposition"]
+    assert hit is None or hit[1]["disposition"] == expected
+
+
+def test_result_is_a_normalized_response(fast_path):
+    _, result = fast_path.classify(SYSTEM_MESSAGES[0][0], "2024-01-01")
+    assert result == DispositionResponse(**result).model_dump()
+    assert result["payment_disposition"] == clean_output({"payment_disposition": None}, "", None)["payment_disposition"]
+    assert result["ptp_details"] == {"amount": None, "date": None}
+
+
+def test_rule_overridden_by_clean_output_defers_to_the_model():
+    config = {**DEFAULT_FAST_PATH_RULES, "rules": [
+        {"name": "bad", "disposition": "BUSY", "require": ["system_busy"], "confidence": 0.95},
+    ]}
+    assert FastPath(config).classify("Agent: The number you are calling is busy. Switch off tha.") is None
+
+
+def test_rules_use_only_fast_path_categories():
+    # clean_output's hint lists ("busy", "switched_off", ...) contain words people say on
+    # live calls; every rule must also require an operator-wording category
+    own = set(DEFAULT_FAST_PATH_RULES["keywords"])
+    for rule in DEFAULT_FAST_PATH_RULES["rules"]:
+        assert any(c.startswith("system_") and c in own for c in rule["require"]), rule["name"]
@@ -0,0 +1,201 @@
+import io
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import pytest
+
+import jobs
+from jobs import JobManager
+
+
+def resolved(value=None, error=None):
+    fut = Future()
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(value)
+    return fut
+
+
+def prediction(transcript):
+    return {"disposition": "ANSWERED", "payment_disposition": None, "reason_for_not_paying": None,
+            "ptp_details": {"amount": None, "date": None}, "remarks": transcript, "confidence_score": 0.5}
+
+
+class CountingSubmit:
+    def __init__(self, fail=None):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        # transcript -> failures to raise before answering
+        self.fail = dict(fail or {})
+
+    def __call__(self, transcript, current_date=None):
+        with self.lock:
+            self.calls[transcript] += 1
+            if self.fail.get(transcript, 0) > 0:
+                self.fail[transcript] -= 1
+                return resolved(error=RuntimeError("worker crashed"))
+        return resolved(prediction(transcript))
+
+
+def upload(rows):
+    body = "transcript\n" + "".join(f"{r}\n" for r in rows)
+    return io.BytesIO(body.encode())
+
+
+def wait_for(manager, job_id, statuses=("completed", "failed"), timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = manager.status(job_id)
+        if status["status"] in statuses:
+            return status
+        time.sleep(0.02)
+    raise AssertionError(f"job stuck in {manager.status(job_id)['status']}")
+
+
+def test_job_runs_once_across_processes(tmp_path):
+    submits = [CountingSubmit(), CountingSubmit()]
+    managers = [JobManager(s, jobs_dir=str(tmp_path)) for s in submits]
+    rows = [f"call {i}" for i in range(100)]
+    job_id = managers[0].create("calls.csv", upload(rows))
+    # Every API process resumes the queued job on start-up; only one may claim it
+    for m in managers:
+        m.resume()
+    status = wait_for(managers[0], job_id)
+    assert status["status"] == "completed"
+    assert status["done_rows"] == status["total_rows"] == 100
+    total = submits[0].calls + submits[1].calls
+    assert all(total[r] == 1 for r in rows)
+    assert len(list(managers[1].iter_result(job_id))) == 101
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    manager = JobManager(CountingSubmit(), jobs_dir=str(tmp_path), lease_s=1)
+    job_id = manager.create("calls.csv", upload(["a", "b"]))
+    wait_for(manager, job_id)
+    # A job left "running" by a process that died
+    manager._execute(
+        "UPDATE jobs SET status = 'running', owner = 'dead:1', lease_until = ? WHERE id = ?", (time.time() + 0.5, job_id),
+    )
+    assert manager.resume() == 0
+    time.sleep(0.6)
+    assert manager.resume() == 1
+    assert wait_for(manager, job_id)["status"] == "completed"
+
+
+def test_lost_lease_stops_checkpoints(tmp_path):
+    manager = JobManager(CountingSubmit(), jobs_dir=str(tmp_path))
+    job_id = manager.create("calls.csv", upload(["a"]))
+    wait_for(manager, job_id)
+    manager._execute("UPDATE jobs SET status = 'running', owner = 'other', lease_until = ? WHERE id = ?", (time.time() + 60, job_id))
+    with pytest.raises(Exception, match="taken over"):
+        manager._checkpoint(job_id, [(job_id, 5, "{}")])
+    assert manager._execute("SELECT COUNT(*) AS n FROM job_results WHERE row_idx = 5")[0]["n"] == 0
+
+
+def test_lost_lease_cancels_rows_in_flight(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_IN_FLIGHT", 8)
+    monkeypatch.setattr(jobs, "JOB_CHECKPOINT_ROWS", 4)
+    pending = []
+
+    def submit(transcript, current_date=None):
+        idx = int(transcript.split()[1])
+        if idx == 9:
+            # Another process takes the job over; the next checkpoint finds out
+            manager._execute("UPDATE jobs SET owner = 'other' WHERE owner = ?", (manager.owner,))
+        if idx < 6:
+            return resolved(prediction(transcript))
+        pending.append(Future())
+        return pending[-1]
+
+    manager = JobManager(submit, jobs_dir=str(tmp_path))
+    job_id = manager.create("calls.csv", upload([f"call {i}" for i in range(20)]))
+    deadline = time.monotonic() + 5
+    while not (pending and all(f.cancelled() for f in pending)) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert len(pending) == 5 and all(f.cancelled() for f in pending)
+    assert manager.status(job_id)["status"] == "running"
+
+
+def test_errored_rows_are_retried(tmp_path):
+    submit = CountingSubmit(fail={"flaky": 2})
+    manager = JobManager(submit, jobs_dir=str(tmp_path), row_retries=2)
+    job_id = manager.create("calls.csv", upload(["ok", "flaky"]))
+    status = wait_for(manager, job_id)
+    assert status["status"] == "completed" and status["done_rows"] == 2
+    assert submit.calls["flaky"] == 3
+    assert "worker crashed" not in "".join(manager.iter_result(job_id))
+
+
+def test_row_failing_every_retry_fails_the_job(tmp_path):
+    submit = CountingSubmit(fail={"bad": 10})
+    manager = JobManager(submit, jobs_dir=str(tmp_path), row_retries=1)
+    job_id = manager.create("calls.csv", upload(["ok", "bad"]))
+    status = wait_for(manager, job_id)
+    assert status["status"] == "failed" and "worker crashed" in status["error"]
+    rows = manager._execute("SELECT row_idx FROM job_results WHERE job_id = ?", (job_id,))
+    assert [r["row_idx"] for r in rows] == [0]
+
+
+def test_submit_error_fails_the_job(tmp_path):
+    def submit(transcript, current_date=None):
+        raise RuntimeError("Model failed to load: no CUDA")
+
+    manager = JobManager(submit, jobs_dir=str(tmp_path))
+    job_id = manager.create("calls.csv", upload(["a"]))
+    status = wait_for(manager, job_id)
+    assert status["status"] == "failed" and "Model failed to load" in status["error"]
+
+
+def test_rows_are_streamed_from_the_stored_upload(tmp_path, monkeypatch):
+    # Every read pass over the input, and how far it had got when each row was submitted
+    passes, lag = [], []
+    load = jobs.load_job_rows
+
+    def tracked(path, kind):
+        passes.append(0)
+        for row in load(path, kind):
+            passes[-1] += 1
+            yield row
+
+    submit = CountingSubmit()
+
+    def tracking_submit(transcript, current_date=None):
+        lag.append(passes[-1] - int(transcript.split()[1]))
+        return submit(transcript, current_date)
+
+    monkeypatch.setattr(jobs, "load_job_rows", tracked)
+    manager = JobManager(tracking_submit, jobs_dir=str(tmp_path))
+    job_id = manager.create("calls.csv", upload([f"call {i}" for i in range(500)]))
+    status = wait_for(manager, job_id)
+    assert status["status"] == "completed" and status["total_rows"] == 500
+    # A counting pass, then one row read ahead of each submission
+    assert passes == [500, 500] and max(lag) == 1
+
+
+def test_resumed_job_only_runs_missing_rows(tmp_path):
+    submit = CountingSubmit()
+    manager = JobManager(submit, jobs_dir=str(tmp_path))
+    rows = [f"call {i}" for i in range(50)]
+    job_id = manager.create("calls.csv", upload(rows))
+    wait_for(manager, job_id)
+    # Forget the second half, as if the process died before checkpointing it
+    manager._execute("DELETE FROM job_results WHERE job_id = ? AND row_idx >= 25", (job_id,))
+    manager._execute("UPDATE jobs SET status = 'running', owner = NULL WHERE id = ?", (job_id,))
+    assert manager.resume() == 1
+    assert wait_for(manager, job_id)["done_rows"] == 50
+    assert [submit.calls[r] for r in rows] == [1] * 25 + [2] * 25
+
+
+def test_empty_and_nan_cells_become_error_rows(tmp_path):
+    submit = CountingSubmit()
+    manager = JobManager(submit, jobs_dir=str(tmp_path))
+    body = '{"transcript": "call 0"}\n{"transcript": NaN}\n{"transcript": null}\n{"transcript": "  "}\n{"transcript": "call 4"}\n'
+    job_id = manager.create("calls.jsonl", io.BytesIO(body.encode()), output_format="jsonl")
+    assert wait_for(manager, job_id)["status"] == "completed"
+    rows = [json.loads(line) for line in manager.iter_result(job_id)]
+    assert [r.get("error") for r in rows] == [None, "Transcript is empty", "Transcript is empty", "Transcript is empty", None]
+    assert "nan" not in submit.calls and set(submit.calls) == {"call 0", "call 4"}
@@ -0,0 +1,85 @@
+import random
+
+from keywords import KEYWORD_RULES, KeywordMatcher, TRANSCRIPT_KEYWORDS
+
+# The inline keyword lists of DispositionModel.clean_output before they moved into
+# KEYWORD_RULES. clean_output must keep giving exactly these answers, so a rule-table
+# edit that changes one of them has to change this copy too.
+ORIGINAL_CLEAN_OUTPUT_KEYWORDS = {
+    "agent_asking_for_borrower": ["se baat", "se baat ho", "bol raha hoon", "bol rahi hoon", "speaking"],
+    "family": ["beta", "beti", "pati", "patni", "bhai", "bhabhi", "devar", "son", "daughter",
+               "wife", "husband", "brother", "sister", "ghar pe nahi", "ghar par nahi",
+               "abhi nahi hain", "at home nahi", "not at home", "nahi hain", "ghar mein nahi"],
+    "switched_off": ["switched off", "switch off", "out of reach", "band aa raha", "switch-off", "nahi lag raha"],
+    "out_of_network": ["not reachable", "out of network", "network area", "kshetra se bahar"],
+    "busy": ["busy", "another call", "vyast", "waiting"],
+    "ringing": ["ringing", "bell", "ghanti"],
+    "pick": ["pick"],
+    "hello": ["hello"],
+    "paid": ["paid", "kattesa", "kattida", "kattivi", "adachu", "jama", "pay kar diya", "bhar diya", "done"],
+    "will": ["will"],
+    "pay": ["pay"],
+    "marathi_ptp": ["pudhchya", "pudhcha", "deu shakto", "udya", "पुढच्या", "देऊ शकतो", "उद्या", "करतो", "karel"],
+    "visit_trigger": ["വീട്ടിലേക്ക്", "വീട്ടിൽ", "வீட்டிற்கு", "இல்லத்திற்கு", "మనెగె", "ఇంటికి", "ghar pe aao", "home visit", "collector"],
+    "visit": ["ghar", "home", "visit", "bhej", "collector", "pickup", "pick up", "address", "location", "dikkat",
+              "call cut", "milne", "വീട്ടിലേക്ക്", "വീട്ടിൽ", "வீட்டிற்கு", "ఇంటికి", "ಮನೆಗೆ"],
+    "medical": ["medical", "hospital", "doctor", "health", "bimari", "ilaj", "accident", "emergency", "operation",
+                "treat", "ആശുപത്രി", "അസുഖം", "மருத்துவம்", "వైద్యం", "ಆಸ್ಪತ್ರೆ"],
+    "job": ["work", "job", "வேலை", "ఉద్యోగం", "ಕೆಲಸ", "ജോലി", "unemployed", "nauki", "kaam", "business"],
+    "job_lost": ["loss", "poyi", "vela", "hogide", "poyindi", "nahi"],
+    "parso": ["parso"],
+    "kal": ["kal"],
+    "commitment": ["pay", "paid", "amount", "rupaye", "kal", "aaj", "parso", "tarikh", "send", "karunga", "dena"],
+    "non_committal": ["sochunga", "dekhunga"],
+}
+
+
+def original_scan(lower_text, category):
+    """The loop clean_output used to run for every check."""
+    return any(kw in lower_text for kw in ORIGINAL_CLEAN_OUTPUT_KEYWORDS[category])
+
+
+def random_texts(n, seed=0):
+    keywords = sorted({kw for kws in ORIGINAL_CLEAN_OUTPUT_KEYWORDS.values() for kw in kws})
+    filler = ["hi", "ok", "sir", "5000", "2026-01-29", "haan", "ji", "x"]
+    rng = random.Random(seed)
+    for _ in range(n):
+        words = [rng.choice(keywords + filler) for _ in range(rng.randint(0, 8))]
+        # Glue some words together so keywords also appear inside and across other words
+        text = "".join(w + rng.choice([" ", "", "-"]) for w in words)
+        yield text.lower()
+
+
+def test_clean_output_categories_unchanged():
+    for category, keywords in ORIGINAL_CLEAN_OUTPUT_KEYWORDS.items():
+        assert set(KEYWORD_RULES[category]) == set(keywords), category
+
+
+def test_matches_original_scan():
+    categories = list(ORIGINAL_CLEAN_OUTPUT_KEYWORDS)
+    rng = random.Random(1)
+    for text in random_texts(20000):
+        hits = TRANSCRIPT_KEYWORDS.scan(text)
+        # Memoized keywords depend on what was asked before, so ask in a random order
+        order = rng.sample(categories, len(categories))
+        for category in order:
+            assert hits.has(category) == original_scan(text, category), (text, category)
+
+
+def test_categories_matches_original_scan():
+    for text in random_texts(2000, seed=2):
+        expected = {c for c in ORIGINAL_CLEAN_OUTPUT_KEYWORDS if original_scan(text, c)}
+        assert TRANSCRIPT_KEYWORDS.scan(text).categories() & set(ORIGINAL_CLEAN_OUTPUT_KEYWORDS) == expected
+
+
+def test_implied_substrings():
+    matcher = KeywordMatcher({"short": ["nahi"], "long": ["ghar pe nahi"], "other": ["se baat ho"], "sub": ["se baat"]})
+    hits = matcher.scan("papa ghar pe nahi hain")
+    assert hits.has("long")
+    # Implied by "ghar pe nahi" without a second search
+    assert hits._keywords["nahi"] is True
+    assert hits.has("short")
+    hits = matcher.scan("kaun bol raha hai")
+    assert not hits.has("sub")
+    assert hits._keywords["se baat ho"] is False
+    assert not hits.has("other")
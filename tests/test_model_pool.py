@@ -0,0 +1,68 @@
+from model_pool import ModelPool
+from scheduler import BatchScheduler, BULK, QueueFull
+
+from test_scheduler import FakeBackend
+
+
+def replicas(count, name="gpu", latency_s=0.02, **kw):
+    return [BatchScheduler(FakeBackend(latency_s), name=f"{name}{i}", max_batch_size=4, max_wait_ms=5, **kw)
+            for i in range(count)]
+
+
+def test_requests_spread_over_the_least_loaded_replicas():
+    pool = ModelPool(replicas(3)).start()
+    try:
+        futures = [pool.submit(f"call {i}") for i in range(60)]
+        assert [f.result(timeout=10)["remarks"] for f in futures] == [f"call {i}" for i in range(60)]
+    finally:
+        pool.stop(1)
+    served = [sum(map(len, r.backend.batches)) for r in pool.replicas]
+    assert sum(served) == 60 and min(served) >= 15
+
+
+def test_a_busy_replica_gets_no_new_work():
+    slow, fast = replicas(2)
+    pool = ModelPool([slow, fast])
+    # A backlog on one replica (not started, so it stays queued)
+    for i in range(5):
+        slow.submit(f"backlog {i}")
+    fast.start()
+    try:
+        futures = [pool.submit(f"call {i}") for i in range(4)]
+        for f in futures:
+            f.result(timeout=5)
+    finally:
+        fast.stop(1)
+    assert sum(map(len, fast.backend.batches)) == 4
+    assert slow.qsize() == 5
+
+
+def test_bulk_and_overflow_go_to_cpu_replicas():
+    gpu, cpu = replicas(1), replicas(1, name="cpu")
+    pool = ModelPool(gpu, cpu, routing={"bulk", "overflow"}, overflow_load=2, cpu_max_load=8)
+    bulk = pool.submit("upload row", lane=BULK)
+    assert cpu[0].qsize() == 1 and gpu[0].qsize() == 0
+    pool.submit("live 0")
+    pool.submit("live 1")
+    # The GPU replica is at overflow_load: the next live request spills over
+    pool.submit("live 2")
+    assert gpu[0].qsize() == 2 and cpu[0].qsize() == 2
+    pool.start()
+    try:
+        assert bulk.result(timeout=5)["remarks"] == "upload row"
+    finally:
+        pool.stop(1)
+
+
+def test_full_replica_spills_to_cpu_or_raises():
+    gpu = replicas(1, max_queue=1)
+    pool = ModelPool(gpu, replicas(1, name="cpu"), routing={"overflow"}, overflow_load=100, cpu_max_load=1)
+    pool.submit("fills the queue")
+    pool.submit("spills to the cpu")
+    assert pool.cpu_replicas[0].qsize() == 1
+    try:
+        pool.submit("nowhere to go")
+    except QueueFull:
+        pass
+    else:
+        raise AssertionError("expected QueueFull once the CPU replica is at cpu_max_load")
@@ -0,0 +1,189 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import BatchScheduler, BULK, INTERACTIVE
+
+
+def prediction(transcript):
+    return {"disposition": "ANSWERED", "payment_disposition": None, "reason_for_not_paying": None,
+            "ptp_details": {"amount": None, "date": None}, "remarks": transcript, "confidence_score": 0.5}
+
+
+class FakeBackend:
+    """Answers instantly and records every batch; a transcript's token count is its length."""
+    def __init__(self, latency_s=0.0):
+        self.latency_s = latency_s
+        self.batches = []
+        self.streams = []
+        self.tokenized_on = set()
+        self.lock = threading.Lock()
+
+    def estimate_tokens(self, transcript):
+        if transcript == "untokenizable":
+            raise ValueError("bad transcript")
+        self.tokenized_on.add(threading.current_thread().name)
+        return len(transcript)
+
+    def predict_batch(self, items, timings=None):
+        time.sleep(self.latency_s)
+        with self.lock:
+            self.batches.append([t for t, _ in items])
+        return [prediction(t) for t, _ in items]
+
+    def predict_stream(self, transcript, current_date, on_partial, timings=None):
+        time.sleep(self.latency_s)
+        with self.lock:
+            self.streams.append(transcript)
+        result = prediction(transcript)
+        on_partial({"disposition": result["disposition"]})
+        return result
+
+
+def make(backend, **kw):
+    kw = {"max_batch_size": 4, "max_wait_ms": 5, "length_buckets": [10], "bucket_max_wait_ms": 10_000, **kw}
+    return BatchScheduler(backend, **kw)
+
+
+class CountingTake:
+    def __init__(self, scheduler):
+        self.calls = 0
+        self.take = scheduler._take
+        scheduler._take = self
+
+    def __call__(self, now, expired):
+        self.calls += 1
+        return self.take(now, expired)
+
+
+def test_batches_form_within_a_length_bucket():
+    backend = FakeBackend()
+    scheduler = make(backend)
+    short, long = ["s" * 5 + str(i) for i in range(3)], ["l" * 20 + str(i) for i in range(3)]
+    futures = [scheduler.submit(t, lane=BULK) for pair in zip(short, long) for t in pair]
+    scheduler.start()
+    try:
+        assert [f.result(timeout=5)["remarks"] for f in futures] == [t for pair in zip(short, long) for t in pair]
+    finally:
+        scheduler.stop(1)
+    assert sorted(map(sorted, backend.batches)) == [sorted(long), sorted(short)]
+
+
+def test_streaming_head_of_the_fullest_bucket_does_not_stall():
+    # The oldest request is long; the fullest bucket (short) starts with a streaming
+    # request, which cannot join a batch. It must go out on its own, not stall the worker.
+    backend = FakeBackend()
+    scheduler = make(backend)
+    take = CountingTake(scheduler)
+    oldest = scheduler.submit("l" * 20)
+    partials = []
+    stream = scheduler.submit("s" * 5, on_partial=partials.append)
+    rest = [scheduler.submit("s" * 5 + str(i)) for i in range(3)]
+    started = time.monotonic()
+    scheduler.start()
+    try:
+        for f in [oldest, stream, *rest]:
+            f.result(timeout=5)
+    finally:
+        scheduler.stop(1)
+    assert time.monotonic() - started < 1.0
+    assert backend.streams == ["s" * 5] and partials == [{"disposition": "ANSWERED"}]
+    assert all("s" * 5 not in batch for batch in backend.batches)
+    assert take.calls < 10
+
+
+def test_idle_worker_blocks_instead_of_spinning():
+    backend = FakeBackend()
+    scheduler = make(backend)
+    take = CountingTake(scheduler)
+    scheduler.start()
+    try:
+        scheduler.submit("one").result(timeout=5)
+        time.sleep(0.2)
+        assert take.calls == 1
+    finally:
+        scheduler.stop(1)
+
+
+def test_lengths_are_estimated_on_the_worker_thread():
+    backend = FakeBackend()
+    scheduler = make(backend)
+    futures = [scheduler.submit(f"call {i}", lane=lane) for i, lane in enumerate([INTERACTIVE, BULK] * 5)]
+    scheduler.start()
+    try:
+        for f in futures:
+            f.result(timeout=5)
+    finally:
+        scheduler.stop(1)
+    assert backend.tokenized_on == {"batch-scheduler-0"}
+
+
+def test_failed_length_estimate_fails_only_that_request():
+    backend = FakeBackend()
+    scheduler = make(backend).start()
+    try:
+        bad = scheduler.submit("untokenizable")
+        with pytest.raises(ValueError):
+            bad.result(timeout=5)
+        assert scheduler.submit("fine").result(timeout=5)["remarks"] == "fine"
+        assert scheduler.qsize() == 0
+    finally:
+        scheduler.stop(1)
+
+
+def test_concurrent_requests_share_batches():
+    backend = FakeBackend(latency_s=0.05)
+    scheduler = make(backend, max_batch_size=8, max_wait_ms=20, length_buckets=[]).start()
+    try:
+        futures = [scheduler.submit(f"call {i}") for i in range(40)]
+        assert [f.result(timeout=5)["remarks"] for f in futures] == [f"call {i}" for i in range(40)]
+    finally:
+        scheduler.stop(1)
+    assert max(map(len, backend.batches)) == 8
+    assert len(backend.batches) <= 10
+
+
+def test_full_interactive_queue_sheds_but_bulk_queues():
+    from scheduler import QueueFull
+    scheduler = make(FakeBackend(), max_queue=3)
+    for i in range(3):
+        scheduler.submit(f"call {i}")
+    with pytest.raises(QueueFull) as e:
+        scheduler.submit("one too many")
+    assert e.value.retry_after >= 1
+    scheduler.submit("upload row", lane=BULK)
+    assert scheduler.qsize() == 4
+
+
+def test_expired_requests_never_reach_the_model():
+    from scheduler import DeadlineExceeded
+    backend = FakeBackend()
+    scheduler = make(backend)
+    late = scheduler.submit("late", deadline=time.monotonic() - 1)
+    on_time = scheduler.submit("on time", deadline=time.monotonic() + 60)
+    scheduler.start()
+    try:
+        with pytest.raises(DeadlineExceeded):
+            late.result(timeout=5)
+        assert on_time.result(timeout=5)["remarks"] == "on time"
+    finally:
+        scheduler.stop(1)
+    assert backend.batches == [["on time"]]
+
+
+def test_interactive_goes_first_but_bulk_keeps_its_share():
+    backend = FakeBackend()
+    scheduler = make(backend, max_batch_size=4, length_buckets=[], bulk_min_share=0.25)
+    bulk = [scheduler.submit(f"bulk {i}", lane=BULK) for i in range(8)]
+    live = [scheduler.submit(f"live {i}") for i in range(12)]
+    scheduler.start()
+    try:
+        for f in bulk + live:
+            f.result(timeout=5)
+    finally:
+        scheduler.stop(1)
+    assert all(t.startswith("live") for t in backend.batches[0])
+    # Bulk rows ride along before the interactive lane has drained
+    first_bulk = next(i for i, b in enumerate(backend.batches) if any(t.startswith("bulk") for t in b))
+    assert any(t.startswith("live") for b in backend.batches[first_bulk + 1:] for t in b)
@@ -0,0 +1,171 @@
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from schema import DispositionResponse, FIELD_LABELS, REQUIRED_FIELDS, CALL_LABELS, REASON_LABELS  # noqa: E402
+from schema_decoding import SchemaDecoder, VocabMasks, compile_schema  # noqa: E402
+from test_schema_trie import VOCAB, VALID, FAMILY, INVALID, FakeTokenizer  # noqa: E402
+
+
+class Output:
+    def __init__(self, logits, past_key_values):
+        self.logits = logits
+        self.past_key_values = past_key_values
+
+
+class FakeModel:
+    """Deterministic causal "model" that wants to write `targets[row]` after the prompt.
+
+    The next-token scores depend only on the visible (attention-masked) tokens: the
+    longest vocabulary token continuing the target scores highest, everything else gets
+    fixed junk scores. The "KV cache" is the list of tokens seen per row, so the test
+    also checks that position ids and attention masks line up with what was cached.
+    """
+    def __init__(self, tokenizer, prompt_lens, targets):
+        self.tokenizer = tokenizer
+        self.prompt_lens = prompt_lens
+        self.targets = targets
+        self.calls = 0
+
+    def scores(self, row, visible):
+        generated = self.tokenizer.decode(visible[self.prompt_lens[row]:])
+        target = self.targets[row]
+        rest = target[len(generated):] if target.startswith(generated) else None
+        out = []
+        for i, tok in enumerate(VOCAB):
+            if rest is not None and tok != "<pad>" and rest.startswith(tok):
+                out.append(10.0 + len(tok))
+            else:
+                out.append(((i * 7919 + len(visible) * 31) % 10) / 10.0)
+        return out
+
+    def __call__(self, input_ids, attention_mask, position_ids, past_key_values, use_cache, logits_to_keep=0):
+        self.calls += 1
+        new_ids, mask, positions = input_ids.tolist(), attention_mask.tolist(), position_ids.tolist()
+        past = past_key_values or [[] for _ in new_ids]
+        logits, cache = [], []
+        for row, (ids, pos) in enumerate(zip(new_ids, positions)):
+            tokens = past[row] + ids
+            assert len(tokens) == len(mask[row])
+            row_logits = []
+            for k in range(len(ids)):
+                p = len(past[row]) + k
+                visible = [tokens[q] for q in range(p + 1) if mask[row][q]]
+                if mask[row][p]:
+                    assert pos[k] == len(visible) - 1
+                row_logits.append(self.scores(row, visible))
+            logits.append(row_logits[-logits_to_keep:] if logits_to_keep else row_logits)
+            cache.append(tokens)
+        return Output(torch.tensor(logits, dtype=torch.float32), cache)
+
+
+class Timer:
+    def __init__(self):
+        self.stages = {}
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return FakeTokenizer()
+
+
+def make_decoder(tokenizer, max_string_tokens=24):
+    vocab = VocabMasks.from_tokenizer(tokenizer, device="cpu")
+    parts = compile_schema(DispositionResponse, FIELD_LABELS, REQUIRED_FIELDS)
+    return SchemaDecoder(tokenizer, parts, vocab, max_string_tokens)
+
+
+def run(decoder, tokenizer, prompts, targets, **kwargs):
+    """Left-pad the prompts, decode, and return (texts, rows, model)."""
+    encoded = [tokenizer(p)["input_ids"] for p in prompts]
+    width = max(map(len, encoded))
+    pad = tokenizer.pad_token_id
+    input_ids = torch.tensor([[pad] * (width - len(e)) + e for e in encoded], dtype=torch.long)
+    attention_mask = torch.tensor([[0] * (width - len(e)) + [1] * len(e) for e in encoded], dtype=torch.long)
+    model = FakeModel(tokenizer, [len(e) for e in encoded], targets)
+    outputs, rows = decoder.generate(model, input_ids, attention_mask, None, pad, Timer(), **kwargs)
+    return [tokenizer.decode(o) for o in outputs], rows, model
+
+
+# Wants numbers with leading zeros, which are not JSON
+LEADING_ZEROS = VALID.replace('"amount": 5000', '"amount": 005000').replace('"confidence_score": 0.95', '"confidence_score": 012')
+PROMPTS = ["Borrower: I lost my job, will pay next week 5000", "Agent: beta? Son: papa ghar pe nahi", "hm", "ok", "..."]
+
+
+def test_follows_the_model_where_the_schema_allows(tokenizer):
+    texts, _, _ = run(make_decoder(tokenizer), tokenizer, PROMPTS[:2], [VALID, FAMILY])
+    assert texts == [VALID, FAMILY]
+
+
+def test_output_is_valid_json_with_allowed_labels(tokenizer):
+    # The last row's target matches nothing, so every choice comes from the junk scores
+    texts, rows, _ = run(make_decoder(tokenizer), tokenizer, PROMPTS, [VALID, FAMILY, INVALID, LEADING_ZEROS, ""])
+    assert all(r.done for r in rows)
+    for text in texts:
+        out = json.loads(text)
+        assert list(out) == list(DispositionResponse.model_fields)
+        assert out["disposition"] in CALL_LABELS
+        assert out["payment_disposition"] is None or out["payment_disposition"] in FIELD_LABELS["payment_disposition"]
+        assert out["reason_for_not_paying"] is None or out["reason_for_not_paying"] in REASON_LABELS
+        assert out["ptp_details"]["amount"] is None or isinstance(out["ptp_details"]["amount"], (int, float))
+        assert isinstance(out["confidence_score"], (int, float))
+    # The row whose model wanted invalid values still produced a schema-valid answer
+    assert json.loads(texts[2])["disposition"] != "NONSENSE"
+
+
+def test_jump_forward_skips_forced_tokens(tokenizer):
+    texts, rows, model = run(make_decoder(tokenizer), tokenizer, PROMPTS[1:2], [FAMILY])
+    tokens = tokenizer(texts[0])["input_ids"]
+    row = rows[0]
+    # Keys, punctuation and the unique rest of a label are appended without a model step
+    assert model.calls < len(row.tokens) / 2
+    assert len(row.tokens) - row.sampled > len(row.tokens) / 2
+    assert len(tokens) <= len(row.tokens)
+
+
+def test_string_budget_closes_the_string(tokenizer):
+    long_remarks = VALID.replace("lost job, will pay next week", "x" * 40).replace('"2026-01-29"', "null")
+    texts, _, _ = run(make_decoder(tokenizer, max_string_tokens=5), tokenizer, PROMPTS[:1], [long_remarks])
+    out = json.loads(texts[0])
+    assert out["remarks"] == "x" * 5
+    # Decoding carries on with the fields after the cut string
+    assert '"remarks": "xxxxx", "confidence_score":' in texts[0]
+    assert isinstance(out["confidence_score"], (int, float))
+
+
+# Prompts the answers copy from, so prompt lookup has something to draft. The quote
+# after "next week" makes the draft propose '"' where the model picks the merged '",'.
+COPY_PROMPTS = [
+    'Borrower: "lost job, will pay next week" ok, 5000 on 2026-01-29',
+    "Agent: beta? Son: son picked up, papa ghar pe nahi",
+    "Borrower: x\\\"y nothing to say",
+]
+
+
+@pytest.mark.parametrize("lookup_tokens", [1, 3, 8])
+def test_prompt_lookup_matches_greedy_decoding(tokenizer, lookup_tokens):
+    decoder = make_decoder(tokenizer)
+    targets = [VALID, FAMILY, INVALID]
+    base, base_rows, base_model = run(decoder, tokenizer, COPY_PROMPTS, targets)
+    texts, rows, model = run(decoder, tokenizer, COPY_PROMPTS, targets, lookup_tokens=lookup_tokens, lookup_ngram=3)
+    assert [r.tokens for r in rows] == [r.tokens for r in base_rows]
+    assert texts == base
+    assert sum(r.accepted for r in rows) > 0
+    assert model.calls < base_model.calls
+    for row, base_row in zip(rows, base_rows):
+        assert row.sampled == base_row.sampled
+        # Accepted draft tokens are model picks, so never more than the sampled ones
+        assert row.accepted <= min(row.drafted, row.sampled)
+
+
+def test_forced_close_quote_is_not_an_accepted_draft(tokenizer):
+    decoder = make_decoder(tokenizer)
+    target = FAMILY.replace("son picked up", "ok")
+    # After "o" the draft is 'k', '"', ' ', 'z': the model picks 'k', then the merged '",'
+    # for which the schema emits the same '"' as the draft. Only 'k' was the model's choice.
+    _, rows, _ = run(decoder, tokenizer, ['ok" zzz'], [target], lookup_tokens=4, lookup_ngram=3)
+    _, plain, _ = run(decoder, tokenizer, ['ok" zzz'], [target])
+    assert rows[0].tokens == plain[0].tokens
+    assert rows[0].accepted == 1
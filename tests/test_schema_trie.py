@@ -0,0 +1,141 @@
+import json
+
+from schema import DispositionResponse, FIELD_LABELS, REQUIRED_FIELDS, CALL_LABELS
+from schema_decoding import (VOCAB_CLASSES, PromptLookup, SchemaDecoder, _TrieCursor, accepts_logits_to_keep,
+                             build_trie, compile_schema)
+
+# A tiny BPE-like vocabulary: single characters plus a few merges, so labels and keys
+# span several tokens and some values have more than one tokenization
+MERGES = [' "', '",', ' null', 'null', 'ANSW', 'ERED', '_BY', 'PTP', '00', '50', '0.', '.9', ' 5',
+          'lost', ' job', '"}', ', ', 'will', ' pay', ' next', ' week']
+VOCAB = [chr(c) for c in range(32, 127)] + MERGES + ["<pad>"]
+
+
+class FakeTokenizer:
+    """Greedy longest-match tokenizer over VOCAB; <pad> is its only special token."""
+    def __init__(self):
+        self.ids = {t: i for i, t in enumerate(VOCAB)}
+        self.pad_token_id = self.ids["<pad>"]
+        self.all_special_ids = [self.pad_token_id]
+
+    def __len__(self):
+        return len(VOCAB)
+
+    def __call__(self, text, add_special_tokens=False):
+        ids, i = [], 0
+        while i < len(text):
+            best = max((t for t in VOCAB[:-1] if text.startswith(t, i)), key=len)
+            ids.append(self.ids[best])
+            i += len(best)
+        return {"input_ids": ids}
+
+    def decode(self, ids):
+        return "".join(VOCAB[i] for i in ids if i != self.pad_token_id)
+
+
+class FakeVocab:
+    """What VocabMasks answers for the cursors, computed from VOCAB_CLASSES directly."""
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def member(self, name, tok):
+        return tok != self.tokenizer.pad_token_id and VOCAB_CLASSES[name](self.text(tok))
+
+    def text(self, tok):
+        return self.tokenizer.decode([tok])
+
+
+def make_decoder(max_string_tokens=24):
+    tokenizer = FakeTokenizer()
+    parts = compile_schema(DispositionResponse, FIELD_LABELS, REQUIRED_FIELDS)
+    return SchemaDecoder(tokenizer, parts, FakeVocab(tokenizer), max_string_tokens), tokenizer
+
+
+def decode(decoder, tokenizer, target):
+    """Drive one row greedily towards `target`, picking only what the schema allows."""
+    row = decoder.row()
+    text = tokenizer.decode(row.step())
+    while not row.done:
+        names, ids = row.allowed()
+        allowed = [t for t in range(len(VOCAB)) if t in ids or any(decoder.vocab.member(n, t) for n in names)]
+        rest = target[len(text):] if target.startswith(text) else ""
+        matching = [t for t in allowed if rest.startswith(VOCAB[t])]
+        tok = max(matching, key=lambda t: len(VOCAB[t])) if matching else allowed[0]
+        text += tokenizer.decode(row.step(tok))
+    return text, row
+
+
+VALID = ('{"disposition": "ANSWERED", "payment_disposition": "PTP", "reason_for_not_paying": "FUNDS_ISSUE", '
+         '"ptp_details": {"amount": 5000, "date": "2026-01-29"}, "remarks": "lost job, will pay next week", '
+         '"confidence_score": 0.95}')
+FAMILY = ('{"disposition": "ANSWERED_BY_FAMILY_MEMBER", "payment_disposition": null, "reason_for_not_paying": null, '
+          '"ptp_details": {"amount": null, "date": null}, "remarks": "son picked up", "confidence_score": 0.9}')
+INVALID = ('{"disposition": "NONSENSE", "payment_disposition": "maybe", "reason_for_not_paying": "lazy", '
+           '"ptp_details": {"amount": "five thousand", "date": null}, "remarks": "x\\"y", "confidence_score": "high"}')
+
+
+def test_trie_cursor_jumps_to_the_next_choice():
+    cursor = _TrieCursor(build_trie({(1, 2, 3): "a", (1, 2, 4, 5): "b", (6,): "c"}))
+    assert cursor.start() == ([], False)
+    assert cursor.allowed() == ((), (1, 6))
+    # Only 2 can follow 1, so it is appended without asking
+    assert cursor.feed(1) == ([1, 2], False)
+    assert cursor.allowed() == ((), (3, 4))
+    assert cursor.feed(4) == ([4, 5], True)
+    assert cursor.value == "b"
+
+
+def test_trie_with_one_option_needs_no_model_step():
+    cursor = _TrieCursor(build_trie({(7, 8, 9): "only"}))
+    assert cursor.start() == ([7, 8, 9], True)
+    assert cursor.value == "only"
+
+
+def test_row_follows_the_target_where_the_schema_allows():
+    decoder, tokenizer = make_decoder()
+    for target in (VALID, FAMILY):
+        text, row = decode(decoder, tokenizer, target)
+        assert text == target
+        # Keys, punctuation and the unique rest of a label are appended without a model step
+        assert len(row.tokens) - row.sampled > len(row.tokens) / 2
+
+
+def test_row_output_is_valid_json_with_allowed_labels():
+    decoder, tokenizer = make_decoder()
+    for target in (INVALID, ""):
+        text, _ = decode(decoder, tokenizer, target)
+        out = json.loads(text)
+        assert list(out) == list(DispositionResponse.model_fields)
+        assert out["disposition"] in CALL_LABELS
+        assert out["ptp_details"]["amount"] is None or isinstance(out["ptp_details"]["amount"], (int, float))
+        assert isinstance(out["confidence_score"], (int, float))
+
+
+def test_string_budget_closes_the_string():
+    decoder, tokenizer = make_decoder(max_string_tokens=5)
+    long_remarks = VALID.replace("lost job, will pay next week", "x" * 40).replace('"2026-01-29"', "null")
+    text, _ = decode(decoder, tokenizer, long_remarks)
+    assert json.loads(text)["remarks"] == "x" * 5
+    # Decoding carries on with the fields after the cut string
+    assert '"remarks": "xxxxx", "confidence_score":' in text
+
+
+def test_prompt_lookup_drafts_after_the_longest_match():
+    lookup = PromptLookup([1, 2, 3, 4, 9, 2, 3, 5, 6], max_ngram=2, num_tokens=2)
+    # "2 3" last occurs before 5 6; a lone 3 would also point there
+    assert lookup.draft([7, 2, 3]) == [5, 6]
+    assert lookup.draft([9]) == [2, 3]
+    assert lookup.draft([8]) == []
+
+
+def test_logits_to_keep_is_only_passed_when_supported():
+    class New:
+        def forward(self, input_ids, logits_to_keep=0, **kwargs):
+            pass
+
+    class Old:
+        def forward(self, input_ids, **kwargs):
+            pass
+
+    assert accepts_logits_to_keep(New())
+    assert not accepts_logits_to_keep(Old())
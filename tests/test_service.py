@@ -0,0 +1,55 @@
+from model_pool import ModelPool
+from result_cache import ResultCache, backend_identity, cache_key
+from scheduler import BatchScheduler, BULK
+from service import InferenceService
+
+from test_scheduler import FakeBackend
+
+
+class Replica(FakeBackend):
+    def __init__(self, device, model_id="merged-3b"):
+        super().__init__()
+        self.device = device
+        self.model_id = model_id
+        self.prompt_version = "p1"
+
+
+def service(gpu_devices, cpu_devices=(), **pool_kw):
+    def scheduler(device):
+        return BatchScheduler(Replica(device), name=device, max_wait_ms=1)
+    pool = ModelPool([scheduler(d) for d in gpu_devices], [scheduler(d) for d in cpu_devices], **pool_kw)
+    return InferenceService(pool.start(), cache=ResultCache(max_size=100, db_path="")), pool
+
+
+def cached(svc, transcript):
+    fut = svc.submit(transcript, "2024-01-01")
+    fut.result(timeout=5)
+    return bool((getattr(fut, "timings", None) or {}).get("cache_hit"))
+
+
+def test_cache_key_includes_runtime():
+    gpu, cpu = backend_identity(Replica("cuda:1")), backend_identity(Replica("cpu:0"))
+    assert gpu == ("merged-3b", "cuda", "p1") and cpu == ("merged-3b", "cpu", "p1")
+    assert backend_identity(Replica("cuda:0")) == gpu
+    assert cache_key("hi", "2024-01-01", *gpu) != cache_key("hi", "2024-01-01", *cpu)
+
+
+def test_cpu_replica_answers_are_not_cached_as_gpu_answers():
+    svc, pool = service(["cuda:0"], ["cpu:0"], routing={"bulk"})
+    try:
+        svc.submit("upload row", "2024-01-01", lane=BULK).result(timeout=5)
+        assert pool.cpu_replicas[0].backend.batches == [["upload row"]]
+        assert not cached(svc, "upload row")
+        assert pool.replicas[0].backend.batches == [["upload row"]]
+        assert cached(svc, "upload row")
+    finally:
+        pool.stop(1)
+
+
+def test_cpu_only_pool_caches():
+    svc, pool = service(["cpu:0", "cpu:1"])
+    try:
+        assert not cached(svc, "live call")
+        assert cached(svc, "live call")
+    finally:
+        pool.stop(1)